@@ -20,11 +20,143 @@ import sqlite3
 import os
 import sys
 import json
+import math
+import time
+import random
 import logging
-from datetime import datetime
+import functools
+import threading
+from datetime import datetime, date, timedelta
+
+from models.calcolo_colonne import calcola_materiali, calcola_preventivi, CAMPI_MATERIALE, CAMPI_PREVENTIVO
+
+# Profili di storage selezionabili in config.json ("storage_profile": "local" | "shared").
+# I singoli valori si possono sovrascrivere con la chiave "storage" di config.json.
+# Nota: il profilo "shared" NON usa WAL: il WAL richiede memoria condivisa tra i processi
+# e non funziona su file system di rete (SMB); su share si usa il journal classico con
+# busy_timeout lungo e retry con backoff.
+PROFILI_STORAGE = {
+    'local': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,         # ms
+        'cache_size': -16000,         # KiB (negativo = dimensione, non pagine)
+        'mmap_size': 268435456,       # 256 MiB
+        'retry_tentativi': 5,
+        'retry_attesa_ms': 50,
+    },
+    'shared': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 15000,
+        'cache_size': -16000,
+        'mmap_size': 0,               # mmap su share di rete non è affidabile
+        'retry_tentativi': 8,
+        'retry_attesa_ms': 100,
+    },
+}
+
+_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+_SYNCHRONOUS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
+
+# Cache di processo dei nomi clienti distinti, per file di database:
+# {db_path: (connessione, data_version, nomi)}. Le scritture di questo processo la svuotano;
+# quelle di altri PC (database condiviso) cambiano PRAGMA data_version, che però vale solo
+# per la connessione che l'ha letto: la voce è valida solo per quella connessione.
+_cache_nomi_clienti = {}
+_cache_nomi_clienti_lock = threading.Lock()
+
+
+class DatabaseOccupato(Exception):
+    """Database bloccato da un altro PC/processo (SQLITE_BUSY): l'operazione si può ritentare.
+    Non deriva da sqlite3.Error, così attraversa i gestori d'errore dei metodi fino al retry."""
+
+
+def _e_occupato(errore):
+    """True se l'errore sqlite indica un lock di un'altra connessione (SQLITE_BUSY/LOCKED)."""
+    messaggio = str(errore).lower()
+    return isinstance(errore, sqlite3.OperationalError) and ('locked' in messaggio or 'busy' in messaggio)
+
+
+class _Cursore(sqlite3.Cursor):
+    """Cursore che, durante un tentativo ritentabile, converte SQLITE_BUSY in DatabaseOccupato."""
+
+    def execute(self, *args):
+        try:
+            return super().execute(*args)
+        except sqlite3.OperationalError as e:
+            if self.connection.traduci_occupato and _e_occupato(e):
+                raise DatabaseOccupato(str(e)) from e
+            raise
+
+    def executemany(self, *args):
+        try:
+            return super().executemany(*args)
+        except sqlite3.OperationalError as e:
+            if self.connection.traduci_occupato and _e_occupato(e):
+                raise DatabaseOccupato(str(e)) from e
+            raise
+
+
+class _Connessione(sqlite3.Connection):
+    """Connessione con cursori _Cursore e commit ritentabile."""
+
+    traduci_occupato = False
+
+    def cursor(self, factory=_Cursore):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        except sqlite3.OperationalError as e:
+            if self.traduci_occupato and _e_occupato(e):
+                raise DatabaseOccupato(str(e)) from e
+            raise
+
+
+def _riprova_se_occupato(metodo):
+    """Decoratore per i metodi di scrittura: se il database è occupato annulla la transazione
+    e ritenta con backoff esponenziale. L'ultimo tentativo gira senza conversione, così un
+    lock persistente segue la gestione d'errore originale del metodo."""
+    @functools.wraps(metodo)
+    def wrapper(self, *args, **kwargs):
+        conn = self._connect()
+        precedente = conn.traduci_occupato
+        tentativi = max(1, int(self.profilo_storage['retry_tentativi']))
+        attesa = self.profilo_storage['retry_attesa_ms'] / 1000.0
+        try:
+            for n in range(tentativi - 1):
+                conn.traduci_occupato = True
+                try:
+                    return metodo(self, *args, **kwargs)
+                except DatabaseOccupato as e:
+                    if precedente:
+                        raise  # chiamata annidata: si ritenta l'intero metodo esterno
+                    if conn.in_transaction:
+                        conn.rollback()
+                    pausa = attesa * (2 ** n) * (0.5 + random.random())
+                    logging.getLogger('rcs').warning(
+                        f"DB occupato in {metodo.__name__} (tentativo {n + 1}/{tentativi}): {e}; "
+                        f"nuovo tentativo tra {pausa * 1000:.0f} ms")
+                    time.sleep(pausa)
+            conn.traduci_occupato = False
+            return metodo(self, *args, **kwargs)
+        finally:
+            conn.traduci_occupato = precedente
+    return wrapper
+
 
 class DatabaseManager:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, profilo=None, opzioni_storage=None):
+        config = {}
         if db_path is None:
             if getattr(sys, 'frozen', False):
                 base_dir = os.path.dirname(sys.executable)
@@ -38,18 +170,111 @@ class DatabaseManager:
                         config = json.load(f)
                     db_path = config.get("db_path") or os.path.join(base_dir, "data", "materiali.db")
                 except Exception:
+                    config = {}
                     db_path = os.path.join(base_dir, "data", "materiali.db")
             else:
                 db_path = os.path.join(base_dir, "data", "materiali.db")
         self.db_path = db_path
+        if profilo is None:
+            # Un db_path in config.json è un database condiviso (vedi dialogo primo avvio)
+            profilo = config.get("storage_profile") or ("shared" if config.get("db_path") else "local")
+        self.profilo_storage = self._carica_profilo_storage(profilo, config.get("storage") or {}, opzioni_storage or {})
+        # Una connessione persistente per thread: evita apertura file, lock probe
+        # e parsing dello schema a ogni chiamata (costosi su percorsi di rete SMB)
+        self._local = threading.local()
+        self._connessioni = {}  # {thread_ident: connessione} per la chiusura globale
+        self._connessioni_lock = threading.Lock()
+        self._cache_previsioni = {}  # {(giorni_storico, giorni_riordino): (versione, previsioni)}
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.init_database()
         self._backup_database()
+        # Controllo incrementale delle giacenze: solo segnalazione nel log, senza riparare
+        self.verifica_giacenze(incrementale=True)
+
+    @staticmethod
+    def _carica_profilo_storage(nome, *sovrascritture):
+        """Restituisce il profilo di storage `nome` con le sovrascritture applicate e validate."""
+        if nome not in PROFILI_STORAGE:
+            logging.getLogger('rcs').warning(f"Profilo storage sconosciuto '{nome}', uso 'local'")
+            nome = 'local'
+        profilo = dict(PROFILI_STORAGE[nome], nome=nome)
+        for valori in sovrascritture:
+            for chiave, valore in valori.items():
+                if chiave not in PROFILI_STORAGE['local']:
+                    logging.getLogger('rcs').warning(f"Opzione storage sconosciuta ignorata: {chiave}")
+                    continue
+                if chiave == 'journal_mode' or chiave == 'synchronous':
+                    valore = str(valore).upper()
+                    ammessi = _JOURNAL_MODES if chiave == 'journal_mode' else _SYNCHRONOUS
+                    if valore not in ammessi:
+                        logging.getLogger('rcs').warning(f"Valore non valido per {chiave}: {valore}")
+                        continue
+                else:
+                    try:
+                        valore = int(valore)
+                    except (TypeError, ValueError):
+                        logging.getLogger('rcs').warning(f"Valore non valido per {chiave}: {valore}")
+                        continue
+                profilo[chiave] = valore
+        return profilo
+
+    # =================== GESTIONE CONNESSIONI ===================
+
+    def _connect(self):
+        """Restituisce la connessione del thread corrente, aprendola alla prima richiesta.
+        Usata come context manager fa commit/rollback come sqlite3.connect(), ma resta aperta."""
+        conn = getattr(self._local, 'conn', None)
+        ident = threading.get_ident()
+        if conn is not None and self._connessioni.get(ident) is conn:
+            return conn
+
+        # check_same_thread=False solo per consentire a close() di chiuderla da un altro
+        # thread: ogni connessione resta usata esclusivamente dal thread che l'ha aperta
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=_Connessione)
+        self._applica_profilo_storage(conn)
+        with self._connessioni_lock:
+            vecchia = self._connessioni.get(ident)
+            self._connessioni[ident] = conn
+        if vecchia is not None:
+            # Ident riutilizzato da un thread terminato: chiudi la connessione orfana
+            try:
+                vecchia.close()
+            except sqlite3.Error:
+                pass
+        self._local.conn = conn
+        return conn
+
+    def _applica_profilo_storage(self, conn):
+        """Imposta le PRAGMA del profilo di storage su una connessione appena aperta"""
+        p = self.profilo_storage
+        conn.execute(f"PRAGMA busy_timeout = {p['busy_timeout']}")
+        try:
+            conn.execute(f"PRAGMA journal_mode = {p['journal_mode']}")
+        except sqlite3.OperationalError as e:
+            # Il cambio di journal mode richiede che nessun altro abbia il db aperto
+            logging.getLogger('rcs').warning(f"Impossibile impostare journal_mode={p['journal_mode']}: {e}")
+        conn.execute(f"PRAGMA synchronous = {p['synchronous']}")
+        conn.execute(f"PRAGMA cache_size = {p['cache_size']}")
+        conn.execute(f"PRAGMA mmap_size = {p['mmap_size']}")
+
+    def close(self):
+        """Chiude tutte le connessioni aperte (di tutti i thread).
+        Una chiamata successiva a un metodo del manager riapre la connessione."""
+        with self._connessioni_lock:
+            connessioni = list(self._connessioni.values())
+            self._connessioni.clear()
+        for conn in connessioni:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.getLogger('rcs').error(f"DB error in close: {e}")
+        self._local.conn = None
+        self._cache_previsioni.clear()
+        self._invalida_cache_clienti()
 
     def _backup_database(self):
         """Crea un backup automatico del database all'avvio. Mantiene gli ultimi 7 backup."""
         try:
-            import shutil
             backup_dir = os.path.join(os.path.dirname(self.db_path), "backup")
             os.makedirs(backup_dir, exist_ok=True)
 
@@ -58,7 +283,12 @@ class DatabaseManager:
             backup_path = os.path.join(backup_dir, backup_name)
 
             if os.path.exists(self.db_path):
-                shutil.copy2(self.db_path, backup_path)
+                # API di backup sqlite: copia coerente anche in WAL (una copia del file perderebbe il -wal)
+                destinazione = sqlite3.connect(backup_path)
+                try:
+                    self._connect().backup(destinazione)
+                finally:
+                    destinazione.close()
 
             # Mantieni solo gli ultimi 7 backup
             backups = sorted([
@@ -69,90 +299,539 @@ class DatabaseManager:
         except Exception:
             pass  # Backup non critico, non blocca l'avvio
 
+    # Registro migrazioni dello schema: (versione, descrizione, metodo).
+    # PRAGMA user_version contiene l'ultima versione applicata: un database aggiornato
+    # costa una sola lettura di pragma all'avvio.
+    MIGRAZIONI = [
+        (1, "schema base (materiali, preventivi, magazzino, fornitori, clienti)", '_migrazione_schema_base'),
+        (2, "indici secondari per le query frequenti", '_migrazione_indici'),
+        (3, "storico modifiche preventivi in tabella dedicata", '_migrazione_storico_preventivi'),
+        (4, "storico preventivi a delta con checkpoint", '_migrazione_storico_delta'),
+        (5, "materiali dei preventivi in tabella normalizzata", '_migrazione_preventivo_materiali'),
+        (6, "indice full-text sui preventivi", '_migrazione_ricerca_preventivi'),
+        (7, "indice per la paginazione dei preventivi", '_migrazione_paginazione_preventivi'),
+        (8, "riepilogo scorte per materiale aggiornato da trigger", '_migrazione_scorte_materiali'),
+        (9, "indice dei movimenti per preventivo (scarico consumi)", '_migrazione_movimenti_preventivo'),
+        (10, "checkpoint mensili delle giacenze", '_migrazione_checkpoint_giacenze'),
+        (11, "giacenze di apertura e materiali da verificare (controllo giacenze)", '_migrazione_verifica_giacenze'),
+        (12, "prezzo dei movimenti e strati di costo mensili (valorizzazione)", '_migrazione_valorizzazione'),
+    ]
+
+    @_riprova_se_occupato
     def init_database(self):
-        """Inizializza il database con le tabelle necessarie"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Porta il database all'ultima versione dello schema applicando le migrazioni mancanti"""
+        versione_finale = self.MIGRAZIONI[-1][0]
+        with self._connect() as conn:
+            versione = conn.execute("PRAGMA user_version").fetchone()[0]
+            if versione >= versione_finale:
+                return
+
+            # BEGIN IMMEDIATE: se due PC avviano insieme, il secondo attende e
+            # rilegge la versione già aggiornata dal primo
+            conn.execute("BEGIN IMMEDIATE")
             cursor = conn.cursor()
+            versione = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for numero, descrizione, metodo in self.MIGRAZIONI:
+                if numero <= versione:
+                    continue
+                t0 = time.perf_counter()
+                getattr(self, metodo)(cursor)
+                cursor.execute(f"PRAGMA user_version = {numero}")
+                logging.getLogger('rcs').info(
+                    f"Migrazione schema {numero} ({descrizione}) applicata in "
+                    f"{(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    # =================== MIGRAZIONI SCHEMA ===================
+
+    def _migrazione_schema_base(self, cursor):
+        """Versione 1: schema storico. Idempotente, perché i database creati prima del
+        versioning hanno user_version = 0 ma già tutte (o parte delle) tabelle."""
+        # Tabella materiali (IDENTICA ALL'ORIGINALE)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS materiali (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nome TEXT NOT NULL UNIQUE,
+                spessore REAL NOT NULL,
+                prezzo REAL NOT NULL
+            )
+        """)
 
-            # Tabella materiali (IDENTICA ALL'ORIGINALE)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS materiali (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    nome TEXT NOT NULL UNIQUE,
-                    spessore REAL NOT NULL,
-                    prezzo REAL NOT NULL
-                )
-            """)
+        # Tabella preventivi - AGGIORNATA con campo storico_modifiche e misura
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS preventivi (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data_creazione TEXT NOT NULL,
+                numero_revisione INTEGER NOT NULL DEFAULT 1,
+                preventivo_originale_id INTEGER,
+                nome_cliente TEXT NOT NULL DEFAULT '',
+                numero_ordine TEXT NOT NULL DEFAULT '',
+                misura TEXT NOT NULL DEFAULT '',
+                descrizione TEXT NOT NULL DEFAULT '',
+                codice TEXT NOT NULL DEFAULT '',
+                finitura TEXT NOT NULL DEFAULT '',
+                costo_totale_materiali REAL,
+                costi_accessori REAL,
+                minuti_taglio REAL,
+                minuti_avvolgimento REAL,
+                minuti_pulizia REAL,
+                minuti_rettifica REAL,
+                minuti_imballaggio REAL,
+                tot_mano_opera REAL,
+                subtotale REAL,
+                maggiorazione_25 REAL,
+                preventivo_finale REAL,
+                prezzo_cliente REAL,
+                materiali_utilizzati TEXT,
+                note_revisione TEXT,
+                storico_modifiche TEXT DEFAULT '[]',
+                FOREIGN KEY (preventivo_originale_id) REFERENCES preventivi(id)
+            )
+        """)
 
-            # Tabella preventivi - AGGIORNATA con campo storico_modifiche e misura
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS preventivi (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    data_creazione TEXT NOT NULL,
-                    numero_revisione INTEGER NOT NULL DEFAULT 1,
-                    preventivo_originale_id INTEGER,
-                    nome_cliente TEXT NOT NULL DEFAULT '',
-                    numero_ordine TEXT NOT NULL DEFAULT '',
-                    misura TEXT NOT NULL DEFAULT '',
-                    descrizione TEXT NOT NULL DEFAULT '',
-                    codice TEXT NOT NULL DEFAULT '',
-                    finitura TEXT NOT NULL DEFAULT '',
-                    costo_totale_materiali REAL,
-                    costi_accessori REAL,
-                    minuti_taglio REAL,
-                    minuti_avvolgimento REAL,
-                    minuti_pulizia REAL,
-                    minuti_rettifica REAL,
-                    minuti_imballaggio REAL,
-                    tot_mano_opera REAL,
-                    subtotale REAL,
-                    maggiorazione_25 REAL,
-                    preventivo_finale REAL,
-                    prezzo_cliente REAL,
-                    materiali_utilizzati TEXT,
-                    note_revisione TEXT,
-                    storico_modifiche TEXT DEFAULT '[]',
-                    FOREIGN KEY (preventivo_originale_id) REFERENCES preventivi(id)
+        # Migrazione automatica per aggiungere le nuove colonne se non esistono
+        self._migrate_database(cursor)
+
+        # Inserimento materiali di esempio se la tabella è vuota (IDENTICO ALL'ORIGINALE)
+        cursor.execute("SELECT COUNT(*) FROM materiali")
+        if cursor.fetchone()[0] == 0:
+            materiali_esempio = [
+                ("HS300", 0.3, 20.00),
+                ("HS150", 0.15, 15.00),
+                ("HM 150/40J", 0.15, 42.00),
+                ("IM45", 0.05, 21.00),
+                ("HM 100/64", 0.1, 30.00),
+                ("CC200PL", 0.25, 30.00),
+                ("CC206", 0.23, 30.00),
+                ("GG204", 0.25, 30.00),
+                ("TWILL", 0.25, 30.00),
+                ("CC222", 0.25, 32.00),
+                ("CC631", 0.25, 41.00),
+                ("CC630", 0.25, 41.00),
+                ("GG800T", 0.8, 46.00),
+                ("CBX200", 0.25, 30.00),
+                ("CBX300", 0.33, 30.00),
+                ("STY280", 0.2, 35.00),
+                ("CK204", 0.25, 32.00),
+                ("VV1017", 0.35, 15.00),
+                ("VV1031", 0.25, 12.00),
+                ("VR192", 0.15, 12.00),
+                ("VV116", 0.15, 10.00),
+                ("VV350", 0.37, 15.00),
+                ("VV770", 0.75, 18.00)
+            ]
+            cursor.executemany(
+                "INSERT INTO materiali (nome, spessore, prezzo) VALUES (?, ?, ?)",
+                materiali_esempio
+            )
+
+    def _migrazione_indici(self, cursor):
+        """Versione 2: indici per le query di magazzino, revisioni, clienti e fornitori"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movimenti_materiale_data ON movimenti_magazzino (materiale_id, data)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movimenti_tipo_data ON movimenti_magazzino (tipo, data)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movimenti_data ON movimenti_magazzino (data)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivi_originale_revisione ON preventivi (preventivo_originale_id, numero_revisione)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivi_nome_cliente ON preventivi (nome_cliente)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_materiale_fornitori_fornitore ON materiale_fornitori (fornitore_nome)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_materiali_fornitore ON materiali (fornitore)")
+
+    def _migrazione_storico_preventivi(self, cursor):
+        """Versione 3: una riga per snapshot in preventivi_storico al posto del blob JSON
+        storico_modifiche, che veniva riletto e riscritto per intero a ogni salvataggio.
+        La colonna resta (a '[]') per i client non ancora aggiornati."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS preventivi_storico (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                preventivo_id INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                dati TEXT NOT NULL,
+                FOREIGN KEY (preventivo_id) REFERENCES preventivi(id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivi_storico_preventivo ON preventivi_storico (preventivo_id, id)")
+
+        # Travaso una tantum dei blob esistenti, nello stesso ordine (dal più vecchio)
+        cursor.execute("""
+            SELECT id, storico_modifiche FROM preventivi
+            WHERE storico_modifiche IS NOT NULL AND storico_modifiche != '[]'
+        """)
+        for preventivo_id, storico_json in cursor.fetchall():
+            try:
+                storico = json.loads(storico_json) if storico_json else []
+            except (json.JSONDecodeError, TypeError):
+                logging.getLogger('rcs').warning(
+                    f"Storico modifiche non leggibile per il preventivo {preventivo_id}: ignorato")
+                storico = []
+            cursor.executemany(
+                "INSERT INTO preventivi_storico (preventivo_id, timestamp, dati) VALUES (?, ?, ?)",
+                [(preventivo_id, snapshot.get('timestamp', ''), json.dumps(snapshot.get('data', {})))
+                 for snapshot in storico if isinstance(snapshot, dict)]
+            )
+        cursor.execute("UPDATE preventivi SET storico_modifiche = '[]' WHERE storico_modifiche != '[]'")
+
+    def _migrazione_storico_delta(self, cursor):
+        """Versione 4: gli snapshot possono essere completi (checkpoint) o delta rispetto
+        alla versione precedente. Le righe esistenti sono tutte complete."""
+        cursor.execute("PRAGMA table_info(preventivi_storico)")
+        if 'completo' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE preventivi_storico ADD COLUMN completo INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivi_storico_checkpoint ON preventivi_storico (preventivo_id, completo, id)")
+
+    def _migrazione_preventivo_materiali(self, cursor):
+        """Versione 5: una riga per materiale di ogni preventivo, per interrogare consumi e
+        costi senza decodificare il JSON. La colonna materiali_utilizzati resta la fonte
+        completa (conicità, orientamento, ...); questa tabella ne è la proiezione."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS preventivo_materiali (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                preventivo_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                materiale_id INTEGER,
+                materiale_nome TEXT NOT NULL DEFAULT '',
+                giri INTEGER NOT NULL DEFAULT 0,
+                lunghezza REAL NOT NULL DEFAULT 0,
+                sviluppo REAL NOT NULL DEFAULT 0,
+                lunghezza_utilizzata REAL NOT NULL DEFAULT 0,
+                costo_totale REAL NOT NULL DEFAULT 0,
+                is_conica INTEGER NOT NULL DEFAULT 0,
+                posa TEXT NOT NULL DEFAULT '==',
+                FOREIGN KEY (preventivo_id) REFERENCES preventivi(id),
+                FOREIGN KEY (materiale_id) REFERENCES materiali(id)
+            )
+        """)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_preventivo_materiali_preventivo ON preventivo_materiali (preventivo_id, position)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivo_materiali_materiale ON preventivo_materiali (materiale_id)")
+
+        # Backfill dai JSON esistenti
+        cursor.execute("SELECT id, materiali_utilizzati FROM preventivi")
+        for preventivo_id, materiali_json in cursor.fetchall():
+            self._scrivi_materiali_preventivo(cursor, preventivo_id, materiali_json)
+
+    def _migrazione_ricerca_preventivi(self, cursor):
+        """Versione 6: indice FTS5 (a contenuto esterno) sui campi testuali dei preventivi,
+        allineato da trigger. Se l'SQLite in uso non ha FTS5 la migrazione non crea nulla
+        e search_preventivi usa LIKE."""
+        campi = ", ".join(self.CAMPI_RICERCA)
+        nuovi = ", ".join(f"new.{c}" for c in self.CAMPI_RICERCA)
+        vecchi = ", ".join(f"old.{c}" for c in self.CAMPI_RICERCA)
+        try:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS preventivi_fts USING fts5(
+                    {campi}, content='preventivi', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
                 )
             """)
+        except sqlite3.OperationalError as e:
+            logging.getLogger('rcs').warning(f"FTS5 non disponibile, ricerca preventivi con LIKE: {e}")
+            return
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS preventivi_fts_ai AFTER INSERT ON preventivi BEGIN
+                INSERT INTO preventivi_fts (rowid, {campi}) VALUES (new.id, {nuovi});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS preventivi_fts_ad AFTER DELETE ON preventivi BEGIN
+                INSERT INTO preventivi_fts (preventivi_fts, rowid, {campi}) VALUES ('delete', old.id, {vecchi});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS preventivi_fts_au AFTER UPDATE OF {campi} ON preventivi BEGIN
+                INSERT INTO preventivi_fts (preventivi_fts, rowid, {campi}) VALUES ('delete', old.id, {vecchi});
+                INSERT INTO preventivi_fts (rowid, {campi}) VALUES (new.id, {nuovi});
+            END
+        """)
+        cursor.execute("INSERT INTO preventivi_fts (preventivi_fts) VALUES ('rebuild')")
+
+    def _migrazione_paginazione_preventivi(self, cursor):
+        """Versione 7: indice sulla chiave di paginazione (data_creazione, id)"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preventivi_data_id ON preventivi (data_creazione, id)")
+
+    # Aggregati di materiale_fornitori per un materiale: una riga per materiale con almeno un fornitore
+    _AGGREGATI_SCORTE = """
+        SELECT materiale_id, SUM(giacenza), MAX(scorta_massima), COUNT(*),
+               MIN(prezzo_fornitore), MIN(fornitore_nome)
+        FROM materiale_fornitori
+        {where}
+        GROUP BY materiale_id
+    """
+
+    def _migrazione_scorte_materiali(self, cursor):
+        """Versione 8: riepilogo delle scorte per materiale (somma giacenze, scorta massima,
+        numero fornitori, prezzo minimo, primo fornitore) tenuto allineato da trigger su
+        materiale_fornitori. get_scorte lo legge per chiave invece di raggruppare ogni volta.
+        I trigger ricalcolano la riga del materiale toccato (pochi fornitori, via indice
+        UNIQUE (materiale_id, fornitore_nome)) invece di sommare differenze: nessuna deriva."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scorte_materiali (
+                materiale_id INTEGER PRIMARY KEY,
+                giacenza REAL NOT NULL,
+                scorta_massima REAL NOT NULL,
+                n_fornitori INTEGER NOT NULL,
+                prezzo_min REAL NOT NULL,
+                primo_fornitore TEXT NOT NULL
+            )
+        """)
+        ricalcola = {
+            chiave: f"""
+                DELETE FROM scorte_materiali WHERE materiale_id = {chiave}.materiale_id;
+                INSERT INTO scorte_materiali {self._AGGREGATI_SCORTE.format(where=f"WHERE materiale_id = {chiave}.materiale_id")};"""
+            for chiave in ('new', 'old')
+        }
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS scorte_materiali_ai AFTER INSERT ON materiale_fornitori BEGIN
+                {ricalcola['new']}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS scorte_materiali_ad AFTER DELETE ON materiale_fornitori BEGIN
+                {ricalcola['old']}
+            END
+        """)
+        # Se cambia materiale_id vanno ricalcolati sia il vecchio che il nuovo materiale
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS scorte_materiali_au AFTER UPDATE OF
+                materiale_id, fornitore_nome, prezzo_fornitore, scorta_massima, giacenza
+            ON materiale_fornitori BEGIN
+                {ricalcola['old']}
+                {ricalcola['new']}
+            END
+        """)
+        self._ricostruisci_scorte_materiali(cursor)
+
+    def _ricostruisci_scorte_materiali(self, cursor):
+        """Riscrive da zero il riepilogo scorte (nella transazione del chiamante)"""
+        cursor.execute("DELETE FROM scorte_materiali")
+        cursor.execute(f"INSERT INTO scorte_materiali {self._AGGREGATI_SCORTE.format(where='')}")
+
+    def _migrazione_movimenti_preventivo(self, cursor):
+        """Versione 9: indice per leggere i movimenti generati da un preventivo (scarico consumi e storno)"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_movimenti_preventivo ON movimenti_magazzino (preventivo_id, id)")
+
+    def _migrazione_checkpoint_giacenze(self, cursor):
+        """Versione 10: fotografia delle giacenze per (materiale, fornitore) all'inizio di ogni
+        mese, per rispondere a "quanto c'era in magazzino il 31/12" senza rileggere tutto lo
+        storico. Fornitore '' = giacenza legacy di materiali. I checkpoint si scrivono solo
+        in avanti, dai contatori del momento (_checkpoint_mensile): i mesi passati non si
+        ricostruiscono togliendo i movimenti dai contatori attuali, che non tornerebbe
+        quando uno scarico è stato fermato a 0."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS giacenze_checkpoint (
+                data TEXT NOT NULL,
+                materiale_id INTEGER NOT NULL,
+                fornitore_nome TEXT NOT NULL,
+                giacenza REAL NOT NULL,
+                PRIMARY KEY (data, materiale_id, fornitore_nome)
+            )
+        """)
 
-            # Migrazione automatica per aggiungere le nuove colonne se non esistono
-            self._migrate_database(cursor)
-
-            # Inserimento materiali di esempio se la tabella è vuota (IDENTICO ALL'ORIGINALE)
-            cursor.execute("SELECT COUNT(*) FROM materiali")
-            if cursor.fetchone()[0] == 0:
-                materiali_esempio = [
-                    ("HS300", 0.3, 20.00),
-                    ("HS150", 0.15, 15.00),
-                    ("HM 150/40J", 0.15, 42.00),
-                    ("IM45", 0.05, 21.00),
-                    ("HM 100/64", 0.1, 30.00),
-                    ("CC200PL", 0.25, 30.00),
-                    ("CC206", 0.23, 30.00),
-                    ("GG204", 0.25, 30.00),
-                    ("TWILL", 0.25, 30.00),
-                    ("CC222", 0.25, 32.00),
-                    ("CC631", 0.25, 41.00),
-                    ("CC630", 0.25, 41.00),
-                    ("GG800T", 0.8, 46.00),
-                    ("CBX200", 0.25, 30.00),
-                    ("CBX300", 0.33, 30.00),
-                    ("STY280", 0.2, 35.00),
-                    ("CK204", 0.25, 32.00),
-                    ("VV1017", 0.35, 15.00),
-                    ("VV1031", 0.25, 12.00),
-                    ("VR192", 0.15, 12.00),
-                    ("VV116", 0.15, 10.00),
-                    ("VV350", 0.37, 15.00),
-                    ("VV770", 0.75, 18.00)
-                ]
-                cursor.executemany(
-                    "INSERT INTO materiali (nome, spessore, prezzo) VALUES (?, ?, ?)",
-                    materiali_esempio
-                )
+    # Contatori di giacenza per (materiale, fornitore): fornitore '' = giacenza legacy di materiali
+    _CONTATORI_GIACENZE = """
+        SELECT id AS materiale_id, '' AS fornitore_nome, giacenza FROM materiali {where_materiali}
+        UNION ALL
+        SELECT materiale_id, fornitore_nome, giacenza FROM materiale_fornitori {where}
+    """
+
+    # Movimenti per (materiale, fornitore), con la stessa convenzione, in ordine (data, id):
+    # saldo = carichi - scarichi, minimo = progressivo più basso subito dopo uno scarico.
+    # I contatori fermano ogni scarico a 0, quindi la giacenza dopo i movimenti non è
+    # giacenza + saldo ma MAX(giacenza + saldo, saldo - minimo): vedi _giacenza_dopo_movimenti.
+    # {join} e {where} filtrano i movimenti, con alias m.
+    _SALDI_MOVIMENTI = """
+        SELECT materiale_id, fornitore_nome, SUM(delta) AS saldo,
+               MIN(CASE WHEN tipo = 'scarico' THEN progressivo END) AS minimo
+        FROM (
+            SELECT m.materiale_id, COALESCE(m.fornitore_nome, '') AS fornitore_nome, m.tipo,
+                   CASE m.tipo WHEN 'carico' THEN m.quantita WHEN 'scarico' THEN -m.quantita ELSE 0 END AS delta,
+                   SUM(CASE m.tipo WHEN 'carico' THEN m.quantita WHEN 'scarico' THEN -m.quantita ELSE 0 END)
+                       OVER (PARTITION BY m.materiale_id, COALESCE(m.fornitore_nome, '') ORDER BY m.data, m.id)
+                       AS progressivo
+            FROM movimenti_magazzino m {join}
+            {where}
+        )
+        GROUP BY materiale_id, fornitore_nome
+    """
+
+    @staticmethod
+    def _giacenza_dopo_movimenti(giacenza, saldi):
+        """Espressione SQL della giacenza che parte da `giacenza` e ripete i movimenti
+        riassunti dalla riga `saldi` di _SALDI_MOVIMENTI (NULL se non ce ne sono), con
+        ogni scarico fermo a 0 come in registra_movimento"""
+        finale = f"{giacenza} + COALESCE({saldi}.saldo, 0.0)"
+        return f"MAX({finale}, COALESCE({saldi}.saldo - {saldi}.minimo, {finale}))"
+
+    def _migrazione_verifica_giacenze(self, cursor):
+        """Versione 11: tabelle del controllo giacenze (verifica_giacenze).
+        giacenze_iniziali tiene la parte di giacenza che non viene dai movimenti: quella
+        presente quando il contatore è nato (materiale creato con giacenza, fornitore
+        aggiunto) e, per i database esistenti, la differenza tra contatori e movimenti al
+        momento dell'aggiornamento, che diventa il punto di partenza del controllo.
+        giacenze_da_verificare raccoglie i materiali toccati dall'ultimo controllo, per la
+        verifica incrementale all'avvio. Entrambe sono tenute da trigger."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS giacenze_iniziali (
+                materiale_id INTEGER NOT NULL,
+                fornitore_nome TEXT NOT NULL,
+                giacenza REAL NOT NULL,
+                PRIMARY KEY (materiale_id, fornitore_nome)
+            )
+        """)
+        cursor.execute("CREATE TABLE IF NOT EXISTS giacenze_da_verificare (materiale_id INTEGER PRIMARY KEY)")
+
+        def apertura(materiale_id, fornitore_nome):
+            # Un contatore che nasce ora è allineato per definizione ai movimenti che ha già
+            return f"""
+                INSERT OR REPLACE INTO giacenze_iniziali (materiale_id, fornitore_nome, giacenza)
+                SELECT {materiale_id}, {fornitore_nome}, new.giacenza - COALESCE(
+                    (SELECT saldo FROM ({self._SALDI_MOVIMENTI.format(join='', where=f"WHERE m.materiale_id = {materiale_id}")})
+                     WHERE fornitore_nome = {fornitore_nome}), 0);"""
+
+        def da_verificare(materiale_id):
+            return f"INSERT OR IGNORE INTO giacenze_da_verificare (materiale_id) VALUES ({materiale_id});"
+
+        trigger = {
+            'giacenze_materiali_ai': f"""AFTER INSERT ON materiali BEGIN
+                {apertura('new.id', "''")}
+                {da_verificare('new.id')}""",
+            'giacenze_materiali_ad': """AFTER DELETE ON materiali BEGIN
+                DELETE FROM giacenze_iniziali WHERE materiale_id = old.id;""",
+            'giacenze_materiali_au': f"""AFTER UPDATE OF giacenza ON materiali
+                WHEN new.giacenza IS NOT old.giacenza BEGIN
+                {da_verificare('new.id')}""",
+            'giacenze_fornitori_ai': f"""AFTER INSERT ON materiale_fornitori BEGIN
+                {apertura('new.materiale_id', 'new.fornitore_nome')}
+                {da_verificare('new.materiale_id')}""",
+            'giacenze_fornitori_ad': f"""AFTER DELETE ON materiale_fornitori BEGIN
+                DELETE FROM giacenze_iniziali
+                WHERE materiale_id = old.materiale_id AND fornitore_nome = old.fornitore_nome;
+                {da_verificare('old.materiale_id')}""",
+            # Rinomina del fornitore: la giacenza di apertura segue il contatore
+            'giacenze_fornitori_au': f"""AFTER UPDATE OF materiale_id, fornitore_nome, giacenza
+                ON materiale_fornitori BEGIN
+                UPDATE OR REPLACE giacenze_iniziali
+                SET materiale_id = new.materiale_id, fornitore_nome = new.fornitore_nome
+                WHERE materiale_id = old.materiale_id AND fornitore_nome = old.fornitore_nome;
+                {da_verificare('old.materiale_id')}
+                {da_verificare('new.materiale_id')}""",
+            'giacenze_movimenti_ai': f"""AFTER INSERT ON movimenti_magazzino BEGIN
+                {da_verificare('new.materiale_id')}""",
+            'giacenze_movimenti_ad': f"""AFTER DELETE ON movimenti_magazzino BEGIN
+                {da_verificare('old.materiale_id')}""",
+            'giacenze_movimenti_au': f"""AFTER UPDATE ON movimenti_magazzino BEGIN
+                {da_verificare('old.materiale_id')}
+                {da_verificare('new.materiale_id')}""",
+        }
+        for nome, corpo in trigger.items():
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {nome} {corpo}\n            END")
+
+        # Database esistente: lo stato attuale è il punto di partenza
+        cursor.execute("DELETE FROM giacenze_iniziali")
+        cursor.execute(f"""
+            INSERT INTO giacenze_iniziali (materiale_id, fornitore_nome, giacenza)
+            SELECT c.materiale_id, c.fornitore_nome, c.giacenza - COALESCE(s.saldo, 0)
+            FROM ({self._CONTATORI_GIACENZE.format(where_materiali='', where='')}) c
+            LEFT JOIN ({self._SALDI_MOVIMENTI.format(join='', where='')}) s
+                ON s.materiale_id = c.materiale_id AND s.fornitore_nome = c.fornitore_nome
+            WHERE ABS(c.giacenza - COALESCE(s.saldo, 0)) > 1e-9
+        """)
 
-            conn.commit()
+    # Prezzo unitario di un movimento al momento della registrazione: quello del fornitore
+    # del movimento, altrimenti il prezzo legacy del materiale o il suo fornitore più economico
+    _PREZZO_MOVIMENTO = """
+        COALESCE(
+            (SELECT NULLIF(prezzo_fornitore, 0) FROM materiale_fornitori
+             WHERE materiale_id = {materiale_id} AND fornitore_nome = {fornitore_nome}),
+            (SELECT NULLIF(prezzo_fornitore, 0) FROM materiali WHERE id = {materiale_id}),
+            (SELECT MIN(prezzo_fornitore) FROM materiale_fornitori
+             WHERE materiale_id = {materiale_id} AND prezzo_fornitore > 0),
+            0)
+    """
+
+    def _migrazione_valorizzazione(self, cursor):
+        """Versione 12: ogni movimento tiene il prezzo unitario con cui è entrato o uscito
+        (scritto da trigger alla registrazione; per i movimenti esistenti il prezzo attuale),
+        e valorizzazione_strati tiene gli strati di costo di ogni materiale all'inizio dei mesi
+        già calcolati (valorizzazione_mesi), per metodo. Un movimento inserito, modificato o
+        eliminato invalida i mesi successivi alla sua data; una giacenza di apertura li
+        invalida tutti."""
+        cursor.execute("PRAGMA table_info(movimenti_magazzino)")
+        if 'prezzo' not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE movimenti_magazzino ADD COLUMN prezzo REAL")
+        cursor.execute(f"""
+            UPDATE movimenti_magazzino
+            SET prezzo = {self._PREZZO_MOVIMENTO.format(materiale_id='movimenti_magazzino.materiale_id',
+                                                       fornitore_nome="COALESCE(movimenti_magazzino.fornitore_nome, '')")}
+            WHERE prezzo IS NULL
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS movimenti_prezzo_ai AFTER INSERT ON movimenti_magazzino
+            WHEN new.prezzo IS NULL BEGIN
+                UPDATE movimenti_magazzino
+                SET prezzo = {self._PREZZO_MOVIMENTO.format(materiale_id='new.materiale_id',
+                                                           fornitore_nome="COALESCE(new.fornitore_nome, '')")}
+                WHERE id = new.id;
+            END
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS valorizzazione_mesi (
+                data TEXT NOT NULL,
+                metodo TEXT NOT NULL,
+                PRIMARY KEY (data, metodo)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS valorizzazione_strati (
+                data TEXT NOT NULL,
+                metodo TEXT NOT NULL,
+                materiale_id INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                quantita REAL NOT NULL,
+                prezzo REAL NOT NULL,
+                PRIMARY KEY (data, metodo, materiale_id, n)
+            )
+        """)
+        invalida = {
+            chiave: f"""
+                DELETE FROM valorizzazione_mesi WHERE data > {chiave}.data;
+                DELETE FROM valorizzazione_strati WHERE data > {chiave}.data;"""
+            for chiave in ('new', 'old')
+        }
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS valorizzazione_movimenti_ai AFTER INSERT ON movimenti_magazzino BEGIN
+                {invalida['new']}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS valorizzazione_movimenti_ad AFTER DELETE ON movimenti_magazzino BEGIN
+                {invalida['old']}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS valorizzazione_movimenti_au AFTER UPDATE OF
+                materiale_id, tipo, quantita, data, prezzo
+            ON movimenti_magazzino BEGIN
+                {invalida['old']}
+                {invalida['new']}
+            END
+        """)
+        # Le giacenze di apertura valgono prima di tutti i movimenti: cambiarle invalida ogni mese
+        # (solo se entra o esce una quantità positiva, l'unica che forma strati). L'UPDATE
+        # guarda i valori perché giacenze_fornitori_au riscrive la riga a ogni movimento.
+        svuota = """
+                DELETE FROM valorizzazione_mesi;
+                DELETE FROM valorizzazione_strati;"""
+        for suffisso, evento, condizione in (
+                ('ai', 'INSERT', 'new.giacenza > 0'),
+                ('ad', 'DELETE', 'old.giacenza > 0'),
+                ('au', 'UPDATE', '(old.giacenza > 0 OR new.giacenza > 0) AND ('
+                                 'new.materiale_id IS NOT old.materiale_id OR '
+                                 'new.fornitore_nome IS NOT old.fornitore_nome OR '
+                                 'new.giacenza IS NOT old.giacenza)')):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS valorizzazione_iniziali_{suffisso} AFTER {evento} ON giacenze_iniziali
+                WHEN {condizione} BEGIN
+                    {svuota}
+                END
+            """)
 
     def _migrate_database(self, cursor):
         """Migrazione automatica per aggiungere i nuovi campi"""
@@ -288,7 +967,7 @@ class DatabaseManager:
     def get_all_materiali(self):
         """Restituisce tutti i materiali disponibili"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, nome, spessore, prezzo, fornitore, prezzo_fornitore, capacita_magazzino, giacenza, scorta_minima, scorta_massima FROM materiali ORDER BY nome")
                 return cursor.fetchall()
@@ -299,7 +978,7 @@ class DatabaseManager:
     def get_materiale_by_id(self, materiale_id):
         """Restituisce un materiale specifico tramite ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, nome, spessore, prezzo, fornitore, prezzo_fornitore, capacita_magazzino, giacenza, scorta_minima, scorta_massima FROM materiali WHERE id = ?", (materiale_id,))
                 return cursor.fetchone()
@@ -310,7 +989,7 @@ class DatabaseManager:
     def get_materiale_by_nome(self, nome):
         """Restituisce un materiale specifico tramite nome"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, nome, spessore, prezzo, fornitore, prezzo_fornitore, capacita_magazzino, giacenza, scorta_minima, scorta_massima FROM materiali WHERE nome = ?", (nome,))
                 return cursor.fetchone()
@@ -318,9 +997,10 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in get_materiale_by_nome: {e}")
             return None
 
+    @_riprova_se_occupato
     def add_materiale(self, nome, spessore, prezzo, fornitore="", prezzo_fornitore=0.0, capacita_magazzino=0.0, giacenza=0.0):
         """Aggiunge un nuovo materiale"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -332,9 +1012,10 @@ class DatabaseManager:
             except sqlite3.IntegrityError:
                 return False
 
+    @_riprova_se_occupato
     def update_materiale_base(self, materiale_id, nome, spessore, prezzo):
         """Aggiorna solo i campi base di un materiale (senza toccare fornitori/giacenza legacy)"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -349,10 +1030,11 @@ class DatabaseManager:
                 logging.getLogger('rcs').error(f"DB error in update_materiale_base: {e}")
                 return False
 
+    @_riprova_se_occupato
     def update_materiale_scorte(self, materiale_id, scorta_minima, scorta_massima):
         """Aggiorna le scorte aggregate (min/max) di un materiale"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "UPDATE materiali SET scorta_minima = ?, scorta_massima = ? WHERE id = ?",
@@ -364,9 +1046,10 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in update_materiale_scorte: {e}")
             return False
 
+    @_riprova_se_occupato
     def update_materiale(self, materiale_id, nome, spessore, prezzo, fornitore="", prezzo_fornitore=0.0, capacita_magazzino=0.0, giacenza=0.0):
         """Aggiorna un materiale esistente"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -381,10 +1064,11 @@ class DatabaseManager:
                 logging.getLogger('rcs').error(f"DB error in update_materiale: {e}")
                 return False
 
+    @_riprova_se_occupato
     def update_prezzo_materiale(self, materiale_id, nuovo_prezzo):
         """Aggiorna solo il prezzo di un materiale"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "UPDATE materiali SET prezzo = ? WHERE id = ?",
@@ -396,13 +1080,15 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in update_prezzo_materiale: {e}")
             return False
 
+    @_riprova_se_occupato
     def delete_materiale(self, materiale_id):
         """Elimina un materiale, i suoi movimenti e le sue voci fornitore"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM movimenti_magazzino WHERE materiale_id = ?", (materiale_id,))
                 cursor.execute("DELETE FROM materiale_fornitori WHERE materiale_id = ?", (materiale_id,))
+                cursor.execute("DELETE FROM giacenze_checkpoint WHERE materiale_id = ?", (materiale_id,))
                 cursor.execute("DELETE FROM materiali WHERE id = ?", (materiale_id,))
                 conn.commit()
                 return cursor.rowcount > 0
@@ -415,7 +1101,7 @@ class DatabaseManager:
     def get_fornitori_per_materiale(self, materiale_id):
         """Restituisce i fornitori di un materiale specifico"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT id, fornitore_nome, prezzo_fornitore, scorta_minima, scorta_massima, giacenza
@@ -431,7 +1117,7 @@ class DatabaseManager:
     def get_fornitori_counts(self):
         """Restituisce dict {materiale_id: n_fornitori} per tutti i materiali"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT materiale_id, COUNT(*) FROM materiale_fornitori GROUP BY materiale_id")
                 return {row[0]: row[1] for row in cursor.fetchall()}
@@ -439,9 +1125,10 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in get_fornitori_counts: {e}")
             return {}
 
+    @_riprova_se_occupato
     def add_fornitore_a_materiale(self, materiale_id, fornitore_nome, prezzo_fornitore=0.0, scorta_minima=0.0, scorta_massima=0.0):
         """Aggiunge un fornitore a un materiale"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute("""
@@ -457,28 +1144,43 @@ class DatabaseManager:
                 logging.getLogger('rcs').error(f"DB error in add_fornitore_a_materiale: {e}")
                 return False
 
+    @_riprova_se_occupato
     def update_fornitore_materiale(self, mf_id, fornitore_nome, prezzo_fornitore=0.0, scorta_minima=0.0, scorta_massima=0.0):
         """Aggiorna un fornitore di un materiale"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
+                vecchio = cursor.execute(
+                    "SELECT materiale_id, fornitore_nome FROM materiale_fornitori WHERE id = ?", (mf_id,)).fetchone()
                 cursor.execute("""
                     UPDATE materiale_fornitori
                     SET fornitore_nome = ?, prezzo_fornitore = ?, scorta_minima = ?, scorta_massima = ?
                     WHERE id = ?
                 """, (fornitore_nome, prezzo_fornitore, scorta_minima, scorta_massima, mf_id))
+                aggiornato = cursor.rowcount > 0
+                if vecchio and vecchio[1] != fornitore_nome:
+                    # Movimenti e checkpoint del materiale seguono il nuovo nome del fornitore
+                    cursor.execute("""
+                        UPDATE movimenti_magazzino SET fornitore_nome = ?
+                        WHERE materiale_id = ? AND fornitore_nome = ?
+                    """, (fornitore_nome, *vecchio))
+                    cursor.execute("""
+                        UPDATE OR REPLACE giacenze_checkpoint SET fornitore_nome = ?
+                        WHERE materiale_id = ? AND fornitore_nome = ?
+                    """, (fornitore_nome, *vecchio))
                 conn.commit()
-                return cursor.rowcount > 0
+                return aggiornato
             except sqlite3.IntegrityError:
                 return False
             except sqlite3.Error as e:
                 logging.getLogger('rcs').error(f"DB error in update_fornitore_materiale: {e}")
                 return False
 
+    @_riprova_se_occupato
     def delete_fornitore_materiale(self, mf_id):
         """Elimina un fornitore da un materiale"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM materiale_fornitori WHERE id = ?", (mf_id,))
                 conn.commit()
@@ -490,7 +1192,7 @@ class DatabaseManager:
     def get_giacenza_totale_materiale(self, materiale_id):
         """Restituisce la giacenza totale di un materiale (somma di tutti i fornitori)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT COALESCE(SUM(giacenza), 0)
@@ -511,7 +1213,7 @@ class DatabaseManager:
     def get_giacenza_scorta_fornitore(self, materiale_id, fornitore_nome):
         """Restituisce (giacenza, scorta_massima) per un materiale/fornitore specifico."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT giacenza, scorta_massima FROM materiale_fornitori
@@ -530,11 +1232,13 @@ class DatabaseManager:
 
     # =================== METODI MAGAZZINO ===================
 
+    @_riprova_se_occupato
     def registra_movimento(self, materiale_id, tipo, quantita, note="", preventivo_id=None, fornitore_nome=""):
         """Registra un movimento di magazzino (carico/scarico) e aggiorna giacenza"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
+                self._checkpoint_mensile(cursor)
                 cursor.execute("""
                     INSERT INTO movimenti_magazzino (materiale_id, tipo, quantita, data, note, preventivo_id, fornitore_nome)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -565,10 +1269,636 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in registra_movimento: {e}")
             return False
 
+    def _valida_movimenti(self, cursor, movimenti, verifica_giacenza=True):
+        """Controlla le righe di un carico/scarico multiplo contro lo stato del database.
+        Ogni movimento è un dict con le chiavi di registra_movimento (materiale_id, tipo,
+        quantita, note, preventivo_id, fornitore_nome). Con verifica_giacenza uno scarico
+        non può superare la giacenza, contando anche le righe precedenti dello stesso lotto.
+        Restituisce (righe, errori): righe come tuple pronte per l'INSERT (senza data),
+        errori come testi "Riga N: ..." con le righe numerate da 1."""
+        righe, errori = [], []
+        for n, mov in enumerate(movimenti, 1):
+            try:
+                materiale_id = int(mov['materiale_id'])
+                tipo = mov['tipo']
+                quantita = float(mov['quantita'])
+            except (KeyError, TypeError, ValueError):
+                errori.append((n, "materiale, tipo e quantità sono obbligatori"))
+                continue
+            if tipo not in ('carico', 'scarico'):
+                errori.append((n, f"tipo '{tipo}' non valido (carico o scarico)"))
+            elif not math.isfinite(quantita) or quantita <= 0:
+                errori.append((n, f"quantità non valida ({quantita})"))
+            else:
+                righe.append((n, (materiale_id, tipo, quantita, mov.get('note') or "",
+                                  mov.get('preventivo_id'), mov.get('fornitore_nome') or "")))
+
+        # Giacenze correnti delle righe toccate: (materiale_id, '') per il campo legacy
+        ids = sorted({riga[0] for _, riga in righe})
+        segnaposto = ", ".join("?" for _ in ids)
+        cursor.execute(f"SELECT id, nome, giacenza FROM materiali WHERE id IN ({segnaposto})", ids)
+        nomi, giacenze = {}, {}
+        for materiale_id, nome, giacenza in cursor.fetchall():
+            nomi[materiale_id] = nome
+            giacenze[(materiale_id, "")] = giacenza
+        cursor.execute(f"""
+            SELECT materiale_id, fornitore_nome, giacenza FROM materiale_fornitori
+            WHERE materiale_id IN ({segnaposto})
+        """, ids)
+        for materiale_id, fornitore_nome, giacenza in cursor.fetchall():
+            giacenze[(materiale_id, fornitore_nome)] = giacenza
+
+        for n, (materiale_id, tipo, quantita, _, _, fornitore_nome) in righe:
+            chiave = (materiale_id, fornitore_nome)
+            if materiale_id not in nomi:
+                errori.append((n, f"materiale {materiale_id} inesistente"))
+            elif chiave not in giacenze:
+                errori.append((n, f"fornitore '{fornitore_nome}' non configurato per {nomi[materiale_id]}"))
+            elif tipo == 'carico':
+                giacenze[chiave] += quantita
+            elif verifica_giacenza and quantita > giacenze[chiave] + 1e-9:
+                errori.append((n, f"scarico di {quantita:.2f} m² di {nomi[materiale_id]}"
+                               + (f" ({fornitore_nome})" if fornitore_nome else "")
+                               + f" oltre la giacenza disponibile ({giacenze[chiave]:.2f} m²)"))
+            else:
+                giacenze[chiave] = max(giacenze[chiave] - quantita, 0)
+        return [riga for _, riga in righe], [f"Riga {n}: {testo}" for n, testo in sorted(errori)]
+
+    def valida_movimenti(self, movimenti, verifica_giacenza=True):
+        """Errori che impedirebbero registra_movimenti_batch (lista vuota se il lotto è valido)"""
+        try:
+            with self._connect() as conn:
+                return self._valida_movimenti(conn.cursor(), list(movimenti), verifica_giacenza)[1]
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in valida_movimenti: {e}")
+            return [f"Errore database: {e}"]
+
+    def _scrivi_movimenti(self, cursor, righe):
+        """Scrive righe già validate da _valida_movimenti (nella transazione del chiamante):
+        movimenti con executemany e giacenze aggiornate nell'ordine delle righe.
+        Restituisce gli id dei movimenti inseriti."""
+        self._checkpoint_mensile(cursor)
+        data = datetime.now().isoformat()
+        cursor.executemany("""
+            INSERT INTO movimenti_magazzino (materiale_id, tipo, quantita, data, note, preventivo_id, fornitore_nome)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(mid, tipo, q, data, note, pid, forn) for mid, tipo, q, note, pid, forn in righe])
+        # Con il lock di scrittura tenuto gli id AUTOINCREMENT del lotto sono consecutivi
+        ultimo_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+        # Giacenze nell'ordine delle righe (lo scarico si ferma a 0 come in registra_movimento)
+        cursor.executemany("""
+            UPDATE materiale_fornitori
+            SET giacenza = CASE WHEN ? = 'carico' THEN giacenza + ? ELSE MAX(giacenza - ?, 0) END
+            WHERE materiale_id = ? AND fornitore_nome = ?
+        """, [(tipo, q, q, mid, forn) for mid, tipo, q, _, _, forn in righe if forn])
+        cursor.executemany("""
+            UPDATE materiali
+            SET giacenza = CASE WHEN ? = 'carico' THEN giacenza + ? ELSE MAX(giacenza - ?, 0) END
+            WHERE id = ?
+        """, [(tipo, q, q, mid) for mid, tipo, q, _, _, forn in righe if not forn])
+
+        return list(range(ultimo_id - len(righe) + 1, ultimo_id + 1))
+
+    @_riprova_se_occupato
+    def registra_movimenti_batch(self, movimenti, verifica_giacenza=True):
+        """Registra più movimenti (es. una consegna di più rotoli) in una sola transazione:
+        o passano tutti o nessuno. Le righe sono validate con _valida_movimenti dentro la
+        transazione, poi scritte con executemany e un solo commit (un solo fsync sulla
+        condivisione di rete invece di uno per riga). L'effetto sulle giacenze è lo stesso
+        di registra_movimento chiamato riga per riga, nello stesso ordine.
+        Restituisce la lista degli id dei movimenti, False se il lotto non è valido o in errore."""
+        movimenti = list(movimenti)
+        if not movimenti:
+            return []
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                righe, errori = self._valida_movimenti(cursor, movimenti, verifica_giacenza)
+                if errori:
+                    conn.rollback()
+                    logging.getLogger('rcs').warning(f"Movimenti non registrati: {'; '.join(errori)}")
+                    return False
+
+                ids = self._scrivi_movimenti(cursor, righe)
+                conn.commit()
+                return ids
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in registra_movimenti_batch: {e}")
+            return False
+
+    # =================== GIACENZE A UNA DATA ===================
+    # giacenze_checkpoint tiene le giacenze di ogni (materiale, fornitore) all'inizio del mese,
+    # cioè prima dei movimenti con data >= checkpoint, copiate dai contatori in quel momento.
+    # La giacenza a una data si ricava in avanti dal checkpoint precedente (o dalla giacenza
+    # di apertura) ripetendo i movimenti in mezzo come fanno i contatori.
+
+    def _scrivi_checkpoint(self, cursor, data):
+        """Checkpoint delle giacenze all'istante data (nella transazione del chiamante):
+        i contatori così come sono, da chiamare prima di qualsiasi movimento con data >= data"""
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO giacenze_checkpoint (data, materiale_id, fornitore_nome, giacenza)
+            SELECT ?, materiale_id, fornitore_nome, giacenza
+            FROM ({self._CONTATORI_GIACENZE.format(where_materiali='', where='')})
+        """, (data,))
+
+    def _checkpoint_mensile(self, cursor):
+        """Scrive il checkpoint del mese corrente se manca: chiamato dai metodi che
+        registrano o modificano movimenti, prima di toccare le giacenze. Se il mese ha
+        già movimenti i contatori non sono più quelli di inizio mese e non si scrive."""
+        mese = datetime.now().strftime("%Y-%m-01T00:00:00")
+        if cursor.execute("""
+                SELECT 1 WHERE NOT EXISTS (SELECT 1 FROM giacenze_checkpoint WHERE data = :mese)
+                           AND NOT EXISTS (SELECT 1 FROM movimenti_magazzino WHERE data >= :mese)
+                """, {'mese': mese}).fetchone() is not None:
+            self._scrivi_checkpoint(cursor, mese)
+
+    def _invalida_checkpoint(self, cursor, materiale_id, fornitore_nome, data):
+        """Un movimento con questa data è cambiato: i checkpoint successivi del suo
+        contatore non valgono più e si torna a ripetere i movimenti da quello prima"""
+        cursor.execute("""
+            DELETE FROM giacenze_checkpoint
+            WHERE materiale_id = ? AND fornitore_nome = ? AND data > ?
+        """, (materiale_id, fornitore_nome or "", data))
+
+    @staticmethod
+    def _limite_data(data):
+        """Istante ISO prima del quale contare i movimenti: una data (date o 'AAAA-MM-GG')
+        vale fino a fine giornata, un datetime o un istante ISO vale così com'è"""
+        if isinstance(data, datetime):
+            return data.isoformat()
+        if isinstance(data, date):
+            return (data + timedelta(days=1)).isoformat() + "T00:00:00"
+        data = str(data)
+        if len(data) == 10:
+            return (date.fromisoformat(data) + timedelta(days=1)).isoformat() + "T00:00:00"
+        return data
+
+    def _giacenze_al(self, cursor, limite):
+        """(materiale_id, fornitore_nome, giacenza) prima dei movimenti con data >= limite:
+        in avanti dal checkpoint più recente non successivo a limite o, per i contatori
+        che non ci sono, dalla giacenza di apertura (giacenze_iniziali), ripetendo i
+        movimenti in mezzo con ogni scarico fermo a 0 come nei contatori"""
+        checkpoint = cursor.execute(
+            "SELECT MAX(data) FROM giacenze_checkpoint WHERE data <= ?", (limite,)).fetchone()[0]
+        saldi = self._SALDI_MOVIMENTI.format(
+            join="JOIN partenze p ON p.materiale_id = m.materiale_id AND p.fornitore_nome = COALESCE(m.fornitore_nome, '')",
+            where="WHERE m.data >= p.dal AND m.data < :limite")
+        cursor.execute(f"""
+            WITH partenze AS (
+                SELECT k.materiale_id, k.fornitore_nome,
+                       COALESCE(c.giacenza, i.giacenza, 0.0) AS giacenza,
+                       CASE WHEN c.giacenza IS NULL THEN '' ELSE :checkpoint END AS dal
+                FROM (
+                    SELECT materiale_id, fornitore_nome
+                    FROM ({self._CONTATORI_GIACENZE.format(where_materiali='', where='')})
+                    UNION
+                    SELECT materiale_id, fornitore_nome FROM giacenze_checkpoint WHERE data = :checkpoint
+                    UNION
+                    SELECT materiale_id, COALESCE(fornitore_nome, '') FROM movimenti_magazzino WHERE data < :limite
+                ) k
+                LEFT JOIN giacenze_checkpoint c
+                    ON c.data = :checkpoint AND c.materiale_id = k.materiale_id AND c.fornitore_nome = k.fornitore_nome
+                LEFT JOIN giacenze_iniziali i
+                    ON i.materiale_id = k.materiale_id AND i.fornitore_nome = k.fornitore_nome
+            ),
+            saldi AS ({saldi})
+            SELECT p.materiale_id, p.fornitore_nome, {self._giacenza_dopo_movimenti('p.giacenza', 's')}
+            FROM partenze p
+            LEFT JOIN saldi s ON s.materiale_id = p.materiale_id AND s.fornitore_nome = p.fornitore_nome
+            ORDER BY p.materiale_id, p.fornitore_nome
+        """, {'checkpoint': checkpoint, 'limite': limite})
+        return cursor.fetchall()
+
+    def get_giacenza_al(self, data, materiale_id=None):
+        """Giacenze a una data (date/'AAAA-MM-GG' = a fine giornata, datetime = a quell'istante)
+        per ogni (materiale, fornitore); fornitore '' = giacenza legacy del materiale.
+        Restituisce: (materiale_id, fornitore_nome, giacenza)"""
+        try:
+            with self._connect() as conn:
+                righe = self._giacenze_al(conn.cursor(), self._limite_data(data))
+                if materiale_id is not None:
+                    righe = [r for r in righe if r[0] == materiale_id]
+                return righe
+        except (sqlite3.Error, ValueError) as e:
+            logging.getLogger('rcs').error(f"DB error in get_giacenza_al: {e}")
+            return []
+
+    def get_giacenze_periodo(self, data_inizio, data_fine):
+        """Giacenza iniziale e finale per materiale in un periodo (stessi estremi di
+        get_movimenti_periodo): iniziale = prima del primo movimento del periodo,
+        finale = iniziale + carichi - scarichi del periodo. Come in get_scorte contano i
+        fornitori del materiale, o la giacenza legacy se non ne ha. Solo materiali con
+        giacenza o movimenti nel periodo, in ordine di nome.
+        Restituisce: (materiale_id, nome, iniziale, carichi, scarichi, finale)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                iniziali = self._giacenze_al(cursor, data_inizio)
+                cursor.execute("""
+                    SELECT materiale_id, COALESCE(fornitore_nome, ''), tipo, SUM(quantita)
+                    FROM movimenti_magazzino
+                    WHERE data >= ? AND data <= ?
+                    GROUP BY materiale_id, fornitore_nome, tipo
+                """, (data_inizio, data_fine))
+                movimenti = cursor.fetchall()
+
+                con_fornitori = {r[0] for r in iniziali if r[1]} | {r[0] for r in movimenti if r[1]}
+                totali = {}  # {materiale_id: [iniziale, carichi, scarichi]}
+                for materiale_id, fornitore_nome, giacenza in iniziali:
+                    if bool(fornitore_nome) == (materiale_id in con_fornitori):
+                        totali.setdefault(materiale_id, [0.0, 0.0, 0.0])[0] += giacenza
+                for materiale_id, fornitore_nome, tipo, quantita in movimenti:
+                    if bool(fornitore_nome) == (materiale_id in con_fornitori):
+                        totali.setdefault(materiale_id, [0.0, 0.0, 0.0])[1 if tipo == 'carico' else 2] += quantita
+
+                nomi = dict(cursor.execute("SELECT id, nome FROM materiali").fetchall())
+                righe = [(materiale_id, nomi[materiale_id], iniziale, carichi, scarichi,
+                          iniziale + carichi - scarichi)
+                         for materiale_id, (iniziale, carichi, scarichi) in totali.items()
+                         if materiale_id in nomi and (iniziale or carichi or scarichi)]
+                return sorted(righe, key=lambda r: (r[1], r[0]))
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_giacenze_periodo: {e}")
+            return []
+
+    # =================== CONTROLLO GIACENZE ===================
+    # I contatori di giacenza vengono aggiornati a differenze (con lo scarico fermo a 0) da
+    # più metodi; il controllo li confronta con quanto dicono i movimenti: attesa = giacenza
+    # di apertura (giacenze_iniziali) ripetendo i movimenti in ordine, ogni scarico fermo a 0.
+
+    def _differenze_giacenze(self, cursor, incrementale=False):
+        """Contatori diversi dalla giacenza attesa dai movimenti, in una sola query
+        raggruppata; con incrementale solo i materiali in giacenze_da_verificare.
+        Restituisce: (materiale_id, nome, fornitore_nome, registrata, attesa)"""
+        where_materiali = where = where_movimenti = ''
+        if incrementale:
+            da_verificare = "(SELECT materiale_id FROM giacenze_da_verificare)"
+            where_materiali, where = f"WHERE id IN {da_verificare}", f"WHERE materiale_id IN {da_verificare}"
+            where_movimenti = f"WHERE m.materiale_id IN {da_verificare}"
+        attesa = self._giacenza_dopo_movimenti('COALESCE(i.giacenza, 0.0)', 's')
+        cursor.execute(f"""
+            WITH contatori AS ({self._CONTATORI_GIACENZE.format(where_materiali=where_materiali, where=where)}),
+                 saldi AS ({self._SALDI_MOVIMENTI.format(join='', where=where_movimenti)})
+            SELECT c.materiale_id, m.nome, c.fornitore_nome, c.giacenza, {attesa} AS attesa
+            FROM contatori c
+            JOIN materiali m ON m.id = c.materiale_id
+            LEFT JOIN giacenze_iniziali i
+                ON i.materiale_id = c.materiale_id AND i.fornitore_nome = c.fornitore_nome
+            LEFT JOIN saldi s
+                ON s.materiale_id = c.materiale_id AND s.fornitore_nome = c.fornitore_nome
+            WHERE ABS(c.giacenza - {attesa}) > 1e-6
+            ORDER BY m.nome, c.materiale_id, c.fornitore_nome
+        """)
+        return cursor.fetchall()
+
+    @_riprova_se_occupato
+    def verifica_giacenze(self, incrementale=False, ripara=False):
+        """Confronta le giacenze registrate (materiali e materiale_fornitori) con quelle
+        ricostruite dai movimenti e, se ripara, riporta i contatori diversi alla giacenza
+        attesa nella stessa transazione. Con incrementale controlla solo i materiali
+        toccati dopo l'ultimo controllo (all'avvio costa una lettura se non è cambiato
+        nulla). I materiali con differenze non riparate restano da verificare.
+        Restituisce le differenze trovate come
+        (materiale_id, nome, fornitore_nome, registrata, attesa), fornitore '' = giacenza
+        legacy (lista vuota se tutto allineato); None in caso di errore."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                if incrementale and cursor.execute(
+                        "SELECT 1 FROM giacenze_da_verificare LIMIT 1").fetchone() is None:
+                    return []
+                cursor.execute("BEGIN IMMEDIATE")
+                differenze = self._differenze_giacenze(cursor, incrementale)
+                if ripara:
+                    cursor.executemany("UPDATE materiali SET giacenza = ? WHERE id = ?",
+                                       [(attesa, mid) for mid, _, forn, _, attesa in differenze if not forn])
+                    cursor.executemany("""
+                        UPDATE materiale_fornitori SET giacenza = ?
+                        WHERE materiale_id = ? AND fornitore_nome = ?
+                    """, [(attesa, mid, forn) for mid, _, forn, _, attesa in differenze if forn])
+                # Dopo il controllo (e le riparazioni, che passano dai trigger) resta da
+                # verificare solo ciò che è ancora diverso
+                cursor.execute("DELETE FROM giacenze_da_verificare")
+                if not ripara:
+                    cursor.executemany("INSERT OR IGNORE INTO giacenze_da_verificare (materiale_id) VALUES (?)",
+                                       [(mid,) for mid in {r[0] for r in differenze}])
+                conn.commit()
+                if differenze:
+                    logging.getLogger('rcs').warning(
+                        f"Giacenze diverse dai movimenti per {len(differenze)} contatori"
+                        + (": riparate" if ripara else ""))
+                return differenze
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in verifica_giacenze: {e}")
+            return None
+
+    # =================== VALORIZZAZIONE DEL MAGAZZINO ===================
+    # Strati di costo per materiale, [quantita, prezzo] dal più vecchio: con 'fifo' ogni
+    # carico è uno strato e gli scarichi consumano i più vecchi; con 'medio' c'è un solo
+    # strato al costo medio ponderato. Lo storico si percorre una volta sola: gli strati
+    # all'inizio di ogni mese attraversato restano in valorizzazione_strati, e il report
+    # successivo riparte dal mese salvato più vicino invece che dal primo movimento.
+
+    METODI_VALORIZZAZIONE = ('medio', 'fifo')
+
+    @staticmethod
+    def _valorizza_movimento(strati, metodo, tipo, quantita, prezzo):
+        """Applica un movimento agli strati di un materiale e restituisce il costo dello
+        scarico (0 per i carichi). La parte di uno scarico oltre gli strati disponibili è
+        valorizzata al prezzo del movimento."""
+        if tipo == 'carico':
+            if metodo == 'medio' and strati:
+                q, p = strati[0]
+                totale = q + quantita
+                strati[0] = [totale, (q * p + quantita * prezzo) / totale if totale > 0 else prezzo]
+            else:
+                strati.append([quantita, prezzo])
+            return 0.0
+        if tipo != 'scarico':
+            return 0.0
+        costo, resto = 0.0, quantita
+        while resto > 1e-9 and strati:
+            q, p = strati[0]
+            preso = min(q, resto)
+            costo += preso * p
+            resto -= preso
+            if q - preso > 1e-9:
+                strati[0] = [q - preso, p]
+            else:
+                strati.pop(0)
+        return costo + resto * prezzo
+
+    @staticmethod
+    def _inizi_mese(dopo, fino):
+        """Inizi mese ISO ('AAAA-MM-01T00:00:00') successivi a dopo e non oltre fino"""
+        anno, mese = int(dopo[:4]), int(dopo[5:7])
+        inizi = []
+        while True:
+            anno, mese = (anno + 1, 1) if mese == 12 else (anno, mese + 1)
+            inizio = f"{anno:04d}-{mese:02d}-01T00:00:00"
+            if inizio > fino:
+                return inizi
+            inizi.append(inizio)
+
+    def _strati_iniziali(self, cursor, metodo, limite):
+        """(data di partenza, strati) dal mese salvato più vicino prima di limite; senza mesi
+        salvati si parte dalle giacenze di apertura (giacenze_iniziali) al prezzo attuale"""
+        partenza = cursor.execute(
+            "SELECT MAX(data) FROM valorizzazione_mesi WHERE metodo = ? AND data <= ?", (metodo, limite)).fetchone()[0]
+        strati = {}
+        if partenza:
+            cursor.execute("""
+                SELECT materiale_id, quantita, prezzo FROM valorizzazione_strati
+                WHERE data = ? AND metodo = ? ORDER BY materiale_id, n
+            """, (partenza, metodo))
+            for materiale_id, quantita, prezzo in cursor.fetchall():
+                strati.setdefault(materiale_id, []).append([quantita, prezzo])
+            return partenza, strati
+        cursor.execute(f"""
+            SELECT i.materiale_id, i.giacenza,
+                   {self._PREZZO_MOVIMENTO.format(materiale_id='i.materiale_id', fornitore_nome='i.fornitore_nome')}
+            FROM giacenze_iniziali i
+            WHERE i.giacenza > 0
+            ORDER BY i.materiale_id, i.fornitore_nome
+        """)
+        for materiale_id, quantita, prezzo in cursor.fetchall():
+            self._valorizza_movimento(strati.setdefault(materiale_id, []), metodo, 'carico', quantita, prezzo)
+        return None, strati
+
+    def _salva_mesi_valorizzazione(self, conn, metodo, fotografie, versione):
+        """Salva gli strati dei mesi appena calcolati, se possibile: è solo una cache, quindi
+        se il database è occupato si rinuncia subito invece di aspettare il lock di scrittura.
+        Si rinuncia anche se un'altra connessione ha scritto dopo la lettura (versione è il
+        PRAGMA data_version di allora): i mesi calcolati potrebbero non valere più."""
+        cursor = conn.cursor()
+        attesa = cursor.execute("PRAGMA busy_timeout").fetchone()[0]
+        try:
+            cursor.execute("PRAGMA busy_timeout = 0")
+            cursor.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if not _e_occupato(e):
+                raise
+            logging.getLogger('rcs').info(f"Valorizzazione: mesi non salvati, database occupato ({e})")
+            return
+        finally:
+            cursor.execute(f"PRAGMA busy_timeout = {int(attesa)}")
+        if cursor.execute("PRAGMA data_version").fetchone()[0] != versione:
+            conn.rollback()
+            return
+        for data, righe in fotografie:
+            if cursor.execute("INSERT OR IGNORE INTO valorizzazione_mesi (data, metodo) VALUES (?, ?)",
+                              (data, metodo)).rowcount:
+                cursor.executemany("""
+                    INSERT INTO valorizzazione_strati (data, metodo, materiale_id, n, quantita, prezzo)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [(data, metodo, *riga) for riga in righe])
+        conn.commit()
+
+    def get_valorizzazione_periodo(self, data_inizio, data_fine, metodo='medio'):
+        """Costo dei consumi nel periodo (stessi estremi di get_movimenti_periodo) e valore
+        del magazzino a fine periodo, per materiale, con il metodo 'medio' (costo medio
+        ponderato) o 'fifo'. I prezzi sono quelli registrati sui movimenti. Solo materiali
+        con consumi o giacenza valorizzata, in ordine di nome.
+        Restituisce: (materiale_id, nome, quantita_consumata, costo_consumi, giacenza_finale, valore_finale)"""
+        if metodo not in self.METODI_VALORIZZAZIONE:
+            logging.getLogger('rcs').error(f"Metodo di valorizzazione sconosciuto: {metodo}")
+            return []
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                fino = min(data_fine, datetime.now().isoformat())
+
+                def mesi_da_salvare(partenza):
+                    # Solo mesi già iniziati: i movimenti nuovi hanno la data di adesso
+                    primo = partenza or cursor.execute("SELECT MIN(data) FROM movimenti_magazzino").fetchone()[0]
+                    return self._inizi_mese(primo, fino) if primo else []
+
+                versione = cursor.execute("PRAGMA data_version").fetchone()[0]
+                partenza, strati = self._strati_iniziali(cursor, metodo, data_inizio)
+                da_salvare = mesi_da_salvare(partenza)
+
+                cursor.execute("""
+                    SELECT materiale_id, tipo, quantita, prezzo, data FROM movimenti_magazzino
+                    WHERE data >= ? AND data <= ?
+                    ORDER BY data, id
+                """, (partenza or "", data_fine))
+                consumi = {}  # {materiale_id: [quantita, costo]}
+                fotografie = []
+                mesi = iter(da_salvare)
+                prossimo = next(mesi, None)
+
+                def fotografa(data):
+                    fotografie.append((data, [(mid, n, q, p) for mid, lista in strati.items()
+                                              for n, (q, p) in enumerate(lista)]))
+
+                for materiale_id, tipo, quantita, prezzo, data in cursor.fetchall():
+                    while prossimo is not None and data >= prossimo:
+                        fotografa(prossimo)
+                        prossimo = next(mesi, None)
+                    costo = self._valorizza_movimento(strati.setdefault(materiale_id, []), metodo,
+                                                      tipo, quantita, prezzo or 0.0)
+                    if tipo == 'scarico' and data >= data_inizio:
+                        voce = consumi.setdefault(materiale_id, [0.0, 0.0])
+                        voce[0] += quantita
+                        voce[1] += costo
+                while prossimo is not None:
+                    fotografa(prossimo)
+                    prossimo = next(mesi, None)
+
+                if fotografie:
+                    self._salva_mesi_valorizzazione(conn, metodo, fotografie, versione)
+
+                nomi = dict(cursor.execute("SELECT id, nome FROM materiali").fetchall())
+                righe = []
+                for materiale_id in set(strati) | set(consumi):
+                    if materiale_id not in nomi:
+                        continue
+                    quantita, costo = consumi.get(materiale_id, (0.0, 0.0))
+                    lista = strati.get(materiale_id, [])
+                    giacenza = sum(q for q, _ in lista)
+                    valore = sum(q * p for q, p in lista)
+                    if quantita or giacenza:
+                        righe.append((materiale_id, nomi[materiale_id], quantita, costo, giacenza, valore))
+                return sorted(righe, key=lambda r: (r[1], r[0]))
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_valorizzazione_periodo: {e}")
+            return []
+
+    # =================== CONSUMI DEI PREVENTIVI ===================
+    # Lo scarico dei consumi di un preventivo sono movimenti 'scarico' con preventivo_id;
+    # lo storno aggiunge i 'carico' opposti con lo stesso preventivo_id. Il preventivo
+    # risulta scaricato se ci sono scarichi dopo l'ultimo storno.
+
+    def _scarichi_preventivo(self, cursor, preventivo_id):
+        """Scarichi del preventivo non ancora stornati: (id, materiale_id, fornitore_nome, quantita)"""
+        cursor.execute("""
+            SELECT id, materiale_id, fornitore_nome, quantita
+            FROM movimenti_magazzino
+            WHERE preventivo_id = :pid AND tipo = 'scarico' AND id > COALESCE((
+                SELECT MAX(id) FROM movimenti_magazzino WHERE preventivo_id = :pid AND tipo = 'carico'
+            ), 0)
+            ORDER BY id
+        """, {'pid': preventivo_id})
+        return cursor.fetchall()
+
+    def _consumi_preventivo(self, cursor, preventivo_id, fornitori=None):
+        """Movimenti di scarico (formato di registra_movimenti_batch) dai materiali del preventivo:
+        lunghezza_utilizzata (m²) sommata per materiale. Il fornitore è quello indicato in
+        fornitori {materiale_id: fornitore_nome}, altrimenti quello con più giacenza; per i
+        materiali senza fornitori si scarica la giacenza legacy. I materiali non più in
+        anagrafica sono esclusi."""
+        cursor.execute("""
+            SELECT pm.materiale_id, m.nome, SUM(pm.lunghezza_utilizzata),
+                   (SELECT mf.fornitore_nome FROM materiale_fornitori mf
+                    WHERE mf.materiale_id = pm.materiale_id
+                    ORDER BY mf.giacenza DESC, mf.fornitore_nome LIMIT 1)
+            FROM preventivo_materiali pm
+            JOIN materiali m ON m.id = pm.materiale_id
+            WHERE pm.preventivo_id = ?
+            GROUP BY pm.materiale_id
+            HAVING SUM(pm.lunghezza_utilizzata) > 0
+            ORDER BY MIN(pm.position)
+        """, (preventivo_id,))
+        fornitori = fornitori or {}
+        return [{
+            'materiale_id': materiale_id,
+            'materiale_nome': nome,
+            'tipo': 'scarico',
+            'quantita': quantita,
+            'note': f"Consumo preventivo #{preventivo_id}",
+            'preventivo_id': preventivo_id,
+            'fornitore_nome': fornitori.get(materiale_id, fornitore) or "",
+        } for materiale_id, nome, quantita, fornitore in cursor.fetchall()]
+
+    def get_consumi_preventivo(self, preventivo_id, fornitori=None):
+        """Anteprima dello scarico: i movimenti che scarica_consumi_preventivo registrerebbe
+        (dict con materiale_nome in più), da controllare con valida_movimenti"""
+        try:
+            with self._connect() as conn:
+                return self._consumi_preventivo(conn.cursor(), preventivo_id, fornitori)
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_consumi_preventivo: {e}")
+            return []
+
+    def get_scarichi_preventivo(self, preventivo_id):
+        """Scarichi registrati per il preventivo e non stornati (lista vuota se non scaricato).
+        Restituisce: (id, materiale_id, fornitore_nome, quantita)"""
+        try:
+            with self._connect() as conn:
+                return self._scarichi_preventivo(conn.cursor(), preventivo_id)
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_scarichi_preventivo: {e}")
+            return []
+
+    @_riprova_se_occupato
+    def scarica_consumi_preventivo(self, preventivo_id, fornitori=None, verifica_giacenza=True):
+        """Scarica dal magazzino i materiali consumati dal preventivo (messa in produzione),
+        un movimento per materiale e fornitore, in una sola transazione.
+        Idempotente: se il preventivo è già scaricato non registra nulla e restituisce gli
+        id degli scarichi esistenti. Restituisce gli id dei movimenti, [] se il preventivo
+        non ha consumi, False se lo scarico non è valido (es. giacenza insufficiente) o in errore."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                esistenti = self._scarichi_preventivo(cursor, preventivo_id)
+                if esistenti:
+                    conn.rollback()
+                    return [r[0] for r in esistenti]
+                righe, errori = self._valida_movimenti(
+                    cursor, self._consumi_preventivo(cursor, preventivo_id, fornitori), verifica_giacenza)
+                if errori:
+                    conn.rollback()
+                    logging.getLogger('rcs').warning(
+                        f"Consumi del preventivo {preventivo_id} non scaricati: {'; '.join(errori)}")
+                    return False
+                ids = self._scrivi_movimenti(cursor, righe) if righe else []
+                conn.commit()
+                return ids
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in scarica_consumi_preventivo: {e}")
+            return False
+
+    @_riprova_se_occupato
+    def storna_consumi_preventivo(self, preventivo_id):
+        """Annulla lo scarico di un preventivo (lavoro annullato) con i carichi opposti, in una
+        sola transazione: i movimenti originali restano nello storico. Dopo lo storno il
+        preventivo si può scaricare di nuovo. Restituisce gli id dei carichi di storno,
+        [] se non c'era nulla da stornare, False in caso di errore."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                storni = [{
+                    'materiale_id': materiale_id,
+                    'tipo': 'carico',
+                    'quantita': quantita,
+                    'note': f"Storno consumo preventivo #{preventivo_id}",
+                    'preventivo_id': preventivo_id,
+                    'fornitore_nome': fornitore_nome,
+                } for _, materiale_id, fornitore_nome, quantita in self._scarichi_preventivo(cursor, preventivo_id)]
+                if not storni:
+                    conn.rollback()
+                    return []
+                righe, errori = self._valida_movimenti(cursor, storni, verifica_giacenza=False)
+                if errori:
+                    conn.rollback()
+                    logging.getLogger('rcs').warning(
+                        f"Scarico del preventivo {preventivo_id} non stornato: {'; '.join(errori)}")
+                    return False
+                ids = self._scrivi_movimenti(cursor, righe)
+                conn.commit()
+                return ids
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in storna_consumi_preventivo: {e}")
+            return False
+
     def get_movimenti_per_materiale(self, materiale_id, limit=100):
         """Restituisce i movimenti di un materiale"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT m.id, m.tipo, m.quantita, m.data, m.note, m.preventivo_id
@@ -585,7 +1915,7 @@ class DatabaseManager:
     def get_movimenti_periodo(self, data_inizio, data_fine):
         """Restituisce tutti i movimenti individuali in un periodo (non aggregati)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT mov.id, m.nome, mov.tipo, mov.quantita, mov.data,
@@ -603,7 +1933,7 @@ class DatabaseManager:
     def get_movimento_by_id(self, movimento_id):
         """Restituisce un singolo movimento per id"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT id, materiale_id, tipo, quantita, data, note, preventivo_id, fornitore_nome
@@ -614,19 +1944,21 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in get_movimento_by_id: {e}")
             return None
 
+    @_riprova_se_occupato
     def modifica_movimento(self, movimento_id, nuova_quantita, note):
         """Modifica un movimento: reversa il vecchio effetto su giacenza e applica il nuovo"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
-                    "SELECT materiale_id, tipo, quantita, fornitore_nome FROM movimenti_magazzino WHERE id = ?",
+                    "SELECT materiale_id, tipo, quantita, fornitore_nome, data FROM movimenti_magazzino WHERE id = ?",
                     (movimento_id,)
                 )
                 row = cursor.fetchone()
                 if not row:
                     return False
-                materiale_id, tipo, vecchia_q, fornitore_nome = row
+                materiale_id, tipo, vecchia_q, fornitore_nome, data = row
+                self._checkpoint_mensile(cursor)
 
                 def _aggiorna_giacenza(cur, mat_id, forn, t, delta):
                     if forn:
@@ -646,6 +1978,7 @@ class DatabaseManager:
                 # Applica nuovo effetto
                 _aggiorna_giacenza(cursor, materiale_id, fornitore_nome, tipo,
                                    nuova_quantita if tipo == 'carico' else -nuova_quantita)
+                self._invalida_checkpoint(cursor, materiale_id, fornitore_nome, data)
 
                 cursor.execute(
                     "UPDATE movimenti_magazzino SET quantita = ?, note = ? WHERE id = ?",
@@ -657,18 +1990,21 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in modifica_movimento: {e}")
             return False
 
+    @_riprova_se_occupato
     def elimina_movimento(self, movimento_id):
         """Elimina un movimento e reversa il suo effetto sulla giacenza"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT materiale_id, tipo, quantita, fornitore_nome FROM movimenti_magazzino WHERE id = ?",
+                "SELECT materiale_id, tipo, quantita, fornitore_nome, data FROM movimenti_magazzino WHERE id = ?",
                 (movimento_id,)
             )
             row = cursor.fetchone()
             if not row:
                 return False
-            materiale_id, tipo, quantita, fornitore_nome = row
+            materiale_id, tipo, quantita, fornitore_nome, data = row
+            self._checkpoint_mensile(cursor)
+            self._invalida_checkpoint(cursor, materiale_id, fornitore_nome, data)
 
             # Reversa effetto sulla giacenza
             if fornitore_nome:
@@ -686,14 +2022,18 @@ class DatabaseManager:
             conn.commit()
             return True
 
+    @_riprova_se_occupato
     def reset_tutte_giacenze(self):
         """Azzera la giacenza di tutti i materiali e fornitori, e cancella tutti i movimenti."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("UPDATE materiali SET giacenza = 0")
                 cursor.execute("UPDATE materiale_fornitori SET giacenza = 0")
                 cursor.execute("DELETE FROM movimenti_magazzino")
+                cursor.execute("DELETE FROM giacenze_checkpoint")
+                cursor.execute("DELETE FROM giacenze_iniziali")
+                cursor.execute("DELETE FROM giacenze_da_verificare")
                 conn.commit()
                 return True
         except sqlite3.Error as e:
@@ -702,7 +2042,7 @@ class DatabaseManager:
 
     def get_consumi_periodo(self, data_inizio, data_fine):
         """Restituisce i consumi aggregati per materiale in un periodo"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT mat.id, mat.nome, mat.prezzo_fornitore,
@@ -717,6 +2057,22 @@ class DatabaseManager:
             """, (data_inizio, data_fine))
             return cursor.fetchall()
 
+    # Giacenza aggregata per materiale: colonne di get_scorte / get_scorta_materiale.
+    # Gli aggregati dei fornitori vengono dal riepilogo scorte_materiali (allineato da trigger);
+    # i materiali senza fornitori non hanno riga e usano i campi legacy di materiali
+    _SELECT_SCORTE = """
+        SELECT m.id, m.nome,
+               COALESCE(s.giacenza, m.giacenza) as giacenza_totale,
+               CASE WHEN m.scorta_massima > 0 THEN m.scorta_massima
+                    ELSE COALESCE(s.scorta_massima, m.capacita_magazzino) END as scorta_massima,
+               COALESCE(s.n_fornitori, 0) as n_fornitori,
+               COALESCE(s.prezzo_min, m.prezzo_fornitore) as prezzo_min,
+               m.scorta_minima as scorta_minima
+        FROM materiali m
+        LEFT JOIN scorte_materiali s ON s.materiale_id = m.id
+        {where}
+    """
+
     def get_scorte(self, ordina_per='giacenza_asc'):
         """Restituisce le scorte di tutti i materiali.
         La giacenza è la somma da materiale_fornitori (se presente) altrimenti dal campo legacy.
@@ -724,7 +2080,7 @@ class DatabaseManager:
         La scorta_massima e scorta_minima aggregate vengono lette da m.scorta_massima / m.scorta_minima
         (impostate in gestione materiali). Se non impostate (= 0) si usa il fallback sui fornitori.
         """
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             if ordina_per == 'giacenza_asc':
                 order = "giacenza_totale ASC"
@@ -735,34 +2091,253 @@ class DatabaseManager:
             elif ordina_per == 'n_fornitori_desc':
                 order = "n_fornitori DESC, m.nome ASC"
             elif ordina_per == 'fornitore_asc':
-                order = "(SELECT MIN(fornitore_nome) FROM materiale_fornitori WHERE materiale_id = m.id) ASC, m.nome ASC"
+                order = "s.primo_fornitore ASC, m.nome ASC"
             else:
                 order = "m.nome ASC"
 
-            cursor.execute(f"""
-                SELECT m.id, m.nome,
-                       COALESCE(SUM(mf.giacenza), m.giacenza) as giacenza_totale,
-                       CASE WHEN m.scorta_massima > 0 THEN m.scorta_massima
-                            ELSE COALESCE(MAX(mf.scorta_massima), m.capacita_magazzino) END as scorta_massima,
-                       COUNT(mf.id) as n_fornitori,
-                       COALESCE(MIN(mf.prezzo_fornitore), m.prezzo_fornitore) as prezzo_min,
-                       m.scorta_minima as scorta_minima
-                FROM materiali m
-                LEFT JOIN materiale_fornitori mf ON mf.materiale_id = m.id
-                GROUP BY m.id, m.nome
-                ORDER BY {order}
-            """)
+            cursor.execute(self._SELECT_SCORTE.format(where="") + f" ORDER BY {order}")
             return cursor.fetchall()
 
+    def get_scorta_materiale(self, materiale_id):
+        """Riga di get_scorte di un solo materiale (aggiornamento di una riga dopo un movimento), o None"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(self._SELECT_SCORTE.format(where="WHERE m.id = ?"), (materiale_id,))
+                return cursor.fetchone()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_scorta_materiale: {e}")
+            return None
+
+    @_riprova_se_occupato
+    def verifica_scorte_materiali(self, ripara=True):
+        """Confronta il riepilogo scorte_materiali con gli aggregati ricalcolati da
+        materiale_fornitori e, se ripara, lo ricostruisce da zero in una transazione.
+        Restituisce gli id dei materiali la cui riga di riepilogo era diversa, mancante
+        o in più (lista vuota se tutto allineato); None in caso di errore."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                aggregati = self._AGGREGATI_SCORTE.format(where='')
+                cursor.execute(f"""
+                    SELECT materiale_id FROM (SELECT * FROM scorte_materiali EXCEPT {aggregati})
+                    UNION
+                    SELECT materiale_id FROM ({aggregati} EXCEPT SELECT * FROM scorte_materiali)
+                """)
+                diversi = sorted(r[0] for r in cursor.fetchall())
+                if diversi and ripara:
+                    self._ricostruisci_scorte_materiali(cursor)
+                conn.commit()
+                if diversi:
+                    logging.getLogger('rcs').warning(
+                        f"Riepilogo scorte non allineato per {len(diversi)} materiali"
+                        + (": ricostruito" if ripara else ""))
+                return diversi
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in verifica_scorte_materiali: {e}")
+            return None
+
+    def get_righe_inventario(self):
+        """Materiali con le rispettive righe fornitore in una sola query, ordinate per
+        materiale e fornitore (report inventario).
+        Restituisce: (id, nome, giacenza_totale, scorta_massima, n_fornitori, prezzo_min, scorta_minima,
+                      fornitore_nome, giacenza_fornitore, scorta_minima_fornitore, scorta_massima_fornitore)
+        Le colonne fornitore sono NULL per i materiali senza fornitori.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
+                    WITH scorte AS ({self._SELECT_SCORTE.format(where="")})
+                    SELECT s.*, mf.fornitore_nome, mf.giacenza, mf.scorta_minima, mf.scorta_massima
+                    FROM scorte s
+                    LEFT JOIN materiale_fornitori mf ON mf.materiale_id = s.id
+                    ORDER BY s.nome, s.id, mf.fornitore_nome
+                """)
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_righe_inventario: {e}")
+            return []
+
+    # =================== PREVISIONI E RIORDINO ===================
+    # Consumo giornaliero = scarichi netti (meno gli storni dei preventivi) diviso i giorni
+    # dal primo movimento del materiale, o della finestra se più recente. Da qui giorni di
+    # copertura, data di esaurimento e quantità da ordinare al fornitore più conveniente.
+
+    def _dati_previsioni(self, cursor, dal):
+        """Scorte, consumo netto dal `dal` (None = tutto lo storico), primo movimento e
+        fornitore più conveniente (prezzo > 0 più basso) per ogni materiale, in una sola
+        query raggruppata su tutti i movimenti"""
+        cursor.execute(f"""
+            WITH consumi AS (
+                SELECT materiale_id, MIN(data) AS primo,
+                       SUM(CASE WHEN :dal IS NOT NULL AND data < :dal THEN 0
+                                WHEN tipo = 'scarico' THEN quantita
+                                WHEN tipo = 'carico' AND preventivo_id IS NOT NULL THEN -quantita
+                                ELSE 0 END) AS consumo
+                FROM movimenti_magazzino
+                GROUP BY materiale_id
+            ),
+            migliori AS (
+                SELECT materiale_id, fornitore_nome, prezzo_fornitore,
+                       ROW_NUMBER() OVER (PARTITION BY materiale_id
+                                          ORDER BY prezzo_fornitore <= 0, prezzo_fornitore, fornitore_nome) AS n
+                FROM materiale_fornitori
+            ),
+            scorte AS ({self._SELECT_SCORTE.format(where="")})
+            SELECT s.id, s.nome, s.giacenza_totale, s.scorta_minima, s.scorta_massima,
+                   COALESCE(c.consumo, 0), c.primo,
+                   COALESCE(f.fornitore_nome, ''), COALESCE(f.prezzo_fornitore, s.prezzo_min)
+            FROM scorte s
+            LEFT JOIN consumi c ON c.materiale_id = s.id
+            LEFT JOIN migliori f ON f.materiale_id = s.id AND f.n = 1
+            ORDER BY s.nome, s.id
+        """, {'dal': dal})
+        return cursor.fetchall()
+
+    @staticmethod
+    def _calcola_previsioni(righe, oggi, giorni_storico=None, giorni_riordino=14):
+        """Previsioni dalle righe di _dati_previsioni. Un materiale è da ordinare se è
+        sotto la scorta minima o se si esaurisce entro giorni_riordino (tempo di consegna).
+        La quantità riporta la giacenza all'arrivo dell'ordine alla scorta massima o, se
+        non impostata, alla scorta minima più il consumo di giorni_riordino."""
+        previsioni = []
+        for materiale_id, nome, giacenza, s_min, s_max, consumo, primo, fornitore, prezzo in righe:
+            consumo_giornaliero = 0.0
+            if primo and consumo > 0:
+                giorni = (oggi - date.fromisoformat(primo[:10])).days + 1
+                if giorni_storico:
+                    giorni = min(giorni, giorni_storico)
+                consumo_giornaliero = consumo / max(giorni, 1)
+            copertura = esaurimento = None
+            if consumo_giornaliero > 0:
+                copertura = giacenza / consumo_giornaliero
+                esaurimento = oggi + timedelta(days=math.floor(copertura))
+
+            da_ordinare = (s_min > 0 and giacenza <= s_min) or (
+                copertura is not None and copertura <= giorni_riordino)
+            quantita = 0.0
+            if da_ordinare:
+                obiettivo = s_max if s_max > 0 else s_min + consumo_giornaliero * giorni_riordino
+                all_arrivo = max(giacenza - consumo_giornaliero * giorni_riordino, 0.0)
+                quantita = round(max(obiettivo - all_arrivo, 0.0), 2)
+            previsioni.append((materiale_id, nome, giacenza, consumo_giornaliero, copertura, esaurimento,
+                               quantita > 0, quantita, fornitore, prezzo))
+        return previsioni
+
+    def get_previsioni_scorte(self, giorni_storico=None, giorni_riordino=14):
+        """Previsioni di consumo e riordino per ogni materiale, in ordine di nome.
+        giorni_storico: consumo misurato sugli ultimi N giorni (None = tutto lo storico).
+        Il risultato resta in cache finché il database non cambia (un movimento, qui o su
+        un altro PC) o non cambia il giorno.
+        Restituisce: (materiale_id, nome, giacenza, consumo_giornaliero, giorni_copertura,
+                      data_esaurimento, da_ordinare, quantita_suggerita, fornitore, prezzo)
+        giorni_copertura e data_esaurimento sono None se il materiale non ha consumi."""
+        try:
+            with self._connect() as conn:
+                oggi = date.today()
+                # total_changes cambia a ogni scrittura di questa connessione, data_version
+                # a ogni scrittura di un'altra (altri thread o PC)
+                versione = (id(conn), conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes, oggi)
+                chiave = (giorni_storico, giorni_riordino)
+                voce = self._cache_previsioni.get(chiave)
+                if voce is not None and voce[0] == versione:
+                    return list(voce[1])
+
+                dal = (oggi - timedelta(days=giorni_storico - 1)).isoformat() if giorni_storico else None
+                previsioni = self._calcola_previsioni(self._dati_previsioni(conn.cursor(), dal),
+                                                      oggi, giorni_storico, giorni_riordino)
+                self._cache_previsioni[chiave] = (versione, tuple(previsioni))
+                return previsioni
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_previsioni_scorte: {e}")
+            return []
+
+    def get_ordini_suggeriti(self, giorni_storico=None, giorni_riordino=14):
+        """Materiali da ordinare raggruppati per fornitore (il più conveniente del
+        materiale; '' = materiale senza fornitori), in ordine di fornitore e nome.
+        Restituisce: (fornitore, materiale_id, nome, quantita, prezzo, costo, data_esaurimento)"""
+        ordini = [(fornitore, materiale_id, nome, quantita, prezzo, quantita * prezzo, esaurimento)
+                  for materiale_id, nome, _, _, _, esaurimento, da_ordinare, quantita, fornitore, prezzo
+                  in self.get_previsioni_scorte(giorni_storico, giorni_riordino) if da_ordinare]
+        return sorted(ordini, key=lambda r: (r[0], r[2], r[1]))
+
     # =================== METODI PREVENTIVI CON VERSIONING ===================
 
+    @staticmethod
+    def _decodifica_materiali(materiali):
+        """Lista di dict dei materiali da lista, JSON o JSON codificato due volte"""
+        for _ in range(2):
+            if not isinstance(materiali, str):
+                break
+            try:
+                materiali = json.loads(materiali)
+            except (json.JSONDecodeError, TypeError):
+                return []
+        if not isinstance(materiali, list):
+            return []
+        return [m for m in materiali if isinstance(m, dict)]
+
+    def _scrivi_materiali_preventivo(self, cursor, preventivo_id, materiali):
+        """Riscrive le righe di preventivo_materiali di un preventivo (nella transazione del chiamante)"""
+        def _num(valore, tipo=float):
+            try:
+                return tipo(float(valore or 0))
+            except (TypeError, ValueError):
+                return tipo(0)
+
+        righe = []
+        for posizione, m in enumerate(self._decodifica_materiali(materiali)):
+            materiale_id = m.get('materiale_id')
+            righe.append((
+                preventivo_id, posizione,
+                materiale_id if isinstance(materiale_id, int) else None,
+                str(m.get('materiale_nome') or m.get('nome') or ''),
+                _num(m.get('giri'), int),
+                _num(m.get('lunghezza')),
+                _num(m.get('sviluppo', m.get('stratifica'))),
+                _num(m.get('lunghezza_utilizzata')),
+                _num(m.get('costo_totale')),
+                1 if m.get('is_conica') else 0,
+                str(m.get('posa') or '=='),
+            ))
+        cursor.execute("DELETE FROM preventivo_materiali WHERE preventivo_id = ?", (preventivo_id,))
+        cursor.executemany("""
+            INSERT INTO preventivo_materiali (
+                preventivo_id, position, materiale_id, materiale_nome, giri, lunghezza,
+                sviluppo, lunghezza_utilizzata, costo_totale, is_conica, posa
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, righe)
+
+    def get_materiali_preventivo(self, preventivo_id):
+        """Materiali di un preventivo dalla tabella normalizzata, nell'ordine di inserimento.
+        Restituisce: (position, materiale_id, materiale_nome, giri, lunghezza, sviluppo,
+                      lunghezza_utilizzata, costo_totale, is_conica, posa)
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT position, materiale_id, materiale_nome, giri, lunghezza, sviluppo,
+                           lunghezza_utilizzata, costo_totale, is_conica, posa
+                    FROM preventivo_materiali
+                    WHERE preventivo_id = ?
+                    ORDER BY position
+                """, (preventivo_id,))
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_materiali_preventivo: {e}")
+            return []
+
     def save_preventivo(self, preventivo_data):
         """Salva un preventivo nel database - COMPATIBILITÀ ORIGINALE con nuovi campi"""
         return self.add_preventivo(preventivo_data)
 
+    @_riprova_se_occupato
     def add_preventivo(self, preventivo_data):
         """Aggiunge un nuovo preventivo originale con i nuovi campi"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO preventivi (
@@ -797,234 +2372,101 @@ class DatabaseManager:
                 json.dumps(preventivo_data['materiali_utilizzati']),
                 "",
             ))
+            preventivo_id = cursor.lastrowid
+            self._scrivi_materiali_preventivo(cursor, preventivo_id, preventivo_data['materiali_utilizzati'])
             conn.commit()
-            return cursor.lastrowid
-
+            self._invalida_cache_clienti()
+            return preventivo_id
+
+    # Campi salvati in ogni snapshot dello storico modifiche
+    CAMPI_SNAPSHOT = (
+        'nome_cliente', 'numero_ordine', 'misura', 'descrizione', 'codice',
+        'costo_totale_materiali', 'costi_accessori', 'minuti_taglio',
+        'minuti_avvolgimento', 'minuti_pulizia', 'minuti_rettifica',
+        'minuti_imballaggio', 'tot_mano_opera', 'subtotale',
+        'maggiorazione_25', 'preventivo_finale', 'prezzo_cliente',
+        'materiali_utilizzati',
+    )
+
+    # Ogni quante versioni lo storico salva uno snapshot completo invece di un delta:
+    # limita le righe da leggere per ricostruire una qualsiasi versione
+    CHECKPOINT_STORICO = 20
+
+    @staticmethod
+    def _ricostruisci_versioni(righe):
+        """Da righe (id, timestamp, completo, dati) ordinate per id, a partire da un
+        checkpoint, restituisce [(id, timestamp, dati_completi)]"""
+        versioni = []
+        stato = {}
+        for id_riga, timestamp, completo, dati in righe:
+            try:
+                valori = json.loads(dati)
+            except (json.JSONDecodeError, TypeError):
+                continue
+            stato = valori if completo else {**stato, **valori}
+            versioni.append((id_riga, timestamp, stato))
+        return versioni
+
+    def _ultime_versioni(self, cursor, preventivo_id, fino_a_id=None):
+        """Righe dall'ultimo checkpoint (fino a fino_a_id incluso), già ricostruite"""
+        cursor.execute("""
+            SELECT id, timestamp, completo, dati FROM preventivi_storico
+            WHERE preventivo_id = :pid AND id <= :fino AND id >= COALESCE((
+                SELECT MAX(id) FROM preventivi_storico
+                WHERE preventivo_id = :pid AND completo = 1 AND id <= :fino
+            ), 0)
+            ORDER BY id
+        """, {'pid': preventivo_id, 'fino': fino_a_id if fino_a_id is not None else sys.maxsize})
+        return self._ricostruisci_versioni(cursor.fetchall())
+
+    def _salva_snapshot(self, cursor, preventivo_id):
+        """Accoda la versione corrente del preventivo a preventivi_storico.
+        Salva solo i campi cambiati rispetto alla versione precedente, con uno snapshot
+        completo ogni CHECKPOINT_STORICO versioni: il costo è limitato e non dipende
+        dalla lunghezza dello storico. Restituisce False se il preventivo non esiste."""
+        cursor.execute(f"SELECT {', '.join(self.CAMPI_SNAPSHOT)} FROM preventivi WHERE id = ?",
+                       (preventivo_id,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        dati = dict(zip(self.CAMPI_SNAPSHOT, row))
+        if dati['materiali_utilizzati'] is None:
+            dati['materiali_utilizzati'] = '[]'
+
+        precedenti = self._ultime_versioni(cursor, preventivo_id)
+        precedente = precedenti[-1][2] if precedenti else None
+        # Checkpoint se non c'è una base, se la catena è lunga o se la versione precedente
+        # ha campi che questa non ha (snapshot migrati da formati vecchi)
+        completo = (precedente is None or len(precedenti) >= self.CHECKPOINT_STORICO
+                    or not set(precedente) <= set(dati))
+        valori = dati if completo else {k: v for k, v in dati.items() if precedente.get(k) != v}
+        cursor.execute(
+            "INSERT INTO preventivi_storico (preventivo_id, timestamp, completo, dati) VALUES (?, ?, ?, ?)",
+            (preventivo_id, datetime.now().isoformat(), 1 if completo else 0, json.dumps(valori))
+        )
+        return True
+
+    @_riprova_se_occupato
     def update_preventivo(self, preventivo_id, preventivo_data):
         """AGGIORNATO: Aggiorna un preventivo esistente salvando snapshot nello storico"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             # 1. Prima di aggiornare, salva lo snapshot corrente nello storico
-            cursor.execute("SELECT * FROM preventivi WHERE id = ?", (preventivo_id,))
-            row = cursor.fetchone()
-
-            if row:
-                # Ottieni i nomi delle colonne
-                cursor.execute("PRAGMA table_info(preventivi)")
-                columns = [col[1] for col in cursor.fetchall()]
-
-                # Crea dizionario con i dati attuali
-                preventivo_attuale = dict(zip(columns, row))
-
-                # Carica storico esistente
-                storico_json = preventivo_attuale.get('storico_modifiche', '[]')
-                try:
-                    storico = json.loads(storico_json) if storico_json else []
-                except (json.JSONDecodeError, TypeError):
-                    storico = []
-
-                # Crea snapshot
-                snapshot = {
-                    'timestamp': datetime.now().isoformat(),
-                    'data': {
-                        'nome_cliente': preventivo_attuale.get('nome_cliente', ''),
-                        'numero_ordine': preventivo_attuale.get('numero_ordine', ''),
-                        'misura': preventivo_attuale.get('misura', ''),
-                        'descrizione': preventivo_attuale.get('descrizione', ''),
-                        'codice': preventivo_attuale.get('codice', ''),
-                        'costo_totale_materiali': preventivo_attuale.get('costo_totale_materiali', 0.0),
-                        'costi_accessori': preventivo_attuale.get('costi_accessori', 0.0),
-                        'minuti_taglio': preventivo_attuale.get('minuti_taglio', 0.0),
-                        'minuti_avvolgimento': preventivo_attuale.get('minuti_avvolgimento', 0.0),
-                        'minuti_pulizia': preventivo_attuale.get('minuti_pulizia', 0.0),
-                        'minuti_rettifica': preventivo_attuale.get('minuti_rettifica', 0.0),
-                        'minuti_imballaggio': preventivo_attuale.get('minuti_imballaggio', 0.0),
-                        'tot_mano_opera': preventivo_attuale.get('tot_mano_opera', 0.0),
-                        'subtotale': preventivo_attuale.get('subtotale', 0.0),
-                        'maggiorazione_25': preventivo_attuale.get('maggiorazione_25', 0.0),
-                        'preventivo_finale': preventivo_attuale.get('preventivo_finale', 0.0),
-                        'prezzo_cliente': preventivo_attuale.get('prezzo_cliente', 0.0),
-                        'materiali_utilizzati': preventivo_attuale.get('materiali_utilizzati', '[]')
-                    }
-                }
-
-                # Aggiungi snapshot allo storico
-                storico.append(snapshot)
-                storico_aggiornato = json.dumps(storico)
-
-                # 2. Ora aggiorna il preventivo con i nuovi dati
-                cursor.execute("""
-                    UPDATE preventivi SET
-                        nome_cliente = ?, numero_ordine = ?, misura = ?, descrizione = ?, codice = ?, finitura = ?,
-                        costo_totale_materiali = ?, costi_accessori = ?, minuti_taglio = ?,
-                        minuti_avvolgimento = ?, minuti_pulizia = ?, minuti_rettifica = ?,
-                        minuti_imballaggio = ?, tot_mano_opera = ?, subtotale = ?,
-                        maggiorazione_25 = ?, preventivo_finale = ?, prezzo_cliente = ?,
-                        materiali_utilizzati = ?, storico_modifiche = ?
-                    WHERE id = ?
-                """, (
-                    preventivo_data.get('nome_cliente', ''),
-                    preventivo_data.get('numero_ordine', ''),
-                    preventivo_data.get('misura', ''),
-                    preventivo_data.get('descrizione', ''),
-                    preventivo_data.get('codice', ''),
-                    preventivo_data.get('finitura', ''),
-                    preventivo_data['costo_totale_materiali'],
-                    preventivo_data['costi_accessori'],
-                    preventivo_data['minuti_taglio'],
-                    preventivo_data['minuti_avvolgimento'],
-                    preventivo_data['minuti_pulizia'],
-                    preventivo_data['minuti_rettifica'],
-                    preventivo_data['minuti_imballaggio'],
-                    preventivo_data['tot_mano_opera'],
-                    preventivo_data['subtotale'],
-                    preventivo_data['maggiorazione_25'],
-                    preventivo_data['preventivo_finale'],
-                    preventivo_data['prezzo_cliente'],
-                    json.dumps(preventivo_data['materiali_utilizzati']),
-                    storico_aggiornato,
-                    preventivo_id
-                ))
-                conn.commit()
-                return cursor.rowcount > 0
-
-            return False
-
-    def get_storico_modifiche(self, preventivo_id):
-        """NUOVO: Ottiene lo storico modifiche di un preventivo"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT storico_modifiche FROM preventivi WHERE id = ?", (preventivo_id,))
-            row = cursor.fetchone()
-
-            if row and row[0]:
-                try:
-                    return json.loads(row[0])
-                except (json.JSONDecodeError, TypeError):
-                    return []
-            return []
-
-    def ripristina_versione_preventivo(self, preventivo_id, timestamp_versione):
-        """NUOVO: Ripristina una versione precedente del preventivo"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
-            # Ottieni storico
-            storico = self.get_storico_modifiche(preventivo_id)
-
-            # Trova la versione da ripristinare
-            versione_da_ripristinare = None
-            for snapshot in storico:
-                if snapshot['timestamp'] == timestamp_versione:
-                    versione_da_ripristinare = snapshot['data']
-                    break
-
-            if not versione_da_ripristinare:
+            if not self._salva_snapshot(cursor, preventivo_id):
                 return False
 
-            # Prima salva la versione corrente nello storico (come in update_preventivo)
-            cursor.execute("SELECT * FROM preventivi WHERE id = ?", (preventivo_id,))
-            row = cursor.fetchone()
-
-            if row:
-                cursor.execute("PRAGMA table_info(preventivi)")
-                columns = [col[1] for col in cursor.fetchall()]
-                preventivo_attuale = dict(zip(columns, row))
-
-                # Aggiungi snapshot corrente
-                snapshot_corrente = {
-                    'timestamp': datetime.now().isoformat(),
-                    'data': {
-                        'nome_cliente': preventivo_attuale.get('nome_cliente', ''),
-                        'numero_ordine': preventivo_attuale.get('numero_ordine', ''),
-                        'misura': preventivo_attuale.get('misura', ''),
-                        'descrizione': preventivo_attuale.get('descrizione', ''),
-                        'codice': preventivo_attuale.get('codice', ''),
-                        'costo_totale_materiali': preventivo_attuale.get('costo_totale_materiali', 0.0),
-                        'costi_accessori': preventivo_attuale.get('costi_accessori', 0.0),
-                        'minuti_taglio': preventivo_attuale.get('minuti_taglio', 0.0),
-                        'minuti_avvolgimento': preventivo_attuale.get('minuti_avvolgimento', 0.0),
-                        'minuti_pulizia': preventivo_attuale.get('minuti_pulizia', 0.0),
-                        'minuti_rettifica': preventivo_attuale.get('minuti_rettifica', 0.0),
-                        'minuti_imballaggio': preventivo_attuale.get('minuti_imballaggio', 0.0),
-                        'tot_mano_opera': preventivo_attuale.get('tot_mano_opera', 0.0),
-                        'subtotale': preventivo_attuale.get('subtotale', 0.0),
-                        'maggiorazione_25': preventivo_attuale.get('maggiorazione_25', 0.0),
-                        'preventivo_finale': preventivo_attuale.get('preventivo_finale', 0.0),
-                        'prezzo_cliente': preventivo_attuale.get('prezzo_cliente', 0.0),
-                        'materiali_utilizzati': preventivo_attuale.get('materiali_utilizzati', '[]')
-                    }
-                }
-
-                storico.append(snapshot_corrente)
-                storico_aggiornato = json.dumps(storico)
-
-                # Ripristina la versione selezionata
-                cursor.execute("""
-                    UPDATE preventivi SET
-                        nome_cliente = ?, numero_ordine = ?, misura = ?, descrizione = ?, codice = ?,
-                        costo_totale_materiali = ?, costi_accessori = ?, minuti_taglio = ?,
-                        minuti_avvolgimento = ?, minuti_pulizia = ?, minuti_rettifica = ?,
-                        minuti_imballaggio = ?, tot_mano_opera = ?, subtotale = ?,
-                        maggiorazione_25 = ?, preventivo_finale = ?, prezzo_cliente = ?,
-                        materiali_utilizzati = ?, storico_modifiche = ?
-                    WHERE id = ?
-                """, (
-                    versione_da_ripristinare['nome_cliente'],
-                    versione_da_ripristinare['numero_ordine'],
-                    versione_da_ripristinare.get('misura', ''),
-                    versione_da_ripristinare['descrizione'],
-                    versione_da_ripristinare['codice'],
-                    versione_da_ripristinare['costo_totale_materiali'],
-                    versione_da_ripristinare['costi_accessori'],
-                    versione_da_ripristinare['minuti_taglio'],
-                    versione_da_ripristinare['minuti_avvolgimento'],
-                    versione_da_ripristinare['minuti_pulizia'],
-                    versione_da_ripristinare['minuti_rettifica'],
-                    versione_da_ripristinare['minuti_imballaggio'],
-                    versione_da_ripristinare['tot_mano_opera'],
-                    versione_da_ripristinare['subtotale'],
-                    versione_da_ripristinare['maggiorazione_25'],
-                    versione_da_ripristinare['preventivo_finale'],
-                    versione_da_ripristinare['prezzo_cliente'],
-                    versione_da_ripristinare['materiali_utilizzati'],
-                    storico_aggiornato,
-                    preventivo_id
-                ))
-                conn.commit()
-                return True
-
-            return False
-
-    def add_revisione_preventivo(self, preventivo_originale_id, preventivo_data, note_revisione=""):
-        """NUOVO: Aggiunge una revisione a un preventivo esistente con i nuovi campi"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
-            # Trova il numero revisione successivo
-            cursor.execute("""
-                SELECT MAX(numero_revisione) FROM preventivi
-                WHERE preventivo_originale_id = ? OR id = ?
-            """, (preventivo_originale_id, preventivo_originale_id))
-
-            max_revisione = cursor.fetchone()[0] or 1
-            nuovo_numero_revisione = max_revisione + 1
-
+            # 2. Ora aggiorna il preventivo con i nuovi dati
             cursor.execute("""
-                INSERT INTO preventivi (
-                    data_creazione, numero_revisione, preventivo_originale_id,
-                    nome_cliente, numero_ordine, misura, descrizione, codice, finitura,
-                    costo_totale_materiali, costi_accessori, minuti_taglio,
-                    minuti_avvolgimento, minuti_pulizia, minuti_rettifica,
-                    minuti_imballaggio, tot_mano_opera, subtotale,
-                    maggiorazione_25, preventivo_finale, prezzo_cliente,
-                    materiali_utilizzati, note_revisione, storico_modifiche
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '[]')
+                UPDATE preventivi SET
+                    nome_cliente = ?, numero_ordine = ?, misura = ?, descrizione = ?, codice = ?, finitura = ?,
+                    costo_totale_materiali = ?, costi_accessori = ?, minuti_taglio = ?,
+                    minuti_avvolgimento = ?, minuti_pulizia = ?, minuti_rettifica = ?,
+                    minuti_imballaggio = ?, tot_mano_opera = ?, subtotale = ?,
+                    maggiorazione_25 = ?, preventivo_finale = ?, prezzo_cliente = ?,
+                    materiali_utilizzati = ?
+                WHERE id = ?
             """, (
-                datetime.now().isoformat(),
-                nuovo_numero_revisione,
-                preventivo_originale_id,
                 preventivo_data.get('nome_cliente', ''),
                 preventivo_data.get('numero_ordine', ''),
                 preventivo_data.get('misura', ''),
@@ -1044,21 +2486,186 @@ class DatabaseManager:
                 preventivo_data['preventivo_finale'],
                 preventivo_data['prezzo_cliente'],
                 json.dumps(preventivo_data['materiali_utilizzati']),
-                note_revisione,
+                preventivo_id
             ))
+            aggiornato = cursor.rowcount > 0
+            self._scrivi_materiali_preventivo(cursor, preventivo_id, preventivo_data['materiali_utilizzati'])
             conn.commit()
-            return cursor.lastrowid
+            self._invalida_cache_clienti()
+            return aggiornato
+
+    def get_storico_modifiche(self, preventivo_id):
+        """NUOVO: Ottiene lo storico modifiche di un preventivo, dal più vecchio al più recente.
+        Formato: [{'timestamp': iso, 'data': {...}}, ...]"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, timestamp, completo, dati FROM preventivi_storico
+                    WHERE preventivo_id = ?
+                    ORDER BY id
+                """, (preventivo_id,))
+                return [{'timestamp': timestamp, 'data': dati}
+                        for _, timestamp, dati in self._ricostruisci_versioni(cursor.fetchall())]
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_storico_modifiche: {e}")
+            return []
+
+    def get_indice_storico(self, preventivo_id):
+        """Solo i timestamp delle versioni nello storico (dal più vecchio), senza decodificare i dati"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT timestamp FROM preventivi_storico
+                    WHERE preventivo_id = ?
+                    ORDER BY id
+                """, (preventivo_id,))
+                return [row[0] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_indice_storico: {e}")
+            return []
+
+    def get_versione_storico(self, preventivo_id, timestamp_versione):
+        """Ricostruisce una singola versione dello storico (dall'ultimo checkpoint
+        precedente), o None se non esiste"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT MIN(id) FROM preventivi_storico
+                    WHERE preventivo_id = ? AND timestamp = ?
+                """, (preventivo_id, timestamp_versione))
+                id_versione = cursor.fetchone()[0]
+                if id_versione is None:
+                    return None
+                versioni = self._ultime_versioni(cursor, preventivo_id, fino_a_id=id_versione)
+                return versioni[-1][2] if versioni and versioni[-1][0] == id_versione else None
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_versione_storico: {e}")
+            return None
+
+    @_riprova_se_occupato
+    def ripristina_versione_preventivo(self, preventivo_id, timestamp_versione):
+        """NUOVO: Ripristina una versione precedente del preventivo"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+
+            # Trova la versione da ripristinare
+            versione_da_ripristinare = self.get_versione_storico(preventivo_id, timestamp_versione)
+            if not versione_da_ripristinare:
+                return False
+
+            # Prima salva la versione corrente nello storico (come in update_preventivo)
+            if not self._salva_snapshot(cursor, preventivo_id):
+                return False
+
+            # Ripristina la versione selezionata
+            cursor.execute("""
+                UPDATE preventivi SET
+                    nome_cliente = ?, numero_ordine = ?, misura = ?, descrizione = ?, codice = ?,
+                    costo_totale_materiali = ?, costi_accessori = ?, minuti_taglio = ?,
+                    minuti_avvolgimento = ?, minuti_pulizia = ?, minuti_rettifica = ?,
+                    minuti_imballaggio = ?, tot_mano_opera = ?, subtotale = ?,
+                    maggiorazione_25 = ?, preventivo_finale = ?, prezzo_cliente = ?,
+                    materiali_utilizzati = ?
+                WHERE id = ?
+            """, (
+                versione_da_ripristinare['nome_cliente'],
+                versione_da_ripristinare['numero_ordine'],
+                versione_da_ripristinare.get('misura', ''),
+                versione_da_ripristinare['descrizione'],
+                versione_da_ripristinare['codice'],
+                versione_da_ripristinare['costo_totale_materiali'],
+                versione_da_ripristinare['costi_accessori'],
+                versione_da_ripristinare['minuti_taglio'],
+                versione_da_ripristinare['minuti_avvolgimento'],
+                versione_da_ripristinare['minuti_pulizia'],
+                versione_da_ripristinare['minuti_rettifica'],
+                versione_da_ripristinare['minuti_imballaggio'],
+                versione_da_ripristinare['tot_mano_opera'],
+                versione_da_ripristinare['subtotale'],
+                versione_da_ripristinare['maggiorazione_25'],
+                versione_da_ripristinare['preventivo_finale'],
+                versione_da_ripristinare['prezzo_cliente'],
+                versione_da_ripristinare['materiali_utilizzati'],
+                preventivo_id
+            ))
+            self._scrivi_materiali_preventivo(cursor, preventivo_id, versione_da_ripristinare['materiali_utilizzati'])
+            conn.commit()
+            self._invalida_cache_clienti()
+            return True
+
+    @_riprova_se_occupato
+    def add_revisione_preventivo(self, preventivo_originale_id, preventivo_data, note_revisione=""):
+        """NUOVO: Aggiunge una revisione a un preventivo esistente con i nuovi campi"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            revisione_id = self._inserisci_revisione(cursor, preventivo_originale_id, preventivo_data, note_revisione)
+            conn.commit()
+            self._invalida_cache_clienti()
+            return revisione_id
+
+    def _inserisci_revisione(self, cursor, preventivo_originale_id, preventivo_data, note_revisione=""):
+        """Inserisce la revisione successiva di un preventivo (nella transazione del chiamante)"""
+        # Trova il numero revisione successivo
+        cursor.execute("""
+            SELECT MAX(numero_revisione) FROM preventivi
+            WHERE preventivo_originale_id = ? OR id = ?
+        """, (preventivo_originale_id, preventivo_originale_id))
+
+        max_revisione = cursor.fetchone()[0] or 1
+        nuovo_numero_revisione = max_revisione + 1
+
+        cursor.execute("""
+            INSERT INTO preventivi (
+                data_creazione, numero_revisione, preventivo_originale_id,
+                nome_cliente, numero_ordine, misura, descrizione, codice, finitura,
+                costo_totale_materiali, costi_accessori, minuti_taglio,
+                minuti_avvolgimento, minuti_pulizia, minuti_rettifica,
+                minuti_imballaggio, tot_mano_opera, subtotale,
+                maggiorazione_25, preventivo_finale, prezzo_cliente,
+                materiali_utilizzati, note_revisione, storico_modifiche
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '[]')
+        """, (
+            datetime.now().isoformat(),
+            nuovo_numero_revisione,
+            preventivo_originale_id,
+            preventivo_data.get('nome_cliente', ''),
+            preventivo_data.get('numero_ordine', ''),
+            preventivo_data.get('misura', ''),
+            preventivo_data.get('descrizione', ''),
+            preventivo_data.get('codice', ''),
+            preventivo_data.get('finitura', ''),
+            preventivo_data['costo_totale_materiali'],
+            preventivo_data['costi_accessori'],
+            preventivo_data['minuti_taglio'],
+            preventivo_data['minuti_avvolgimento'],
+            preventivo_data['minuti_pulizia'],
+            preventivo_data['minuti_rettifica'],
+            preventivo_data['minuti_imballaggio'],
+            preventivo_data['tot_mano_opera'],
+            preventivo_data['subtotale'],
+            preventivo_data['maggiorazione_25'],
+            preventivo_data['preventivo_finale'],
+            preventivo_data['prezzo_cliente'],
+            json.dumps(preventivo_data['materiali_utilizzati']),
+            note_revisione,
+        ))
+        revisione_id = cursor.lastrowid
+        self._scrivi_materiali_preventivo(cursor, revisione_id, preventivo_data['materiali_utilizzati'])
+        return revisione_id
 
     def get_all_preventivi(self):
         """Restituisce tutti i preventivi salvati - AGGIORNATO con nuovi campi"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                    SELECT id, data_creazione, preventivo_finale, prezzo_cliente,
-                           nome_cliente, numero_ordine, descrizione, codice, numero_revisione,
-                           storico_modifiche
-                    FROM preventivi ORDER BY data_creazione DESC
+                    SELECT p.id, p.data_creazione, p.preventivo_finale, p.prezzo_cliente,
+                           p.nome_cliente, p.numero_ordine, p.descrizione, p.codice, p.numero_revisione,
+                           (SELECT COUNT(*) FROM preventivi_storico s WHERE s.preventivo_id = p.id) as n_modifiche
+                    FROM preventivi p ORDER BY p.data_creazione DESC
                 """)
                 return cursor.fetchall()
         except sqlite3.Error as e:
@@ -1067,47 +2674,181 @@ class DatabaseManager:
 
     def get_all_preventivi_latest(self):
         """NUOVO: Restituisce solo l'ultima revisione di ogni preventivo con i nuovi campi"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                WITH latest_preventivi AS (
-                    SELECT
-                        COALESCE(preventivo_originale_id, id) as gruppo_id,
-                        MAX(numero_revisione) as max_revisione
-                    FROM preventivi
-                    GROUP BY COALESCE(preventivo_originale_id, id)
-                )
                 SELECT p.id, p.data_creazione, p.preventivo_finale, p.prezzo_cliente,
                        p.nome_cliente, p.numero_ordine, p.descrizione, p.codice,
                        p.numero_revisione,
                        CASE WHEN p.numero_revisione > 1 THEN 'R' ELSE 'O' END as tipo,
-                       p.storico_modifiche
+                       (SELECT COUNT(*) FROM preventivi_storico s WHERE s.preventivo_id = p.id) as n_modifiche
                 FROM preventivi p
-                INNER JOIN latest_preventivi lp ON
-                    COALESCE(p.preventivo_originale_id, p.id) = lp.gruppo_id
-                    AND p.numero_revisione = lp.max_revisione
+                -- ultima revisione del gruppo: nessuna revisione successiva con lo stesso originale
+                -- (usa idx_preventivi_originale_revisione invece di raggruppare tutta la tabella)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM preventivi r
+                    WHERE r.preventivo_originale_id = COALESCE(p.preventivo_originale_id, p.id)
+                      AND r.numero_revisione > p.numero_revisione
+                )
                 ORDER BY p.data_creazione DESC
             """)
             return cursor.fetchall()
 
+    # Campi testuali indicizzati per la ricerca dei preventivi
+    CAMPI_RICERCA = ('nome_cliente', 'numero_ordine', 'descrizione', 'codice', 'misura', 'finitura')
+    PESI_RICERCA = (4.0, 3.0, 1.0, 3.0, 2.0, 1.0)
+
+    def _ha_indice_ricerca(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'preventivi_fts'")
+        return cursor.fetchone() is not None
+
+    def _condizioni_ricerca(self, cursor, query, filtri):
+        """JOIN, condizioni WHERE e parametri comuni alle ricerche sui preventivi (alias p).
+        Con una query su indice FTS restituisce anche l'ordinamento per pertinenza."""
+        filtri = filtri or {}
+        parole = [p.replace('"', '') for p in (query or "").split()]
+        parole = [p for p in parole if p]
+        join, condizioni, parametri, pertinenza = "", [], [], None
+
+        if parole:
+            per_id = f" OR p.id = {int(parole[0])}" if len(parole) == 1 and parole[0].isdigit() else ""
+            if self._ha_indice_ricerca(cursor):
+                # Ogni parola tra virgolette (niente sintassi FTS dall'utente) con * = prefisso
+                # bm25: cliente, ordine e codice pesano più della descrizione
+                join = f"""{'LEFT JOIN' if per_id else 'JOIN'} (
+                    SELECT rowid, bm25(preventivi_fts, {', '.join(map(str, self.PESI_RICERCA))}) AS punteggio
+                    FROM preventivi_fts WHERE preventivi_fts MATCH ?
+                ) f ON f.rowid = p.id"""
+                parametri.append(" ".join(f'"{p}"*' for p in parole))
+                if per_id:
+                    condizioni.append(f"(f.rowid IS NOT NULL{per_id})")
+                pertinenza = "f.punteggio IS NULL, f.punteggio"
+            else:
+                campi = " || ' ' || ".join(f"COALESCE(p.{c}, '')" for c in self.CAMPI_RICERCA)
+                condizioni.append("((" + " AND ".join(f"({campi}) LIKE ?" for _ in parole) + f"){per_id})")
+                parametri += [f"%{p}%" for p in parole]
+
+        if filtri.get('cliente'):
+            condizioni.append("TRIM(p.nome_cliente) = ?")
+            parametri.append(filtri['cliente'].strip())
+        if filtri.get('tipo') == 'originali':
+            condizioni.append("p.numero_revisione = 1")
+        elif filtri.get('tipo') == 'revisionati':
+            condizioni.append("p.numero_revisione > 1")
+        if filtri.get('solo_ultime'):
+            condizioni.append("""NOT EXISTS (
+                SELECT 1 FROM preventivi r
+                WHERE r.preventivo_originale_id = COALESCE(p.preventivo_originale_id, p.id)
+                  AND r.numero_revisione > p.numero_revisione
+            )""")
+        if filtri.get('solo_con_modifiche'):
+            condizioni.append("EXISTS (SELECT 1 FROM preventivi_storico s WHERE s.preventivo_id = p.id)")
+        return join, condizioni, parametri, pertinenza
+
+    # Colonne restituite da search_preventivi e get_pagina_preventivi
+    _COLONNE_RICERCA = """
+        p.id, p.data_creazione, p.preventivo_finale, p.prezzo_cliente,
+        p.nome_cliente, p.numero_ordine, p.descrizione, p.codice, p.numero_revisione,
+        (SELECT COUNT(*) FROM preventivi_storico s WHERE s.preventivo_id = p.id) as n_modifiche,
+        p.misura, p.finitura
+    """
+
+    def search_preventivi(self, query="", filtri=None, limit=None):
+        """Cerca i preventivi per parole (anche iniziali: "ros" trova "Rossi") nei campi
+        cliente, ordine, descrizione, codice, misura e finitura; un numero cerca anche l'id.
+        Con una query i risultati sono ordinati per pertinenza, altrimenti per data.
+        filtri (tutti opzionali):
+            'cliente':            nome cliente esatto
+            'tipo':               'originali' | 'revisionati'
+            'solo_ultime':        solo l'ultima revisione di ogni preventivo
+            'solo_con_modifiche': solo preventivi con storico modifiche
+        Restituisce: (id, data_creazione, preventivo_finale, prezzo_cliente, nome_cliente,
+                      numero_ordine, descrizione, codice, numero_revisione, n_modifiche,
+                      misura, finitura)
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                join, condizioni, parametri, pertinenza = self._condizioni_ricerca(cursor, query, filtri)
+                ordine = "p.data_creazione DESC, p.id DESC"
+                if pertinenza:
+                    ordine = f"{pertinenza}, {ordine}"
+                where = "WHERE " + " AND ".join(condizioni) if condizioni else ""
+                limite = ""
+                if limit:
+                    limite = "LIMIT ?"
+                    parametri.append(int(limit))
+                cursor.execute(f"""
+                    SELECT {self._COLONNE_RICERCA}
+                    FROM preventivi p
+                    {join}
+                    {where}
+                    ORDER BY {ordine}
+                    {limite}
+                """, parametri)
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in search_preventivi: {e}")
+            return []
+
+    def get_pagina_preventivi(self, query="", filtri=None, limit=200, dopo=None):
+        """Una pagina di preventivi dal più recente, con gli stessi filtri di search_preventivi.
+        Paginazione keyset: dopo = (data_creazione, id) dell'ultima riga della pagina
+        precedente; ogni pagina costa uguale, anche in fondo alla lista.
+        Restituisce le stesse colonne di search_preventivi."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                join, condizioni, parametri, _ = self._condizioni_ricerca(cursor, query, filtri)
+                if dopo is not None:
+                    condizioni.append("(p.data_creazione, p.id) < (?, ?)")
+                    parametri += [dopo[0], dopo[1]]
+                where = "WHERE " + " AND ".join(condizioni) if condizioni else ""
+                cursor.execute(f"""
+                    SELECT {self._COLONNE_RICERCA}
+                    FROM preventivi p
+                    {join}
+                    {where}
+                    ORDER BY p.data_creazione DESC, p.id DESC
+                    LIMIT ?
+                """, parametri + [int(limit)])
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_pagina_preventivi: {e}")
+            return []
+
+    def conta_preventivi(self, query="", filtri=None):
+        """Numero di preventivi che corrispondono a query e filtri (vedi search_preventivi)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                join, condizioni, parametri, _ = self._condizioni_ricerca(cursor, query, filtri)
+                where = "WHERE " + " AND ".join(condizioni) if condizioni else ""
+                cursor.execute(f"SELECT COUNT(*) FROM preventivi p {join} {where}", parametri)
+                return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in conta_preventivi: {e}")
+            return 0
+
     def get_preventivi_con_modifiche(self):
         """NUOVO: Restituisce solo i preventivi che hanno modifiche nello storico"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT id, data_creazione, preventivo_finale, prezzo_cliente,
-                       nome_cliente, numero_ordine, descrizione, codice, numero_revisione,
-                       storico_modifiche
-                FROM preventivi
-                WHERE storico_modifiche != '[]' AND storico_modifiche IS NOT NULL
-                ORDER BY data_creazione DESC
+                SELECT p.id, p.data_creazione, p.preventivo_finale, p.prezzo_cliente,
+                       p.nome_cliente, p.numero_ordine, p.descrizione, p.codice, p.numero_revisione,
+                       COUNT(*) as n_modifiche
+                FROM preventivi p
+                JOIN preventivi_storico s ON s.preventivo_id = p.id
+                GROUP BY p.id
+                ORDER BY p.data_creazione DESC
             """)
             return cursor.fetchall()
 
     def get_preventivo_by_id(self, preventivo_id):
         """Restituisce un preventivo specifico con tutti i dettagli - AGGIORNATO"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM preventivi WHERE id = ?", (preventivo_id,))
                 row = cursor.fetchone()
@@ -1131,12 +2872,9 @@ class DatabaseManager:
                         if campo not in preventivo:
                             preventivo[campo] = ''
 
-                    # Gestisci storico modifiche
-                    storico_json = preventivo.get('storico_modifiche', '[]')
-                    try:
-                        preventivo['storico_modifiche'] = json.loads(storico_json) if storico_json else []
-                    except (json.JSONDecodeError, TypeError):
-                        preventivo['storico_modifiche'] = []
+                    # Lo storico modifiche sta in preventivi_storico (get_storico_modifiche):
+                    # la vecchia colonna è sempre '[]' e non va esposta
+                    preventivo.pop('storico_modifiche', None)
 
                     return preventivo
                 return None
@@ -1147,7 +2885,7 @@ class DatabaseManager:
     def get_revisioni_preventivo(self, preventivo_originale_id):
         """NUOVO: Restituisce tutte le revisioni di un preventivo con i nuovi campi"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT id, data_creazione, preventivo_finale, prezzo_cliente,
@@ -1162,32 +2900,147 @@ class DatabaseManager:
             logging.getLogger('rcs').error(f"DB error in get_revisioni_preventivo: {e}")
             return []
 
+    # =================== RIPREZZATURA PREVENTIVI ===================
+    # Quando cambia il prezzo di un materiale i preventivi salvati restano al vecchio
+    # costo finché qualcuno non li apre e lancia "Aggiorna prezzi". Qui lo stesso
+    # ricalcolo si fa su tutte le ultime revisioni insieme, con il listino letto una volta.
+
+    # Variazione del preventivo finale sotto cui il preventivo si considera invariato (€)
+    TOLLERANZA_RIPREZZATURA = 0.005
+
+    # Campi numerici del preventivo che entrano nei totali
+    CAMPI_TOTALI_PREVENTIVO = (
+        'costi_accessori', 'minuti_taglio', 'minuti_avvolgimento', 'minuti_pulizia',
+        'minuti_rettifica', 'minuti_imballaggio',
+    )
+
+    def _riprezza_righe_preventivi(self, righe, prezzi):
+        """Ricalcola materiali e totali di più preventivi (dict delle righe di preventivi)
+        come PreventivoWindow.aggiorna_prezzi_materiali: gli strati di un materiale
+        presente in prezzi ({nome: prezzo}) prendono il prezzo attuale e rifanno i calcoli
+        di MaterialeCalcolato, gli altri restano come salvati. Tutti gli strati passano
+        insieme dal calcolo a colonne di models.calcolo_colonne.
+        Restituisce (totali {campo: colonna}, lista dei dict dei materiali per preventivo)."""
+        def _num(valore, tipo=float):
+            try:
+                return tipo(float(valore or 0))
+            except (TypeError, ValueError):
+                return tipo(0)
+
+        materiali = [self._decodifica_materiali(dati.get('materiali_utilizzati')) for dati in righe]
+        strati = [m for lista in materiali for m in lista]
+        inizi, posizione = [], 0
+        for lista in materiali:
+            inizi.append(posizione)
+            posizione += len(lista)
+        da_ricalcolare = [i for i, m in enumerate(strati) if m.get('materiale_nome', "") in prezzi]
+        scelti = [strati[i] for i in da_ricalcolare]
+        calcolati = calcola_materiali(
+            diametro=[_num(m.get('diametro')) for m in scelti],
+            lunghezza=[_num(m.get('lunghezza')) for m in scelti],
+            giri=[_num(m.get('giri'), int) for m in scelti],
+            spessore=[_num(m.get('spessore')) for m in scelti],
+            costo_materiale=[prezzi[m.get('materiale_nome', "")] for m in scelti],
+            arrotondamento_manuale=[_num(m.get('arrotondamento_manuale')) for m in scelti],
+            lunghezza_utilizzata=[_num(m.get('lunghezza_utilizzata')) for m in scelti],
+        )
+
+        maggiorazione = [_num(m.get('maggiorazione')) for m in strati]
+        for j, i in enumerate(da_ricalcolare):
+            aggiornati = {campo: calcolati[campo][j] for campo in CAMPI_MATERIALE}
+            strati[i] = dict(strati[i], stratifica=aggiornati['sviluppo'], **aggiornati)
+            maggiorazione[i] = aggiornati['maggiorazione']
+        totali = calcola_preventivi(maggiorazione, inizi, *(
+            [_num(dati.get(campo)) for dati in righe] for campo in self.CAMPI_TOTALI_PREVENTIVO))
+        return totali, [strati[a:a + len(lista)] for a, lista in zip(inizi, materiali)]
+
+    @_riprova_se_occupato
+    def riprezza_preventivi(self, applica=False, note_revisione="Aggiornamento prezzi materiali"):
+        """Ricalcola l'ultima revisione di ogni preventivo con i prezzi attuali dei materiali
+        e ne misura l'impatto. Con applica salva, in un'unica transazione, una nuova
+        revisione (stesso prezzo cliente) per ogni preventivo il cui finale cambia.
+        Restituisce (preventivi, clienti), solo per i preventivi che cambiano:
+          preventivi: (id, originale_id, numero_revisione, nome_cliente, finale_attuale,
+                       finale_nuovo, revisione_id), revisione_id None se non applicata
+          clienti:    (nome_cliente, n_preventivi, totale_attuale, totale_nuovo)
+        None in caso di errore."""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                if applica:
+                    cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT nome, COALESCE(prezzo, 0) FROM materiali")
+                prezzi = dict(cursor.fetchall())
+                cursor.execute("""
+                    SELECT p.* FROM preventivi p
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM preventivi r
+                        WHERE r.preventivo_originale_id = COALESCE(p.preventivo_originale_id, p.id)
+                          AND r.numero_revisione > p.numero_revisione
+                    )
+                    ORDER BY p.id
+                """)
+                colonne = [d[0] for d in cursor.description]
+                righe = [dict(zip(colonne, riga)) for riga in cursor.fetchall()]
+                totali, materiali = self._riprezza_righe_preventivi(righe, prezzi)
+
+                preventivi = []
+                for i, dati in enumerate(righe):
+                    finale_attuale = dati['preventivo_finale'] or 0.0
+                    finale_nuovo = totali['preventivo_finale'][i]
+                    if abs(finale_nuovo - finale_attuale) <= self.TOLLERANZA_RIPREZZATURA:
+                        continue
+                    originale_id = dati['preventivo_originale_id'] or dati['id']
+                    revisione_id = None
+                    if applica:
+                        revisione = dict(dati, materiali_utilizzati=materiali[i],
+                                         **{campo: totali[campo][i] for campo in CAMPI_PREVENTIVO})
+                        revisione_id = self._inserisci_revisione(cursor, originale_id, revisione, note_revisione)
+                    preventivi.append((dati['id'], originale_id, dati['numero_revisione'],
+                                       (dati['nome_cliente'] or '').strip(), finale_attuale,
+                                       finale_nuovo, revisione_id))
+                if applica:
+                    conn.commit()
+                    if preventivi:
+                        self._invalida_cache_clienti()
+                        logging.getLogger('rcs').info(f"Riprezzati {len(preventivi)} preventivi")
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in riprezza_preventivi: {e}")
+            return None
+
+        clienti = {}
+        for _, _, _, cliente, attuale, nuovo, _ in preventivi:
+            n, tot_attuale, tot_nuovo = clienti.get(cliente, (0, 0.0, 0.0))
+            clienti[cliente] = (n + 1, tot_attuale + attuale, tot_nuovo + nuovo)
+        return preventivi, [(cliente,) + clienti[cliente] for cliente in sorted(clienti, key=str.lower)]
+
     # =================== METODI FORNITORI ===================
 
     def get_fornitori_nomi_attivi(self):
         """Restituisce i nomi distinti dei fornitori che hanno almeno un materiale"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT fornitore_nome FROM materiale_fornitori ORDER BY fornitore_nome")
             return [row[0] for row in cursor.fetchall()]
 
     def get_materiali_ids_per_fornitore(self, fornitore_nome):
         """Restituisce gli id dei materiali che hanno un certo fornitore"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT materiale_id FROM materiale_fornitori WHERE fornitore_nome = ?", (fornitore_nome,))
             return {row[0] for row in cursor.fetchall()}
 
     def get_all_fornitori(self):
         """Restituisce tutti i fornitori"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id, nome FROM fornitori ORDER BY nome")
             return cursor.fetchall()
 
+    @_riprova_se_occupato
     def add_fornitore(self, nome):
         """Aggiunge un nuovo fornitore"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute("INSERT INTO fornitori (nome) VALUES (?)", (nome,))
@@ -1199,10 +3052,21 @@ class DatabaseManager:
     def get_scorte_per_fornitore(self, nome_fornitore):
         """Restituisce le scorte dei materiali di un fornitore specifico.
         Considera sia il campo legacy materiali.fornitore sia la tabella materiale_fornitori."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            # UNION dei due sistemi invece di un OR: ogni ramo usa il proprio indice
             cursor.execute("""
-                SELECT DISTINCT m.id, m.nome,
+                SELECT m.id, m.nome,
+                    mf.giacenza as giacenza,
+                    mf.scorta_massima as capacita_magazzino,
+                    ? as fornitore,
+                    mf.prezzo_fornitore as prezzo_fornitore,
+                    mf.scorta_minima as scorta_minima
+                FROM materiale_fornitori mf
+                JOIN materiali m ON m.id = mf.materiale_id
+                WHERE mf.fornitore_nome = ?
+                UNION
+                SELECT m.id, m.nome,
                     COALESCE(mf.giacenza, m.giacenza) as giacenza,
                     COALESCE(mf.scorta_massima, m.capacita_magazzino) as capacita_magazzino,
                     ? as fornitore,
@@ -1211,14 +3075,55 @@ class DatabaseManager:
                 FROM materiali m
                 LEFT JOIN materiale_fornitori mf
                     ON mf.materiale_id = m.id AND mf.fornitore_nome = ?
-                WHERE m.fornitore = ? OR mf.fornitore_nome = ?
-                ORDER BY m.nome
-            """, (nome_fornitore, nome_fornitore, nome_fornitore, nome_fornitore))
+                WHERE m.fornitore = ?
+                ORDER BY 2
+            """, (nome_fornitore, nome_fornitore, nome_fornitore, nome_fornitore, nome_fornitore))
             return cursor.fetchall()
 
+    def get_riepilogo_fornitori(self):
+        """Riepilogo di ogni fornitore in una sola query raggruppata, con gli stessi
+        materiali di get_scorte_per_fornitore (materiale_fornitori + campo legacy materiali.fornitore).
+        Restituisce: (id, nome, n_materiali, giacenza_totale, n_sotto_scorta, valore)
+        n_sotto_scorta: materiali con scorta minima impostata e giacenza inferiore
+        valore: somma di giacenza × prezzo fornitore
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    WITH righe AS (
+                        SELECT mf.fornitore_nome AS fornitore, mf.materiale_id,
+                               mf.giacenza, mf.scorta_minima, mf.prezzo_fornitore
+                        FROM materiale_fornitori mf
+                        UNION
+                        SELECT m.fornitore, m.id,
+                               COALESCE(mf.giacenza, m.giacenza),
+                               COALESCE(mf.scorta_minima, 0),
+                               COALESCE(mf.prezzo_fornitore, m.prezzo_fornitore)
+                        FROM materiali m
+                        LEFT JOIN materiale_fornitori mf
+                            ON mf.materiale_id = m.id AND mf.fornitore_nome = m.fornitore
+                        WHERE m.fornitore IS NOT NULL AND m.fornitore != ''
+                    )
+                    SELECT f.id, f.nome,
+                           COUNT(r.materiale_id) as n_materiali,
+                           COALESCE(SUM(r.giacenza), 0) as giacenza_totale,
+                           COALESCE(SUM(r.scorta_minima > 0 AND r.giacenza < r.scorta_minima), 0) as n_sotto_scorta,
+                           COALESCE(SUM(r.giacenza * r.prezzo_fornitore), 0) as valore
+                    FROM fornitori f
+                    LEFT JOIN righe r ON r.fornitore = f.nome
+                    GROUP BY f.id, f.nome
+                    ORDER BY f.nome
+                """)
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_riepilogo_fornitori: {e}")
+            return []
+
+    @_riprova_se_occupato
     def rename_fornitore(self, old_nome, new_nome):
         """Rinomina un fornitore aggiornando anche tutti i materiali collegati"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute("UPDATE fornitori SET nome = ? WHERE nome = ?", (new_nome, old_nome))
@@ -1226,24 +3131,29 @@ class DatabaseManager:
                     return False
                 cursor.execute("UPDATE materiali SET fornitore = ? WHERE fornitore = ?", (new_nome, old_nome))
                 cursor.execute("UPDATE materiale_fornitori SET fornitore_nome = ? WHERE fornitore_nome = ?", (new_nome, old_nome))
+                # Movimenti e checkpoint seguono il nome, così storni e giacenze a una data lo ritrovano
+                cursor.execute("UPDATE movimenti_magazzino SET fornitore_nome = ? WHERE fornitore_nome = ?", (new_nome, old_nome))
+                cursor.execute("UPDATE OR REPLACE giacenze_checkpoint SET fornitore_nome = ? WHERE fornitore_nome = ?", (new_nome, old_nome))
                 conn.commit()
                 return True
             except sqlite3.IntegrityError:
                 return False
 
+    @_riprova_se_occupato
     def assegna_materiali_a_fornitore(self, nome_fornitore, materiale_ids):
         """Assegna i materiali selezionati al fornitore (aggiorna campo fornitore)"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             for mat_id in materiale_ids:
                 cursor.execute("UPDATE materiali SET fornitore = ? WHERE id = ?", (nome_fornitore, mat_id))
             conn.commit()
 
+    @_riprova_se_occupato
     def delete_preventivo_e_revisioni(self, preventivo_id):
         """Elimina un preventivo e tutte le sue revisioni se è l'originale,
         oppure solo la revisione se viene passato l'ID di una revisione."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
 
                 # Controlla se è un originale o una revisione
@@ -1260,17 +3170,26 @@ class DatabaseManager:
 
                 if preventivo_originale_id is None:
                     # È un originale: elimina originale + tutte le sue revisioni
+                    for tabella in ("preventivi_storico", "preventivo_materiali"):
+                        cursor.execute(f"""
+                            DELETE FROM {tabella} WHERE preventivo_id IN (
+                                SELECT id FROM preventivi WHERE preventivo_originale_id = ? OR id = ?
+                            )
+                        """, (preventivo_id, preventivo_id))
                     cursor.execute("""
                         DELETE FROM preventivi
                         WHERE preventivo_originale_id = ? OR id = ?
                     """, (preventivo_id, preventivo_id))
                 else:
                     # È una revisione: elimina solo questa revisione
+                    cursor.execute("DELETE FROM preventivi_storico WHERE preventivo_id = ?", (preventivo_id,))
+                    cursor.execute("DELETE FROM preventivo_materiali WHERE preventivo_id = ?", (preventivo_id,))
                     cursor.execute("""
                         DELETE FROM preventivi WHERE id = ?
                     """, (preventivo_id,))
 
                 conn.commit()
+                self._invalida_cache_clienti()
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             logging.getLogger('rcs').error(f"DB error in delete_preventivo_e_revisioni: {e}")
@@ -1278,10 +3197,36 @@ class DatabaseManager:
 
     # =================== METODI CLIENTI ===================
 
+    def get_nomi_clienti_distinti(self):
+        """Nomi cliente (senza spazi ai bordi) presenti nei preventivi, ordinati: riempiono
+        i filtri cliente. Letti dall'indice su nome_cliente e tenuti in cache fino alla
+        prossima scrittura di preventivi o clienti."""
+        try:
+            with self._connect() as conn:
+                versione = conn.execute("PRAGMA data_version").fetchone()[0]
+                with _cache_nomi_clienti_lock:
+                    voce = _cache_nomi_clienti.get(self.db_path)
+                if voce is not None and voce[0] is conn and voce[1] == versione:
+                    return list(voce[2])
+
+                cursor = conn.cursor()
+                cursor.execute("SELECT DISTINCT nome_cliente FROM preventivi WHERE nome_cliente IS NOT NULL")
+                nomi = sorted({nome.strip() for (nome,) in cursor.fetchall() if nome.strip()})
+                with _cache_nomi_clienti_lock:
+                    _cache_nomi_clienti[self.db_path] = (conn, versione, tuple(nomi))
+                return nomi
+        except sqlite3.Error as e:
+            logging.getLogger('rcs').error(f"DB error in get_nomi_clienti_distinti: {e}")
+            return []
+
+    def _invalida_cache_clienti(self):
+        with _cache_nomi_clienti_lock:
+            _cache_nomi_clienti.pop(self.db_path, None)
+
     def get_all_clienti(self):
         """Restituisce tutti i clienti con conteggio preventivi, ordinati per nome"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT c.id, c.nome, COUNT(p.id) as n_preventivi
@@ -1297,18 +3242,20 @@ class DatabaseManager:
 
     def get_cliente_by_id(self, cliente_id):
         """Restituisce un cliente specifico tramite ID"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id, nome FROM clienti WHERE id = ?", (cliente_id,))
             return cursor.fetchone()
 
+    @_riprova_se_occupato
     def add_cliente(self, nome, email="", telefono="", note=""):
         """Aggiunge un nuovo cliente"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute("INSERT INTO clienti (nome) VALUES (?)", (nome,))
                 conn.commit()
+                self._invalida_cache_clienti()
                 return cursor.lastrowid
             except sqlite3.IntegrityError:
                 return False
@@ -1316,13 +3263,15 @@ class DatabaseManager:
                 logging.getLogger('rcs').error(f"DB error in add_cliente: {e}")
                 return False
 
+    @_riprova_se_occupato
     def update_cliente(self, cliente_id, nome, email="", telefono="", note=""):
         """Aggiorna un cliente esistente"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute("UPDATE clienti SET nome = ? WHERE id = ?", (nome, cliente_id))
                 conn.commit()
+                self._invalida_cache_clienti()
                 return cursor.rowcount > 0
             except sqlite3.IntegrityError:
                 return False
@@ -1330,13 +3279,15 @@ class DatabaseManager:
                 logging.getLogger('rcs').error(f"DB error in update_cliente: {e}")
                 return False
 
+    @_riprova_se_occupato
     def delete_cliente(self, cliente_id):
         """Elimina un cliente"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM clienti WHERE id = ?", (cliente_id,))
                 conn.commit()
+                self._invalida_cache_clienti()
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             logging.getLogger('rcs').error(f"DB error in delete_cliente: {e}")
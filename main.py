@@ -209,8 +209,8 @@ def _mostra_dialogo_primo_avvio(base_dir):
                 )
                 if risposta != QMessageBox.Yes:
                     return
-            # Salva config.json
-            config = {"db_path": path_scelto}
+            # Salva config.json (profilo "shared": busy timeout lungo e retry per l'accesso da più PC)
+            config = {"db_path": path_scelto, "storage_profile": "shared"}
             config_path = os.path.join(base_dir, "config.json")
             with open(config_path, "w", encoding="utf-8") as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+© 2025 RCS - Software Proprietario
+Calcolo a colonne - MaterialeCalcolato e Preventivo su molti strati insieme
+Uso riservato esclusivamente a RCS
+
+Le stesse formule di MaterialeCalcolato.ricalcola_tutto e Preventivo.ricalcola_tutto,
+applicate a colonne (liste della stessa lunghezza, una posizione per strato) invece
+che a un oggetto alla volta: serve a chi ricalcola migliaia di strati insieme (es.
+DatabaseManager.riprezza_preventivi). Le operazioni sono nello stesso ordine dei
+metodi scalari, quindi i risultati sono identici bit per bit.
+"""
+
+from itertools import repeat
+
+# Colonne restituite da calcola_materiali, con i nomi dei campi di MaterialeCalcolato
+CAMPI_MATERIALE = (
+    'diametro_finale', 'sviluppo', 'lunghezza_utilizzata', 'costo_materiale',
+    'costo_totale', 'maggiorazione',
+)
+
+# Colonne restituite da calcola_preventivi, con i nomi dei campi di Preventivo
+CAMPI_PREVENTIVO = (
+    'costo_totale_materiali', 'tot_mano_opera', 'subtotale', 'maggiorazione_25',
+    'preventivo_finale',
+)
+
+
+def calcola_materiali(diametro, lunghezza, giri, spessore, costo_materiale,
+                      arrotondamento_manuale=None, prezzo=None, lunghezza_utilizzata=None):
+    """Valori derivati di MaterialeCalcolato per ogni strato.
+
+    Le colonne opzionali valgono come i default di un MaterialeCalcolato nuovo (0.0):
+    prezzo è l'alias che, se > 0, sostituisce costo_materiale; lunghezza_utilizzata è
+    il valore già presente, che resta se lo sviluppo non è positivo.
+    Restituisce {campo: colonna} per i campi di CAMPI_MATERIALE.
+    """
+    n = len(diametro)
+    arrotondamento_manuale = repeat(0.0, n) if arrotondamento_manuale is None else arrotondamento_manuale
+    prezzo = repeat(0.0, n) if prezzo is None else prezzo
+    lunghezza_utilizzata = repeat(0.0, n) if lunghezza_utilizzata is None else lunghezza_utilizzata
+
+    # calcola_diametro_finale
+    diametro_finale = [d + (s * (g * 2)) for d, s, g in zip(diametro, spessore, giri)]
+    # calcola_sviluppo
+    sviluppo = [a if a > 0 else ((d + g * s) * 3.14) * g + 5
+                for a, d, g, s in zip(arrotondamento_manuale, diametro, giri, spessore)]
+    # calcola_lunghezza_utilizzata
+    lunghezza_utilizzata = [(l * sv) / 1000000 if sv > 0 else lu
+                            for l, sv, lu in zip(lunghezza, sviluppo, lunghezza_utilizzata)]
+    # calcola_costo_totale
+    costo_materiale = [p if p > 0 else c for p, c in zip(prezzo, costo_materiale)]
+    costo_totale = [lu * c for lu, c in zip(lunghezza_utilizzata, costo_materiale)]
+    # calcola_maggiorazione
+    maggiorazione = [ct * 1.1 for ct in costo_totale]
+
+    return {
+        'diametro_finale': diametro_finale,
+        'sviluppo': sviluppo,
+        'lunghezza_utilizzata': lunghezza_utilizzata,
+        'costo_materiale': costo_materiale,
+        'costo_totale': costo_totale,
+        'maggiorazione': maggiorazione,
+    }
+
+
+def calcola_preventivi(maggiorazione, inizi, costi_accessori, minuti_taglio, minuti_avvolgimento,
+                       minuti_pulizia, minuti_rettifica, minuti_imballaggio):
+    """Totali di Preventivo per ogni preventivo.
+
+    maggiorazione è la colonna degli strati di tutti i preventivi uno dopo l'altro;
+    inizi[i] è la posizione del primo strato del preventivo i (gli strati vanno fino
+    all'inizio del successivo, l'ultimo fino in fondo). Le altre colonne hanno una
+    posizione per preventivo.
+    Restituisce {campo: colonna} per i campi di CAMPI_PREVENTIVO.
+    """
+    fini = list(inizi[1:]) + [len(maggiorazione)]
+    # ricalcola_costo_totale_materiali (sum parte da 0 e somma nell'ordine degli strati)
+    costo_totale_materiali = [sum(maggiorazione[a:b]) for a, b in zip(inizi, fini)]
+    # calcola_tot_mano_opera
+    tot_mano_opera = [t + a + p + r + i for t, a, p, r, i in zip(
+        minuti_taglio, minuti_avvolgimento, minuti_pulizia, minuti_rettifica, minuti_imballaggio)]
+    # calcola_subtotale
+    subtotale = [c + m + t for c, m, t in zip(costi_accessori, tot_mano_opera, costo_totale_materiali)]
+    # calcola_maggiorazione_25
+    maggiorazione_25 = [s * 0.25 for s in subtotale]
+    # calcola_preventivo_finale
+    preventivo_finale = [s + m for s, m in zip(subtotale, maggiorazione_25)]
+
+    return {
+        'costo_totale_materiali': costo_totale_materiali,
+        'tot_mano_opera': tot_mano_opera,
+        'subtotale': subtotale,
+        'maggiorazione_25': maggiorazione_25,
+        'preventivo_finale': preventivo_finale,
+    }
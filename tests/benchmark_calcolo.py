@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark calcolo materiali e preventivi RCS-App
+
+Esegui con:  python tests/benchmark_calcolo.py
+Opzioni:     --strati N       numero di strati calcolati (default 100000)
+             --n N            ripetizioni per misura (default 5)
+
+Confronta i metodi scalari di MaterialeCalcolato / Preventivo (un oggetto alla
+volta) con il calcolo a colonne di models.calcolo_colonne. Non usa il database.
+"""
+
+import sys
+import os
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.materiale import MaterialeCalcolato
+from models.preventivo import Preventivo
+from models.calcolo_colonne import calcola_materiali, calcola_preventivi
+
+BOLD  = "\033[1m"
+CYAN  = "\033[96m"
+DIM   = "\033[2m"
+RESET = "\033[0m"
+
+CAMPI_TOTALI = ('costi_accessori', 'minuti_taglio', 'minuti_avvolgimento', 'minuti_pulizia',
+                'minuti_rettifica', 'minuti_imballaggio')
+
+
+def _misura(fn, n):
+    """Esegue fn n volte e restituisce la latenza media per chiamata in ms."""
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) * 1000.0 / n
+
+
+def _riga(nome, ms_prima, ms_dopo):
+    fattore = ms_prima / ms_dopo if ms_dopo > 0 else float('inf')
+    print(f"  {nome:38s} {ms_prima:9.3f} ms {ms_dopo:9.3f} ms   x{fattore:6.1f}")
+
+
+def bench_materiali(n, n_strati):
+    """ricalcola_tutto su ogni strato (gli oggetti esistono già) vs calcola_materiali"""
+    rng = random.Random(1)
+    colonne = {
+        'diametro': [rng.uniform(20, 400) for _ in range(n_strati)],
+        'lunghezza': [rng.uniform(100, 4000) for _ in range(n_strati)],
+        'giri': [rng.randint(1, 20) for _ in range(n_strati)],
+        'spessore': [rng.choice((0.2, 0.3, 0.5, 1.0)) for _ in range(n_strati)],
+        'costo_materiale': [rng.uniform(5, 60) for _ in range(n_strati)],
+        'arrotondamento_manuale': [0.0 if rng.random() < 0.8 else rng.uniform(100, 2000) for _ in range(n_strati)],
+    }
+    oggetti = []
+    for i in range(n_strati):
+        m = MaterialeCalcolato()
+        for campo, colonna in colonne.items():
+            setattr(m, campo, colonna[i])
+        oggetti.append(m)
+
+    def scalare():
+        for m in oggetti:
+            m.ricalcola_tutto()
+
+    print(f"\n{BOLD}{CYAN}▶ Calcolo di {n_strati} strati{RESET}")
+    print(f"  {DIM}{'operazione':38s} {'scalare':>12s} {'colonne':>12s}   fattore{RESET}")
+    _riga("calcola_materiali()", _misura(scalare, n), _misura(lambda: calcola_materiali(**colonne), n))
+
+
+def bench_preventivi(n, n_strati, strati_per_preventivo=8):
+    """Preventivo.ricalcola_tutto su ogni preventivo vs calcola_preventivi"""
+    rng = random.Random(2)
+    preventivi, maggiorazione, inizi = [], [], []
+    for _ in range(n_strati // strati_per_preventivo):
+        prev = Preventivo()
+        for campo in CAMPI_TOTALI:
+            setattr(prev, campo, rng.uniform(0, 120))
+        inizi.append(len(maggiorazione))
+        for _ in range(strati_per_preventivo):
+            m = MaterialeCalcolato()
+            m.maggiorazione = rng.uniform(1, 300)
+            prev.materiali_calcolati.append(m)
+            maggiorazione.append(m.maggiorazione)
+        preventivi.append(prev)
+    colonne = [[getattr(p, campo) for p in preventivi] for campo in CAMPI_TOTALI]
+
+    def scalare():
+        for prev in preventivi:
+            prev.ricalcola_tutto()
+
+    print(f"\n{BOLD}{CYAN}▶ Totali di {len(preventivi)} preventivi ({strati_per_preventivo} strati){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'scalare':>12s} {'colonne':>12s}   fattore{RESET}")
+    _riga("calcola_preventivi()", _misura(scalare, n),
+          _misura(lambda: calcola_preventivi(maggiorazione, inizi, *colonne), n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calcolo materiali e preventivi RCS-App")
+    parser.add_argument("--strati", type=int, default=100000, help="numero di strati calcolati")
+    parser.add_argument("--n", type=int, default=5, help="ripetizioni per misura")
+    args = parser.parse_args()
+
+    bench_materiali(args.n, args.strati)
+    bench_preventivi(args.n, args.strati)
+
+
+if __name__ == "__main__":
+    main()
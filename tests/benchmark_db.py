@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark prestazioni database RCS-App
+
+Esegui con:  python tests/benchmark_db.py
+Opzioni:     --dir PERCORSO   cartella in cui creare il DB di prova
+                              (es. una cartella condivisa: \\\\NOMEPC\\RCS o Z:\\RCS)
+             --n N            numero di chiamate per misura (default 500)
+
+Il DB di prova viene creato in una sottocartella temporanea ed eliminato alla fine.
+"""
+
+import sys
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.db_manager import DatabaseManager
+from models.materiale import MaterialeCalcolato
+from models.preventivo import Preventivo
+from utils.report_inventario import genera_html_inventario
+
+BOLD  = "\033[1m"
+CYAN  = "\033[96m"
+DIM   = "\033[2m"
+RESET = "\033[0m"
+
+
+def _misura(fn, n):
+    """Esegue fn n volte e restituisce la latenza media per chiamata in ms."""
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) * 1000.0 / n
+
+
+def _riga(nome, ms_prima, ms_dopo):
+    fattore = ms_prima / ms_dopo if ms_dopo > 0 else float('inf')
+    print(f"  {nome:38s} {ms_prima:9.3f} ms {ms_dopo:9.3f} ms   x{fattore:6.1f}")
+
+
+def bench_connessioni(db, n):
+    """Connessione per chiamata (comportamento precedente) vs connessione persistente per thread."""
+    print(f"\n{BOLD}{CYAN}▶ Connessione per chiamata vs persistente{RESET}")
+    print(f"  {DIM}{'operazione':38s} {'per chiamata':>12s} {'persistente':>12s}   fattore{RESET}")
+
+    mat_id = db.get_all_materiali()[0][0]
+
+    def vecchio_get_materiale():
+        with sqlite3.connect(db.db_path) as conn:
+            conn.execute("SELECT id, nome, spessore, prezzo, fornitore, prezzo_fornitore, capacita_magazzino, "
+                         "giacenza, scorta_minima, scorta_massima FROM materiali WHERE id = ?", (mat_id,)).fetchone()
+
+    def vecchio_get_scorte():
+        with sqlite3.connect(db.db_path) as conn:
+            conn.execute("""
+                SELECT m.id, m.nome, COALESCE(SUM(mf.giacenza), m.giacenza), COUNT(mf.id)
+                FROM materiali m LEFT JOIN materiale_fornitori mf ON mf.materiale_id = m.id
+                GROUP BY m.id, m.nome
+            """).fetchall()
+
+    def vecchio_update_prezzo():
+        with sqlite3.connect(db.db_path) as conn:
+            conn.execute("UPDATE materiali SET prezzo = prezzo WHERE id = ?", (mat_id,))
+
+    _riga("get_materiale_by_id",
+          _misura(vecchio_get_materiale, n),
+          _misura(lambda: db.get_materiale_by_id(mat_id), n))
+    _riga("get_scorte",
+          _misura(vecchio_get_scorte, n),
+          _misura(lambda: db.get_scorte(), n))
+    _riga("update_prezzo_materiale (con commit)",
+          _misura(vecchio_update_prezzo, max(1, n // 5)),
+          _misura(lambda: db.update_prezzo_materiale(mat_id, 20.0), max(1, n // 5)))
+
+
+def bench_report_inventario(db, n, n_materiali=2000, n_fornitori=3):
+    """Report inventario: query per materiale e HTML con += (comportamento precedente)
+    vs una query con join e HTML unito con join, su n_materiali × n_fornitori."""
+    print(f"\n{BOLD}{CYAN}▶ Report inventario ({n_materiali} materiali × {n_fornitori} fornitori){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'per materiale':>12s} {'una query':>12s}   fattore{RESET}")
+
+    with db._connect() as conn:
+        conn.executemany("INSERT INTO materiali (nome, spessore, prezzo) VALUES (?, 0.25, 30.0)",
+                         [(f"INV_{i:05d}",) for i in range(n_materiali)])
+        conn.executemany("""
+            INSERT INTO materiale_fornitori (materiale_id, fornitore_nome, prezzo_fornitore,
+                                             scorta_minima, scorta_massima, giacenza)
+            SELECT id, ?, 10.0, 5.0, 200.0, (id % 150) FROM materiali WHERE nome LIKE 'INV_%'
+        """, [(f"FORN_INV_{f}",) for f in range(n_fornitori)])
+
+    td = 'style="border:1px solid #cbd5e0; padding:8px 12px; font-size:14px;"'
+    td_num = 'style="border:1px solid #cbd5e0; padding:8px 12px; font-size:14px; text-align:right;"'
+    td_sub = 'style="border:1px solid #cbd5e0; padding:6px 12px 6px 28px; font-size:13px; color:#4a5568; background:#f7fafc;"'
+    td_sub_num = 'style="border:1px solid #cbd5e0; padding:6px 12px; font-size:13px; color:#4a5568; text-align:right; background:#f7fafc;"'
+
+    def vecchio_report():
+        rows_html = ""
+        for row in db.get_scorte('nome'):
+            mat_id, nome, giacenza_totale, scorta_massima, n_forn = row[:5]
+            scorta_minima = row[6]
+            pct = f"{(giacenza_totale / scorta_massima * 100):.0f}%" if scorta_massima > 0 else "—"
+            rows_html += f"""
+            <tr>
+              <td {td}><b>{nome}</b></td>
+              <td {td_num}><b>{giacenza_totale:.2f}</b></td>
+              <td {td_num}>{scorta_minima:.2f}</td>
+              <td {td_num}>{scorta_massima:.2f}</td>
+              <td {td_num}>{pct}</td>
+              <td {td}>—</td>
+              <td {td_num}>—</td>
+              <td {td_num}>—</td>
+              <td {td_num}>—</td>
+            </tr>"""
+            if n_forn > 0:
+                for _, forn_nome, _, s_min, s_max, giacenza in db.get_fornitori_per_materiale(mat_id):
+                    pct_f = f"{(giacenza / s_max * 100):.0f}%" if s_max > 0 else "—"
+                    rows_html += f"""
+            <tr>
+              <td {td_sub}></td>
+              <td {td_sub_num}></td>
+              <td {td_sub_num}></td>
+              <td {td_sub_num}></td>
+              <td {td_sub_num}></td>
+              <td {td_sub}>↳ {forn_nome}</td>
+              <td {td_sub_num}>{giacenza:.2f}</td>
+              <td {td_sub_num}>{s_min:.2f}</td>
+              <td {td_sub_num}>{pct_f}</td>
+            </tr>"""
+        return rows_html
+
+    ripetizioni = max(1, n // 100)
+    _riga("report inventario HTML",
+          _misura(vecchio_report, ripetizioni),
+          _misura(lambda: genera_html_inventario(db), ripetizioni))
+
+
+def bench_riepilogo_scorte(db, n):
+    """get_scorte con LEFT JOIN + GROUP BY ad ogni lettura (comportamento precedente)
+    vs lettura del riepilogo scorte_materiali tenuto aggiornato dai trigger."""
+    n_materiali = db._connect().execute("SELECT COUNT(*) FROM materiali").fetchone()[0]
+    print(f"\n{BOLD}{CYAN}▶ Riepilogo scorte ({n_materiali} materiali){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'aggregato':>12s} {'riepilogo':>12s}   fattore{RESET}")
+
+    vecchio = """
+        SELECT m.id, m.nome,
+               COALESCE(SUM(mf.giacenza), m.giacenza) as giacenza_totale,
+               CASE WHEN m.scorta_massima > 0 THEN m.scorta_massima
+                    ELSE COALESCE(MAX(mf.scorta_massima), m.capacita_magazzino) END as scorta_massima,
+               COUNT(mf.id) as n_fornitori,
+               COALESCE(MIN(mf.prezzo_fornitore), m.prezzo_fornitore) as prezzo_min,
+               m.scorta_minima as scorta_minima
+        FROM materiali m
+        LEFT JOIN materiale_fornitori mf ON mf.materiale_id = m.id
+        GROUP BY m.id, m.nome
+        ORDER BY {order}
+    """
+    conn = db._connect()
+    ripetizioni = max(1, n // 50)
+    for ordina_per, order in (
+            ('giacenza_asc', "giacenza_totale ASC"),
+            ('fornitore_asc', "(SELECT MIN(fornitore_nome) FROM materiale_fornitori "
+                              "WHERE materiale_id = m.id) ASC, m.nome ASC")):
+        _riga(f"get_scorte('{ordina_per}')",
+              _misura(lambda: conn.execute(vecchio.format(order=order)).fetchall(), ripetizioni),
+              _misura(lambda: db.get_scorte(ordina_per), ripetizioni))
+
+
+def bench_movimenti_batch(db, n, righe=40):
+    """Consegna di `righe` rotoli: registra_movimento riga per riga (un commit ciascuna)
+    vs registra_movimenti_batch (una transazione, un commit)."""
+    print(f"\n{BOLD}{CYAN}▶ Carico di {righe} righe{RESET}")
+    print(f"  {DIM}{'operazione':38s} {'per riga':>12s} {'lotto':>12s}   fattore{RESET}")
+
+    mat_id = db.get_all_materiali()[0][0]
+    db.add_fornitore_a_materiale(mat_id, "FORN_BENCH_BATCH", 10.0, 0.0, 0.0)
+    movimenti = [{'materiale_id': mat_id, 'tipo': 'carico', 'quantita': 1.0,
+                  'fornitore_nome': "FORN_BENCH_BATCH"}] * righe
+
+    def per_riga():
+        for mov in movimenti:
+            db.registra_movimento(mov['materiale_id'], mov['tipo'], mov['quantita'],
+                                  fornitore_nome=mov['fornitore_nome'])
+
+    ripetizioni = max(1, n // 50)
+    _riga(f"{righe} movimenti",
+          _misura(per_riga, ripetizioni),
+          _misura(lambda: db.registra_movimenti_batch(movimenti), ripetizioni))
+
+
+def bench_verifica_giacenze(db, n):
+    """Controllo giacenze all'avvio: verifica completa (tutti i movimenti) vs incrementale
+    dopo un solo movimento, e incrementale senza modifiche (una lettura)."""
+    n_movimenti = db._connect().execute("SELECT COUNT(*) FROM movimenti_magazzino").fetchone()[0]
+    print(f"\n{BOLD}{CYAN}▶ Controllo giacenze ({n_movimenti} movimenti){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'completa':>12s} {'increm.':>12s}   fattore{RESET}")
+
+    mat_id = db.get_all_materiali()[0][0]
+
+    def dopo_un_movimento():
+        db.registra_movimento(mat_id, 'carico', 1.0)
+        db.verifica_giacenze(incrementale=True)
+
+    ripetizioni = max(1, n // 50)
+    _riga("verifica dopo un movimento",
+          _misura(lambda: (db.registra_movimento(mat_id, 'carico', 1.0), db.verifica_giacenze()), ripetizioni),
+          _misura(dopo_un_movimento, ripetizioni))
+    _riga("verifica senza modifiche",
+          _misura(db.verifica_giacenze, ripetizioni),
+          _misura(lambda: db.verifica_giacenze(incrementale=True), ripetizioni))
+
+
+def bench_valorizzazione(db, n, mesi=36, movimenti_per_mese=200):
+    """Report mensile di valorizzazione su `mesi` di storico: percorso completo dei
+    movimenti (strati mensili cancellati) vs ripartenza dagli strati salvati."""
+    conn = db._connect()
+    mat_id = db.get_all_materiali()[0][0]
+    adesso = datetime.now()
+    righe = []
+    for i in range(mesi * movimenti_per_mese):
+        data = adesso - timedelta(days=mesi * 30 * (1 - i / (mesi * movimenti_per_mese)))
+        righe.append((mat_id, 'carico' if i % 2 else 'scarico', 5.0 + i % 7, data.isoformat(), 10.0 + i % 5))
+    conn.executemany("""
+        INSERT INTO movimenti_magazzino (materiale_id, tipo, quantita, data, prezzo) VALUES (?, ?, ?, ?, ?)
+    """, righe)
+    conn.commit()
+
+    n_movimenti = conn.execute("SELECT COUNT(*) FROM movimenti_magazzino").fetchone()[0]
+    print(f"\n{BOLD}{CYAN}▶ Valorizzazione mese scorso ({n_movimenti} movimenti){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'da zero':>12s} {'strati':>12s}   fattore{RESET}")
+
+    fine = adesso.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    inizio = (fine - timedelta(days=1)).replace(day=1).isoformat()
+    fine = (fine - timedelta(microseconds=1)).isoformat()
+
+    def da_zero(metodo):
+        conn.execute("DELETE FROM valorizzazione_mesi")
+        conn.execute("DELETE FROM valorizzazione_strati")
+        conn.commit()
+        db.get_valorizzazione_periodo(inizio, fine, metodo)
+
+    ripetizioni = max(1, n // 100)
+    for metodo in ('medio', 'fifo'):
+        _riga(f"get_valorizzazione_periodo('{metodo}')",
+              _misura(lambda: da_zero(metodo), ripetizioni),
+              _misura(lambda: db.get_valorizzazione_periodo(inizio, fine, metodo), ripetizioni))
+
+
+def bench_riprezzatura(db, n, n_preventivi=1000, strati=8):
+    """Riprezzatura di tutti i preventivi: uno alla volta come "Aggiorna prezzi" della
+    finestra preventivo (una query per strato) vs riprezza_preventivi (listino letto una volta)."""
+    conn = db._connect()
+    nomi = [r[1] for r in db.get_all_materiali()]
+    for i in range(n_preventivi):
+        prev = Preventivo()
+        prev.minuti_taglio = 10.0 + i % 30
+        for j in range(strati):
+            m = MaterialeCalcolato()
+            m.materiale_nome = nomi[(i * strati + j) % len(nomi)]
+            m.diametro, m.lunghezza, m.giri, m.spessore = 50.0 + j * 10, 1000.0 + i % 500, 1 + j % 4, 0.3
+            m.costo_materiale = 1.0
+            m.ricalcola_tutto()
+            prev.materiali_calcolati.append(m)
+        prev.ricalcola_tutto()
+        db.add_preventivo(prev.to_dict())
+
+    print(f"\n{BOLD}{CYAN}▶ Riprezzatura di {n_preventivi} preventivi ({strati} strati){RESET}")
+    print(f"  {DIM}{'operazione':38s} {'per strato':>12s} {'listino':>12s}   fattore{RESET}")
+
+    def uno_alla_volta():
+        for riga in db.get_all_preventivi_latest():
+            dati = db.get_preventivo_by_id(riga[0])
+            prev = Preventivo()
+            prev.minuti_taglio = dati['minuti_taglio']
+            for d in dati['materiali_utilizzati']:
+                m = MaterialeCalcolato()
+                m.materiale_nome = d['materiale_nome']
+                m.diametro, m.lunghezza, m.giri, m.spessore = d['diametro'], d['lunghezza'], d['giri'], d['spessore']
+                materiale_db = db.get_materiale_by_nome(m.materiale_nome)
+                if materiale_db:
+                    m.costo_materiale = materiale_db[3]
+                    m.ricalcola_tutto()
+                prev.materiali_calcolati.append(m)
+            prev.ricalcola_tutto()
+
+    ripetizioni = max(1, n // 250)
+    _riga("riprezza_preventivi()", _misura(uno_alla_volta, ripetizioni),
+          _misura(db.riprezza_preventivi, ripetizioni))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prestazioni database RCS-App")
+    parser.add_argument("--dir", default=None, help="cartella in cui creare il DB di prova (locale o di rete)")
+    parser.add_argument("--n", type=int, default=500, help="chiamate per misura")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="rcs_bench_", dir=args.dir)
+    db = DatabaseManager(db_path=os.path.join(tmp, "bench.db"))
+    print(f"{DIM}  DB: {db.db_path}{RESET}")
+    try:
+        bench_connessioni(db, args.n)
+        bench_report_inventario(db, args.n)
+        bench_riepilogo_scorte(db, args.n)
+        bench_movimenti_batch(db, args.n)
+        bench_verifica_giacenze(db, args.n)
+        bench_valorizzazione(db, args.n)
+        bench_riprezzatura(db, args.n)
+    finally:
+        db.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
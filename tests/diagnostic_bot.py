@@ -1115,11 +1115,11 @@ def test_09_preventivi_storico(db, pids, verbose=False):
     elif not con_mod:
         R.warn("get_preventivi_con_modifiche: lista vuota (atteso almeno qualcuno)")
     else:
-        # colonna 9 è storico_modifiche (come get_all_preventivi)
+        # colonna 9 è il numero di versioni nello storico (come get_all_preventivi)
         errori_cm = 0
         for row in con_mod[:10]:
             stor_raw = row[9] if len(row) > 9 else None
-            if stor_raw in (None, "[]", ""):
+            if not stor_raw:
                 errori_cm += 1
         if errori_cm:
             R.fail(f"get_preventivi_con_modifiche: {errori_cm}/10 hanno storico_modifiche vuoto")
@@ -1940,6 +1940,48 @@ def test_17_integrita_cross(db, mat_ids, pids, verbose=False):
             else:
                 R.ok("delete_fornitore_materiale: fornitore non più in get_fornitori_per_materiale", verbose)
 
+    # Riepilogo scorte (trigger su materiale_fornitori) allineato dopo tutte le scritture
+    diversi, exc = safe(db.verifica_scorte_materiali, ripara=False)
+    if exc or diversi is None:
+        R.fail("verifica_scorte_materiali crash", exc)
+    elif diversi:
+        R.fail(f"Riepilogo scorte non allineato per {len(diversi)} materiali")
+    else:
+        R.ok("Riepilogo scorte allineato a materiale_fornitori", verbose)
+
+    # Controllo giacenze: l'unica scrittura diretta dei contatori è update_materiale con
+    # giacenza (materiali *_FULL); ogni altra differenza è un errore dei movimenti o del controllo
+    differenze, exc = safe(db.verifica_giacenze)
+    if exc or differenze is None:
+        R.fail("verifica_giacenze crash", exc)
+    else:
+        inattese = [d for d in differenze if not d[1].endswith("_FULL")]
+        if inattese:
+            R.fail(f"verifica_giacenze: {len(inattese)} differenze non dovute a update_materiale: {inattese[:5]}")
+        else:
+            R.ok(f"verifica_giacenze: {len(differenze)} differenze, tutte da update_materiale", verbose)
+        riparate, exc = safe(db.verifica_giacenze, ripara=True)
+        rimaste, exc2 = safe(db.verifica_giacenze)
+        if exc or exc2 or riparate is None or rimaste:
+            R.fail(f"verifica_giacenze: differenze rimaste dopo la riparazione: {rimaste}", exc or exc2)
+        else:
+            R.ok(f"verifica_giacenze: {len(riparate)} contatori riportati ai movimenti", verbose)
+
+    # Scarico oltre la giacenza (fermato a 0) seguito da un carico: nessuna differenza
+    mid_oltre, exc = safe(db.add_materiale, "DIAG_SCARICO_OLTRE", 0.3, 10.0)
+    if exc or not mid_oltre:
+        R.warn("Materiale per lo scarico oltre giacenza non creato — skip")
+    else:
+        for tipo, quantita in (('carico', 10.0), ('scarico', 15.0), ('carico', 5.0)):
+            safe(db.registra_movimento, mid_oltre, tipo, quantita)
+        differenze, exc = safe(db.verifica_giacenze, incrementale=True)
+        giacenza = (safe(db.get_giacenza_scorta_fornitore, mid_oltre, "")[0] or (None,))[0]
+        if exc or differenze or giacenza != 5.0:
+            R.fail(f"verifica_giacenze dopo scarico oltre giacenza: giacenza {giacenza}, differenze {differenze}", exc)
+        else:
+            R.ok("verifica_giacenze: scarico oltre giacenza e carico successivo allineati", verbose)
+        safe(db.delete_materiale, mid_oltre)
+
     # Categoria eliminata → rimossa dal sistema (test saltato)
     R.skip("Integrità categoria — rimossa dal sistema (test saltato)", verbose=True)
 
@@ -2115,7 +2157,7 @@ def test_19_metodi_non_coperti(db, mat_ids, pids, verbose=False):
         errori_cm = 0
         for row in (con_mod or [])[:20]:
             stor_raw = row[9] if len(row) > 9 else None
-            if stor_raw in (None, "[]", ""):
+            if not stor_raw:
                 errori_cm += 1
         if errori_cm:
             R.fail(f"get_preventivi_con_modifiche: {errori_cm} con storico vuoto")
@@ -10,9 +10,11 @@ Esegui con:  python -m pytest tests/ -v
 import sys
 import os
 import json
+import sqlite3
 import tempfile
 import unittest
 import math
+import random
 from datetime import datetime, timedelta
 
 # Aggiungi la root del progetto al path
@@ -21,6 +23,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database.db_manager import DatabaseManager
 from models.materiale import Materiale, MaterialeCalcolato
 from models.preventivo import Preventivo
+from models.calcolo_colonne import calcola_materiali, calcola_preventivi, CAMPI_MATERIALE, CAMPI_PREVENTIVO
+from utils.report_inventario import genera_html_inventario, salva_inventario
 
 
 # ---------------------------------------------------------------------------
@@ -317,6 +321,39 @@ class TestFornitori(unittest.TestCase):
         scorte = self.db.get_scorte_per_fornitore("FANTASMA")
         self.assertEqual(len(scorte), 0)
 
+    def test_riepilogo_fornitori_valori(self):
+        self.db.add_fornitore("FORN_RIEP")
+        m1 = self.db.add_materiale("MAT_RIEP_1", 0.1, 1.0)
+        m2 = self.db.add_materiale("MAT_RIEP_2", 0.1, 1.0)
+        self.db.add_fornitore_a_materiale(m1, "FORN_RIEP", 10.0, 50.0, 200.0)
+        self.db.add_fornitore_a_materiale(m2, "FORN_RIEP", 4.0, 5.0, 100.0)
+        self.db.registra_movimento(m1, "carico", 20.0, fornitore_nome="FORN_RIEP")   # sotto minimo
+        self.db.registra_movimento(m2, "carico", 30.0, fornitore_nome="FORN_RIEP")
+        riepilogo = {r[1]: r for r in self.db.get_riepilogo_fornitori()}
+        _, _, n_mat, giacenza, n_sotto, valore = riepilogo["FORN_RIEP"]
+        self.assertEqual(n_mat, 2)
+        self.assertAlmostEqual(giacenza, 50.0)
+        self.assertEqual(n_sotto, 1)
+        self.assertAlmostEqual(valore, 20.0 * 10.0 + 30.0 * 4.0)
+
+    def test_riepilogo_fornitori_stessi_materiali_di_get_scorte_per_fornitore(self):
+        """Legacy, tabella nuova ed entrambi insieme: il conteggio coincide con la query per fornitore"""
+        self.db.add_fornitore("FORN_MISTO")
+        self.db.add_materiale("MAT_LEG", 0.1, 1.0, fornitore="FORN_MISTO", prezzo_fornitore=3.0, giacenza=7.0)
+        mid = self.db.add_materiale("MAT_DUE", 0.1, 1.0, fornitore="FORN_MISTO")
+        self.db.add_fornitore_a_materiale(mid, "FORN_MISTO", 5.0)
+        mid2 = self.db.add_materiale("MAT_NUOVO", 0.1, 1.0)
+        self.db.add_fornitore_a_materiale(mid2, "FORN_MISTO", 5.0)
+        for _, nome, n_mat, giacenza, _, _ in self.db.get_riepilogo_fornitori():
+            scorte = self.db.get_scorte_per_fornitore(nome)
+            self.assertEqual(n_mat, len(scorte), msg=nome)
+            self.assertAlmostEqual(giacenza, sum(r[2] for r in scorte), msg=nome)
+
+    def test_riepilogo_fornitore_senza_materiali(self):
+        self.db.add_fornitore("FORN_VUOTO_RIEP")
+        riepilogo = {r[1]: r for r in self.db.get_riepilogo_fornitori()}
+        self.assertEqual(riepilogo["FORN_VUOTO_RIEP"][2:], (0, 0, 0, 0))
+
 
 # ===========================================================================
 # 3. MATERIALE_FORNITORI (multi-fornitore per materiale)
@@ -470,6 +507,14 @@ class TestMagazzino(unittest.TestCase):
         giacenze = [r[2] for r in scorte]
         self.assertEqual(giacenze, sorted(giacenze, reverse=True))
 
+    def test_get_scorta_materiale_uguale_a_riga_get_scorte(self):
+        self.db.registra_movimento(self.mid, "carico", 30.0, fornitore_nome="FORN_MAG")
+        riga = [r for r in self.db.get_scorte() if r[0] == self.mid][0]
+        self.assertEqual(self.db.get_scorta_materiale(self.mid), riga)
+
+    def test_get_scorta_materiale_non_esistente(self):
+        self.assertIsNone(self.db.get_scorta_materiale(999999))
+
     def test_get_consumi_periodo_scarichi(self):
         inizio = (datetime.now() - timedelta(days=1)).isoformat()
         fine = (datetime.now() + timedelta(days=1)).isoformat()
@@ -490,6 +535,66 @@ class TestMagazzino(unittest.TestCase):
         tot = self.db.get_giacenza_totale_materiale(self.mid)
         self.assertAlmostEqual(tot, 60.0, places=2)
 
+    def test_batch_stesse_giacenze_dei_movimenti_singoli(self):
+        legacy = self.db.add_materiale("MAT_MAG_LEGACY", 0.1, 1.0, giacenza=5.0)
+        righe = [
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 40.0, 'fornitore_nome': "FORN_MAG"},
+            {'materiale_id': self.mid, 'tipo': 'scarico', 'quantita': 15.5, 'fornitore_nome': "FORN_MAG",
+             'note': "taglio"},
+            {'materiale_id': legacy, 'tipo': 'carico', 'quantita': 2.0},
+        ]
+        ids = self.db.registra_movimenti_batch(righe)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual([self.db.get_movimento_by_id(i)[2] for i in ids], ['carico', 'scarico', 'carico'])
+        self.assertEqual(self.db.get_movimento_by_id(ids[1])[5], "taglio")
+        self.assertAlmostEqual(self.db.get_giacenza_totale_materiale(self.mid), 24.5)
+        self.assertAlmostEqual(self.db.get_scorta_materiale(legacy)[2], 7.0)
+
+    def test_batch_tutto_o_niente(self):
+        righe = [
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 10.0, 'fornitore_nome': "FORN_MAG"},
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 10.0, 'fornitore_nome': "NON_CONFIGURATO"},
+        ]
+        self.assertIs(self.db.registra_movimenti_batch(righe), False)
+        self.assertEqual(self.db.get_movimenti_per_materiale(self.mid), [])
+        self.assertEqual(self.db.get_giacenza_totale_materiale(self.mid), 0.0)
+
+    def test_batch_scarico_oltre_giacenza_conta_le_righe_precedenti(self):
+        righe = [
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 10.0, 'fornitore_nome': "FORN_MAG"},
+            {'materiale_id': self.mid, 'tipo': 'scarico', 'quantita': 8.0, 'fornitore_nome': "FORN_MAG"},
+            {'materiale_id': self.mid, 'tipo': 'scarico', 'quantita': 8.0, 'fornitore_nome': "FORN_MAG"},
+        ]
+        errori = self.db.valida_movimenti(righe)
+        self.assertEqual(len(errori), 1)
+        self.assertTrue(errori[0].startswith("Riga 3:"))
+        self.assertIs(self.db.registra_movimenti_batch(righe), False)
+        # Senza verifica lo scarico si ferma a 0 come registra_movimento
+        self.assertEqual(len(self.db.registra_movimenti_batch(righe, verifica_giacenza=False)), 3)
+        self.assertEqual(self.db.get_giacenza_totale_materiale(self.mid), 0.0)
+
+    def test_batch_righe_non_valide(self):
+        errori = self.db.valida_movimenti([
+            {'materiale_id': self.mid, 'tipo': 'reso', 'quantita': 1.0},
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': -1.0},
+            {'materiale_id': 999999, 'tipo': 'carico', 'quantita': 1.0},
+            {'tipo': 'carico', 'quantita': 1.0},
+        ])
+        self.assertEqual([e.split(":")[0] for e in errori], ["Riga 1", "Riga 2", "Riga 3", "Riga 4"])
+        self.assertEqual(self.db.registra_movimenti_batch([]), [])
+
+    def test_batch_un_solo_commit(self):
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            self.db.registra_movimenti_batch(
+                [{'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 1.0, 'fornitore_nome': "FORN_MAG"}] * 40)
+        finally:
+            conn.set_trace_callback(None)
+        self.assertEqual(len([q for q in eseguite if q.strip().upper() == "COMMIT"]), 1)
+        self.assertAlmostEqual(self.db.get_giacenza_totale_materiale(self.mid), 40.0)
+
 
 # ===========================================================================
 # 5. CATEGORIE CRUD
@@ -944,6 +1049,1506 @@ class TestMaterialeModel(unittest.TestCase):
         self.assertAlmostEqual(m.spessore, 0.3)
 
 
+# ===========================================================================
+# 10. Connessioni persistenti per thread
+# ===========================================================================
+
+class TestConnessioni(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_stesso_thread_riusa_connessione(self):
+        self.assertIs(self.db._connect(), self.db._connect())
+
+    def test_thread_diverso_connessione_diversa(self):
+        import threading
+        conn_main = self.db._connect()
+        risultato = {}
+
+        def worker():
+            risultato['conn'] = self.db._connect()
+            risultato['materiali'] = self.db.get_all_materiali()
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        self.assertIsNot(risultato['conn'], conn_main)
+        self.assertGreater(len(risultato['materiali']), 0)
+
+    def test_close_chiude_tutte_e_riapre_su_richiesta(self):
+        conn = self.db._connect()
+        self.db.close()
+        import sqlite3
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+        # Il manager resta utilizzabile: riapre una nuova connessione
+        mid = self.db.add_materiale("DOPO_CLOSE", 0.1, 1.0)
+        self.assertIsInstance(mid, int)
+        self.assertIsNot(self.db._connect(), conn)
+
+    def test_errore_fa_rollback_sulla_connessione_condivisa(self):
+        """Un'eccezione dentro il blocco with annulla le scritture non ancora committate."""
+        try:
+            with self.db._connect() as conn:
+                conn.execute("INSERT INTO fornitori (nome) VALUES ('ROLLBACK_F')")
+                raise RuntimeError("simulato")
+        except RuntimeError:
+            pass
+        nomi = [r[1] for r in self.db.get_all_fornitori()]
+        self.assertNotIn("ROLLBACK_F", nomi)
+
+
+# ===========================================================================
+# 11. Profili di storage e retry su database occupato
+# ===========================================================================
+
+class TestProfiloStorage(unittest.TestCase):
+
+    def _db(self, **kwargs):
+        tmp = tempfile.mkdtemp()
+        db = DatabaseManager(db_path=os.path.join(tmp, "test.db"), **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def _pragma(self, db, nome):
+        return db._connect().execute(f"PRAGMA {nome}").fetchone()[0]
+
+    def test_profilo_local_usa_wal(self):
+        db = self._db()
+        self.assertEqual(db.profilo_storage['nome'], 'local')
+        self.assertEqual(self._pragma(db, "journal_mode").upper(), "WAL")
+        self.assertEqual(self._pragma(db, "busy_timeout"), 5000)
+
+    def test_profilo_shared_journal_classico(self):
+        db = self._db(profilo='shared')
+        self.assertEqual(self._pragma(db, "journal_mode").upper(), "DELETE")
+        self.assertEqual(self._pragma(db, "synchronous"), 2)  # FULL
+        self.assertEqual(self._pragma(db, "busy_timeout"), 15000)
+        self.assertEqual(self._pragma(db, "mmap_size"), 0)
+
+    def test_sovrascritture_valide_e_non_valide(self):
+        db = self._db(opzioni_storage={'busy_timeout': 1234, 'journal_mode': 'boh', 'sconosciuta': 1})
+        self.assertEqual(self._pragma(db, "busy_timeout"), 1234)
+        self.assertEqual(db.profilo_storage['journal_mode'], 'WAL')
+        self.assertNotIn('sconosciuta', db.profilo_storage)
+
+    def test_profilo_sconosciuto_ripiega_su_local(self):
+        db = self._db(profilo='cloud')
+        self.assertEqual(db.profilo_storage['nome'], 'local')
+
+    def test_backup_include_dati_wal(self):
+        db = self._db()
+        db.add_materiale("NEL_WAL", 0.1, 1.0)
+        db._backup_database()
+        backup_dir = os.path.join(os.path.dirname(db.db_path), "backup")
+        ultimo = sorted(os.listdir(backup_dir))[-1]
+        import sqlite3
+        conn = sqlite3.connect(os.path.join(backup_dir, ultimo))
+        try:
+            nomi = [r[0] for r in conn.execute("SELECT nome FROM materiali")]
+        finally:
+            conn.close()
+        self.assertIn("NEL_WAL", nomi)
+
+    def _blocca(self, db):
+        """Apre una seconda connessione che tiene un lock esclusivo sul database."""
+        import sqlite3
+        altra = sqlite3.connect(db.db_path, isolation_level=None, check_same_thread=False)
+        altra.execute("BEGIN EXCLUSIVE")
+        self.addCleanup(altra.close)
+        return altra
+
+    def test_scrittura_ritentata_finche_il_lock_si_libera(self):
+        import threading
+        db = self._db(opzioni_storage={'busy_timeout': 0, 'retry_tentativi': 10, 'retry_attesa_ms': 20})
+        mid = db.add_materiale("LOCK_MAT", 0.1, 1.0)
+        altra = self._blocca(db)
+        threading.Timer(0.15, lambda: altra.execute("COMMIT")).start()
+        self.assertTrue(db.update_prezzo_materiale(mid, 42.0))
+        self.assertAlmostEqual(db.get_materiale_by_id(mid)[3], 42.0)
+
+    def test_riprezzatura_ritentata_finche_il_lock_si_libera(self):
+        import threading
+        db = self._db(opzioni_storage={'busy_timeout': 0, 'retry_tentativi': 10, 'retry_attesa_ms': 20})
+        mid = db.add_materiale("LOCK_RP", 0.5, 10.0)
+        prev = Preventivo()
+        m = MaterialeCalcolato()
+        m.materiale_nome = "LOCK_RP"
+        m.diametro, m.lunghezza, m.giri, m.spessore, m.costo_materiale = 100.0, 1000.0, 3, 0.5, 10.0
+        m.ricalcola_tutto()
+        prev.materiali_calcolati.append(m)
+        prev.ricalcola_tutto()
+        pid = db.add_preventivo(prev.to_dict())
+        db.update_prezzo_materiale(mid, 12.0)
+        altra = self._blocca(db)
+        threading.Timer(0.15, lambda: altra.execute("COMMIT")).start()
+        preventivi, _ = db.riprezza_preventivi(applica=True)
+        self.assertEqual([p[0] for p in preventivi], [pid])
+        self.assertEqual(db.get_preventivo_by_id(preventivi[0][6])['numero_revisione'], 2)
+
+    def test_lock_persistente_segue_gestione_errore_originale(self):
+        db = self._db(opzioni_storage={'busy_timeout': 0, 'retry_tentativi': 2, 'retry_attesa_ms': 1})
+        mid = db.add_materiale("LOCK_MAT2", 0.1, 1.0)
+        self._blocca(db)
+        # update_prezzo_materiale gestisce sqlite3.Error restituendo False
+        self.assertFalse(db.update_prezzo_materiale(mid, 42.0))
+
+
+# ===========================================================================
+# 12. Versioning dello schema (PRAGMA user_version)
+# ===========================================================================
+
+class TestVersioningSchema(unittest.TestCase):
+
+    def test_db_nuovo_alla_versione_finale(self):
+        db = make_db()
+        versione = db._connect().execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(versione, DatabaseManager.MIGRAZIONI[-1][0])
+
+    def test_registro_migrazioni_numerato_in_ordine(self):
+        numeri = [m[0] for m in DatabaseManager.MIGRAZIONI]
+        self.assertEqual(numeri, list(range(1, len(numeri) + 1)))
+
+    def test_db_aggiornato_non_riesegue_migrazioni(self):
+        """Con user_version aggiornato i materiali di esempio non vengono reinseriti."""
+        db = make_db()
+        with db._connect() as conn:
+            conn.execute("DELETE FROM materiali")
+        db.close()
+        db2 = DatabaseManager(db_path=db.db_path)
+        self.assertEqual(len(db2.get_all_materiali()), 0)
+
+    def test_db_pre_versioning_viene_migrato(self):
+        """Un database creato prima del versioning (user_version = 0, colonne mancanti)."""
+        import sqlite3
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "vecchio.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE materiali (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "nome TEXT NOT NULL UNIQUE, spessore REAL NOT NULL, prezzo REAL NOT NULL)")
+        conn.execute("INSERT INTO materiali (nome, spessore, prezzo) VALUES ('LEGACY', 0.2, 10.0)")
+        conn.commit()
+        conn.close()
+
+        db = DatabaseManager(db_path=path)
+        self.assertEqual(db._connect().execute("PRAGMA user_version").fetchone()[0],
+                         DatabaseManager.MIGRAZIONI[-1][0])
+        row = db.get_materiale_by_nome("LEGACY")
+        self.assertIsNotNone(row)
+        self.assertAlmostEqual(row[7], 0.0)  # colonna giacenza aggiunta dalla migrazione
+        self.assertIsInstance(db.add_fornitore_a_materiale(row[0], "F_LEGACY"), int)
+
+
+# ===========================================================================
+# 13. Indici: EXPLAIN QUERY PLAN delle query frequenti
+# ===========================================================================
+
+class TestPianiQuery(unittest.TestCase):
+    """Intercetta le query eseguite dai metodi e verifica che le tabelle grandi
+    vengano lette tramite indice (SEARCH) e non con una scansione completa (SCAN)."""
+
+    def setUp(self):
+        self.db = make_db()
+
+    def _piani(self, metodo, *args):
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            metodo(*args)
+        finally:
+            conn.set_trace_callback(None)
+        dettagli = []
+        for sql in eseguite:
+            if sql.lstrip().upper().startswith(("SELECT", "WITH")):
+                dettagli += [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+        self.assertTrue(dettagli, msg=f"{metodo.__name__}: nessuna query intercettata")
+        return dettagli
+
+    def _assert_usa_indice(self, dettagli, alias):
+        self.assertFalse([d for d in dettagli if d.startswith(f"SCAN {alias}")],
+                         msg=f"Scansione completa di '{alias}': {dettagli}")
+        self.assertTrue([d for d in dettagli if d.startswith(f"SEARCH {alias} ")],
+                        msg=f"'{alias}' non letto tramite indice: {dettagli}")
+
+    def test_movimenti_periodo(self):
+        self._assert_usa_indice(self._piani(self.db.get_movimenti_periodo, "2025-01-01", "2025-12-31"), "mov")
+
+    def test_consumi_periodo(self):
+        self._assert_usa_indice(self._piani(self.db.get_consumi_periodo, "2025-01-01", "2025-12-31"), "mov")
+
+    def test_movimenti_per_materiale(self):
+        self._assert_usa_indice(self._piani(self.db.get_movimenti_per_materiale, 1), "m")
+
+    def test_revisioni_preventivo(self):
+        self._assert_usa_indice(self._piani(self.db.get_revisioni_preventivo, 1), "preventivi")
+
+    def test_preventivi_latest_sottoquery_su_indice(self):
+        self._assert_usa_indice(self._piani(self.db.get_all_preventivi_latest), "r")
+
+    def test_clienti_join_preventivi(self):
+        self._assert_usa_indice(self._piani(self.db.get_all_clienti), "p")
+
+    def test_scorte_per_fornitore(self):
+        dettagli = self._piani(self.db.get_scorte_per_fornitore, "CIT")
+        self._assert_usa_indice(dettagli, "mf")
+        self._assert_usa_indice(dettagli, "m")
+
+    def test_storico_preventivo(self):
+        self._assert_usa_indice(self._piani(self.db.get_storico_modifiche, 1), "preventivi_storico")
+
+    def test_materiali_preventivo(self):
+        self._assert_usa_indice(self._piani(self.db.get_materiali_preventivo, 1), "preventivo_materiali")
+
+    def test_scarichi_preventivo(self):
+        self._assert_usa_indice(self._piani(self.db.get_scarichi_preventivo, 1), "movimenti_magazzino")
+
+    def test_versione_storico_dall_ultimo_checkpoint(self):
+        pid = self.db.add_preventivo(_preventivo_data())
+        self.db.update_preventivo(pid, _preventivo_data(prezzo_cliente=1.0))
+        ts = self.db.get_indice_storico(pid)[0]
+        self._assert_usa_indice(self._piani(self.db.get_versione_storico, pid, ts), "preventivi_storico")
+
+
+# ===========================================================================
+# 14. Storico modifiche in tabella dedicata (preventivi_storico)
+# ===========================================================================
+
+class TestStoricoPreventivi(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+
+    def _add_prev(self, **kw):
+        return self.db.add_preventivo(_preventivo_data(**kw))
+
+    def test_una_riga_per_salvataggio(self):
+        pid = self._add_prev(preventivo_finale=100.0)
+        for i in range(5):
+            self.db.update_preventivo(pid, _preventivo_data(preventivo_finale=200.0 + i))
+        righe = self.db._connect().execute(
+            "SELECT COUNT(*) FROM preventivi_storico WHERE preventivo_id = ?", (pid,)).fetchone()[0]
+        self.assertEqual(righe, 5)
+        storico = self.db.get_storico_modifiche(pid)
+        self.assertEqual([v["data"]["preventivo_finale"] for v in storico], [100.0, 200.0, 201.0, 202.0, 203.0])
+        self.assertEqual(self.db.get_indice_storico(pid), [v["timestamp"] for v in storico])
+
+    def test_salvataggio_non_riscrive_lo_storico(self):
+        """Il salvataggio non tocca la colonna legacy e inserisce una sola riga di storico."""
+        pid = self._add_prev()
+        for i in range(20):
+            self.db.update_preventivo(pid, _preventivo_data(preventivo_finale=float(i)))
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            self.db.update_preventivo(pid, _preventivo_data(preventivo_finale=99.0))
+        finally:
+            conn.set_trace_callback(None)
+        self.assertFalse([q for q in eseguite if "storico_modifiche" in q])
+        self.assertEqual(len([q for q in eseguite if "INSERT INTO preventivi_storico" in q]), 1)
+        self.assertEqual(conn.execute("SELECT storico_modifiche FROM preventivi WHERE id = ?",
+                                      (pid,)).fetchone()[0], "[]")
+
+    def test_ripristino_accoda_versione_corrente(self):
+        pid = self._add_prev(nome_cliente="V1", preventivo_finale=10.0)
+        self.db.update_preventivo(pid, _preventivo_data(nome_cliente="V2", preventivo_finale=20.0))
+        ts_v1 = self.db.get_indice_storico(pid)[0]
+        self.assertTrue(self.db.ripristina_versione_preventivo(pid, ts_v1))
+        prev = self.db.get_preventivo_by_id(pid)
+        self.assertEqual(prev["nome_cliente"], "V1")
+        self.assertAlmostEqual(prev["preventivo_finale"], 10.0)
+        self.assertEqual(self.db.get_storico_modifiche(pid)[-1]["data"]["nome_cliente"], "V2")
+        self.assertNotIn("storico_modifiche", prev)
+
+    def test_flag_e_conteggio_modifiche(self):
+        pid_mod = self._add_prev()
+        pid_no = self._add_prev()
+        self.db.update_preventivo(pid_mod, _preventivo_data(prezzo_cliente=5.0))
+        self.db.update_preventivo(pid_mod, _preventivo_data(prezzo_cliente=6.0))
+        con_mod = {r[0]: r[9] for r in self.db.get_preventivi_con_modifiche()}
+        self.assertEqual(con_mod, {pid_mod: 2})
+        tutti = {r[0]: r[9] for r in self.db.get_all_preventivi()}
+        self.assertEqual((tutti[pid_mod], tutti[pid_no]), (2, 0))
+        self.assertEqual([r[0] for r in self.db.get_pagina_preventivi("", {'solo_con_modifiche': True})], [pid_mod])
+
+    def test_eliminazione_rimuove_storico(self):
+        pid = self._add_prev()
+        self.db.update_preventivo(pid, _preventivo_data(prezzo_cliente=5.0))
+        rev = self.db.add_revisione_preventivo(pid, _preventivo_data())
+        self.db.update_preventivo(rev, _preventivo_data(prezzo_cliente=7.0))
+        self.assertTrue(self.db.delete_preventivo_e_revisioni(pid))
+        righe = self.db._connect().execute("SELECT COUNT(*) FROM preventivi_storico").fetchone()[0]
+        self.assertEqual(righe, 0)
+
+    def test_delta_e_checkpoint(self):
+        n = DatabaseManager.CHECKPOINT_STORICO
+        pid = self._add_prev()
+        for i in range(n + 3):
+            self.db.update_preventivo(pid, _preventivo_data(preventivo_finale=float(i)))
+        completi = [r[0] for r in self.db._connect().execute(
+            "SELECT completo FROM preventivi_storico WHERE preventivo_id = ? ORDER BY id", (pid,))]
+        self.assertEqual(completi, [1] + [0] * (n - 1) + [1, 0, 0])
+        ultima = self.db.get_versione_storico(pid, self.db.get_indice_storico(pid)[-1])
+        self.assertAlmostEqual(ultima["preventivo_finale"], float(n + 1))
+        self.assertEqual(set(ultima), set(DatabaseManager.CAMPI_SNAPSHOT))
+
+    def test_round_trip_1000_modifiche_casuali(self):
+        """1000 modifiche casuali: ogni versione ricostruita coincide con quella salvata
+        e lo storico occupa molto meno del vecchio blob JSON."""
+        import random
+        rnd = random.Random(7)
+        campi_testo = ["nome_cliente", "numero_ordine", "misura", "descrizione", "codice"]
+        campi_numerici = ["costo_totale_materiali", "costi_accessori", "minuti_taglio",
+                          "minuti_avvolgimento", "preventivo_finale", "prezzo_cliente"]
+        corrente = _preventivo_data(materiali_utilizzati=[{"nome": "HS300", "giri": 3}])
+        pid = self.db.add_preventivo(corrente)
+        attesi = []
+        for _ in range(1000):
+            attesi.append({k: v for k, v in self.db.get_preventivo_by_id(pid).items()
+                           if k in DatabaseManager.CAMPI_SNAPSHOT})
+            corrente = dict(corrente)
+            for campo in rnd.sample(campi_testo + campi_numerici + ["materiali_utilizzati"], rnd.randint(1, 2)):
+                if campo in campi_testo:
+                    corrente[campo] = f"{campo}_{rnd.randint(0, 50)}"
+                elif campo in campi_numerici:
+                    corrente[campo] = round(rnd.uniform(0, 1000), 2)
+                else:
+                    corrente[campo] = [{"nome": "HS300", "giri": rnd.randint(1, 9)}]
+            self.db.update_preventivo(pid, corrente)
+
+        storico = self.db.get_storico_modifiche(pid)
+        ricostruiti = [v["data"] for v in storico]
+        for versione in ricostruiti:
+            versione["materiali_utilizzati"] = json.loads(versione["materiali_utilizzati"])
+        for versione in attesi:
+            versione.pop("storico_modifiche", None)
+        self.assertEqual(ricostruiti, attesi)
+        for i in rnd.sample(range(1000), 20):
+            versione = self.db.get_versione_storico(pid, storico[i]["timestamp"])
+            self.assertEqual(json.loads(versione["materiali_utilizzati"]), attesi[i]["materiali_utilizzati"])
+
+        # Dimensione: stesso contenuto nel formato precedente (blob unico) vs righe delta
+        blob = json.dumps(storico)
+        righe = self.db._connect().execute(
+            "SELECT SUM(LENGTH(dati) + LENGTH(timestamp)) FROM preventivi_storico WHERE preventivo_id = ?",
+            (pid,)).fetchone()[0]
+        self.assertLess(righe * 4, len(blob), msg=f"delta {righe} byte vs blob {len(blob)} byte")
+
+    def test_migrazione_blob_esistente(self):
+        """Un database alla versione 2 con lo storico nel blob JSON viene travasato."""
+        db = make_db()
+        storico = [
+            {"timestamp": "2025-01-01T10:00:00", "data": {"nome_cliente": "A", "preventivo_finale": 1.0}},
+            {"timestamp": "2025-01-02T10:00:00", "data": {"nome_cliente": "B", "preventivo_finale": 2.0}},
+        ]
+        pid = db.add_preventivo(_preventivo_data())
+        pid_rotto = db.add_preventivo(_preventivo_data())
+        with db._connect() as conn:
+            conn.execute("DROP TABLE preventivi_storico")
+            conn.execute("UPDATE preventivi SET storico_modifiche = ? WHERE id = ?", (json.dumps(storico), pid))
+            conn.execute("UPDATE preventivi SET storico_modifiche = '{rotto' WHERE id = ?", (pid_rotto,))
+            conn.execute("PRAGMA user_version = 2")
+        db.close()
+
+        db2 = DatabaseManager(db_path=db.db_path)
+        self.assertEqual(db2.get_storico_modifiche(pid), storico)
+        self.assertEqual(db2.get_storico_modifiche(pid_rotto), [])
+        residui = db2._connect().execute(
+            "SELECT COUNT(*) FROM preventivi WHERE storico_modifiche != '[]'").fetchone()[0]
+        self.assertEqual(residui, 0)
+
+
+# ===========================================================================
+# 15. Materiali dei preventivi in tabella normalizzata (preventivo_materiali)
+# ===========================================================================
+
+def _materiale_dict(materiale_id, nome, giri=3, lunghezza=1000.0, **kw):
+    """Materiale come salvato da MaterialeCalcolato.to_dict()."""
+    mc = MaterialeCalcolato()
+    mc.materiale_id, mc.materiale_nome, mc.giri = materiale_id, nome, giri
+    mc.diametro, mc.lunghezza, mc.spessore, mc.prezzo = 100.0, lunghezza, 0.3, 20.0
+    mc.ricalcola_tutto()
+    d = mc.to_dict()
+    d.update(kw)
+    return d
+
+
+class TestPreventivoMateriali(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+
+    def test_scritti_su_add_update_revisione(self):
+        m1, m2 = _materiale_dict(1, "HS300"), _materiale_dict(2, "HS150", giri=5, is_conica=True, posa="//")
+        pid = self.db.add_preventivo(_preventivo_data(materiali_utilizzati=[m1, m2]))
+        righe = self.db.get_materiali_preventivo(pid)
+        self.assertEqual([(r[0], r[1], r[2], r[3]) for r in righe], [(0, 1, "HS300", 3), (1, 2, "HS150", 5)])
+        self.assertAlmostEqual(righe[0][6], m1["lunghezza_utilizzata"])
+        self.assertAlmostEqual(righe[0][7], m1["costo_totale"])
+        self.assertEqual((righe[1][8], righe[1][9]), (1, "//"))
+
+        self.db.update_preventivo(pid, _preventivo_data(materiali_utilizzati=[m2]))
+        self.assertEqual([r[2] for r in self.db.get_materiali_preventivo(pid)], ["HS150"])
+
+        rev = self.db.add_revisione_preventivo(pid, _preventivo_data(materiali_utilizzati=[m1, m1]))
+        self.assertEqual(len(self.db.get_materiali_preventivo(rev)), 2)
+        self.assertEqual(len(self.db.get_materiali_preventivo(pid)), 1)
+
+    def test_ripristino_riscrive_materiali(self):
+        pid = self.db.add_preventivo(_preventivo_data(materiali_utilizzati=[_materiale_dict(1, "HS300")]))
+        self.db.update_preventivo(pid, _preventivo_data(materiali_utilizzati=[]))
+        self.assertEqual(self.db.get_materiali_preventivo(pid), [])
+        self.db.ripristina_versione_preventivo(pid, self.db.get_indice_storico(pid)[0])
+        self.assertEqual([r[2] for r in self.db.get_materiali_preventivo(pid)], ["HS300"])
+
+    def test_json_non_valido_nessuna_riga(self):
+        pid = self.db.add_preventivo(_preventivo_data(materiali_utilizzati="non json"))
+        self.assertEqual(self.db.get_materiali_preventivo(pid), [])
+
+    def test_eliminazione_rimuove_righe(self):
+        pid = self.db.add_preventivo(_preventivo_data(materiali_utilizzati=[_materiale_dict(1, "HS300")]))
+        self.db.add_revisione_preventivo(pid, _preventivo_data(materiali_utilizzati=[_materiale_dict(1, "HS300")]))
+        self.db.delete_preventivo_e_revisioni(pid)
+        righe = self.db._connect().execute("SELECT COUNT(*) FROM preventivo_materiali").fetchone()[0]
+        self.assertEqual(righe, 0)
+
+    def test_backfill_da_json_esistente(self):
+        """Un database alla versione 4 con i soli JSON viene proiettato nella tabella."""
+        db = make_db()
+        pid = db.add_preventivo(_preventivo_data(materiali_utilizzati=[
+            _materiale_dict(1, "HS300"), _materiale_dict(None, "SENZA_ID", giri=2)]))
+        with db._connect() as conn:
+            conn.execute("DROP TABLE preventivo_materiali")
+            conn.execute("PRAGMA user_version = 4")
+        db.close()
+
+        db2 = DatabaseManager(db_path=db.db_path)
+        righe = db2.get_materiali_preventivo(pid)
+        self.assertEqual([(r[1], r[2], r[3]) for r in righe], [(1, "HS300", 3), (None, "SENZA_ID", 2)])
+
+
+# ===========================================================================
+# 16. Ricerca full-text sui preventivi (search_preventivi)
+# ===========================================================================
+
+class TestRicercaPreventivi(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.rossi = self.db.add_preventivo(_preventivo_data(
+            nome_cliente="Rossi Srl", descrizione="Rullo gommato", codice="RG-100", finitura="Lucida"))
+        self.bianchi = self.db.add_preventivo(_preventivo_data(
+            nome_cliente="Bianchi", descrizione="Rullo per Rossi, caffè", misura="80x300"))
+        self.rev = self.db.add_revisione_preventivo(self.rossi, _preventivo_data(
+            nome_cliente="Rossi Srl", descrizione="Rullo gommato rev"))
+
+    def _ids(self, query="", filtri=None, limit=None):
+        return [r[0] for r in self.db.search_preventivi(query, filtri, limit)]
+
+    def test_prefisso_e_pertinenza(self):
+        # Il cliente pesa più della descrizione
+        self.assertEqual(self._ids("ross")[-1], self.bianchi)
+        self.assertEqual(set(self._ids("ross")), {self.rossi, self.bianchi, self.rev})
+
+    def test_tutte_le_parole_e_accenti(self):
+        self.assertEqual(self._ids("rullo caffe"), [self.bianchi])
+        self.assertEqual(self._ids("lucid"), [self.rossi])
+        self.assertEqual(self._ids("rg-100"), [self.rossi])
+        self.assertEqual(self._ids("80x3"), [self.bianchi])
+
+    def test_colonne_restituite(self):
+        riga = self.db.search_preventivi("lucida")[0]
+        self.assertEqual(len(riga), 12)
+        self.assertEqual((riga[0], riga[4], riga[10], riga[11]), (self.rossi, "Rossi Srl", "100x200", "Lucida"))
+
+    def test_numero_cerca_anche_id(self):
+        self.assertIn(self.bianchi, self._ids(str(self.bianchi)))
+
+    def test_sintassi_fts_dell_utente_ignorata(self):
+        self.assertEqual(self._ids('"rossi OR NEAR('), [])
+        self.assertEqual(self._ids("   "), self._ids(""))
+
+    def test_filtri(self):
+        self.assertEqual(self._ids("rullo", {"cliente": "Bianchi"}), [self.bianchi])
+        self.assertEqual(self._ids("", {"tipo": "revisionati"}), [self.rev])
+        self.assertNotIn(self.rossi, self._ids("rossi", {"solo_ultime": True}))
+        self.db.update_preventivo(self.bianchi, _preventivo_data(nome_cliente="Bianchi"))
+        self.assertEqual(self._ids("", {"solo_con_modifiche": True}), [self.bianchi])
+        self.assertEqual(len(self._ids("rullo", limit=2)), 2)
+
+    def test_indice_allineato_da_trigger(self):
+        self.db.update_preventivo(self.bianchi, _preventivo_data(nome_cliente="Verdi", descrizione="Albero"))
+        self.assertNotIn(self.bianchi, self._ids("bianchi"))
+        self.assertEqual(self._ids("verd"), [self.bianchi])
+        self.db.delete_preventivo_e_revisioni(self.rossi)
+        self.assertEqual(self._ids("ross"), [])
+
+    def test_senza_fts_usa_like(self):
+        with self.db._connect() as conn:
+            for trigger in ("preventivi_fts_ai", "preventivi_fts_ad", "preventivi_fts_au"):
+                conn.execute(f"DROP TRIGGER {trigger}")
+            conn.execute("DROP TABLE preventivi_fts")
+        self.assertEqual(set(self._ids("ross")), {self.rossi, self.bianchi, self.rev})
+        self.assertEqual(self._ids("rullo caffè"), [self.bianchi])
+
+
+# ===========================================================================
+# 17. Paginazione keyset dei preventivi (get_pagina_preventivi)
+# ===========================================================================
+
+class TestPaginazionePreventivi(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.ids = [self.db.add_preventivo(_preventivo_data(nome_cliente=f"Cliente {i % 3}"))
+                    for i in range(25)]
+        # Metà dei preventivi con la stessa data: l'id deve spezzare i pareggi
+        with self.db._connect() as conn:
+            conn.execute("UPDATE preventivi SET data_creazione = '2025-06-01T10:00:00' WHERE id % 2 = 0")
+
+    def _tutte_le_pagine(self, query="", filtri=None, limit=4):
+        righe, dopo = [], None
+        while True:
+            pagina = self.db.get_pagina_preventivi(query, filtri, limit=limit, dopo=dopo)
+            righe += pagina
+            if len(pagina) < limit:
+                return righe
+            dopo = (pagina[-1][1], pagina[-1][0])
+
+    def test_pagine_coprono_tutto_senza_duplicati(self):
+        righe = self._tutte_le_pagine()
+        self.assertEqual([r[0] for r in righe], [r[0] for r in self.db.search_preventivi()])
+        self.assertEqual(sorted(r[0] for r in righe), sorted(self.ids))
+
+    def test_pagine_con_filtri(self):
+        filtri = {"cliente": "Cliente 1"}
+        righe = self._tutte_le_pagine("cliente", filtri, limit=3)
+        self.assertEqual(len(righe), self.db.conta_preventivi("cliente", filtri))
+        self.assertTrue(all(r[4] == "Cliente 1" for r in righe))
+
+    def test_conta_preventivi(self):
+        self.assertEqual(self.db.conta_preventivi(), 25)
+        self.assertEqual(self.db.conta_preventivi("", {"tipo": "revisionati"}), 0)
+
+    def test_pagina_successiva_su_indice(self):
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            self.db.get_pagina_preventivi(limit=5, dopo=("2025-06-01T10:00:00", 10))
+        finally:
+            conn.set_trace_callback(None)
+        sql = [q for q in eseguite if q.lstrip().startswith("SELECT")][0]
+        piano = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+        self.assertTrue([d for d in piano if d.startswith("SEARCH p USING INDEX idx_preventivi_data_id")],
+                        msg=str(piano))
+        self.assertFalse([d for d in piano if "TEMP B-TREE" in d], msg=str(piano))
+
+
+# ===========================================================================
+# 18. Nomi clienti distinti per i filtri (get_nomi_clienti_distinti)
+# ===========================================================================
+
+class TestNomiClientiDistinti(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        for nome in ("Rossi", " Rossi ", "Bianchi", "", "Verdi"):
+            self.db.add_preventivo(_preventivo_data(nome_cliente=nome))
+
+    def _select_eseguite(self, metodo):
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            risultato = metodo()
+        finally:
+            conn.set_trace_callback(None)
+        return risultato, [q for q in eseguite if q.lstrip().upper().startswith("SELECT")]
+
+    def test_nomi_distinti_ordinati(self):
+        self.assertEqual(self.db.get_nomi_clienti_distinti(), ["Bianchi", "Rossi", "Verdi"])
+
+    def test_cache_evita_la_query(self):
+        self.db.get_nomi_clienti_distinti()
+        nomi, select = self._select_eseguite(self.db.get_nomi_clienti_distinti)
+        self.assertEqual(nomi, ["Bianchi", "Rossi", "Verdi"])
+        self.assertEqual(select, [])
+
+    def test_scritture_preventivi_invalidano(self):
+        self.db.get_nomi_clienti_distinti()
+        pid = self.db.add_preventivo(_preventivo_data(nome_cliente="Neri"))
+        self.assertIn("Neri", self.db.get_nomi_clienti_distinti())
+        self.db.update_preventivo(pid, _preventivo_data(nome_cliente="Gialli"))
+        nomi = self.db.get_nomi_clienti_distinti()
+        self.assertIn("Gialli", nomi)
+        self.assertNotIn("Neri", nomi)
+        self.db.delete_preventivo_e_revisioni(pid)
+        self.assertNotIn("Gialli", self.db.get_nomi_clienti_distinti())
+
+    def test_scritture_clienti_invalidano(self):
+        self.db.get_nomi_clienti_distinti()
+        self.db.add_cliente("Nuovo")
+        _, select = self._select_eseguite(self.db.get_nomi_clienti_distinti)
+        self.assertTrue(select)
+
+    def test_scrittura_da_altra_connessione(self):
+        """Un altro PC sul database condiviso: cambia PRAGMA data_version"""
+        self.db.get_nomi_clienti_distinti()
+        with sqlite3.connect(self.db.db_path) as altra:
+            altra.execute("UPDATE preventivi SET nome_cliente = 'Marroni' WHERE nome_cliente = 'Verdi'")
+        altra.close()
+        nomi = self.db.get_nomi_clienti_distinti()
+        self.assertIn("Marroni", nomi)
+        self.assertNotIn("Verdi", nomi)
+
+    def test_scrittura_da_altra_connessione_dopo_close(self):
+        """data_version vale per una connessione: dopo close la cache non è più valida"""
+        self.db.add_preventivo(_preventivo_data(nome_cliente="Alfa"))
+        self.db.get_nomi_clienti_distinti()
+        self.db.close()
+        with sqlite3.connect(self.db.db_path) as altra:
+            altra.execute("UPDATE preventivi SET nome_cliente = 'Beta' WHERE nome_cliente = 'Alfa'")
+        altra.close()
+        nomi = self.db.get_nomi_clienti_distinti()
+        self.assertIn("Beta", nomi)
+        self.assertNotIn("Alfa", nomi)
+
+    def test_legge_solo_l_indice(self):
+        self.db._invalida_cache_clienti()
+        _, select = self._select_eseguite(self.db.get_nomi_clienti_distinti)
+        conn = self.db._connect()
+        piano = [r[3] for q in select for r in conn.execute("EXPLAIN QUERY PLAN " + q)]
+        self.assertTrue([d for d in piano if "COVERING INDEX idx_preventivi_nome_cliente" in d], msg=str(piano))
+
+
+# ===========================================================================
+# 19. Report inventario (utils.report_inventario, senza interfaccia)
+# ===========================================================================
+
+class TestReportInventario(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.m1 = self.db.add_materiale("B_MAT <TEST>", 0.25, 30.0)
+        self.m2 = self.db.add_materiale("A_MAT", 0.25, 30.0)
+        self.db.add_fornitore_a_materiale(self.m1, "ZETA", 10.0, 5.0, 100.0)
+        self.db.add_fornitore_a_materiale(self.m1, "ALFA", 12.0, 5.0, 100.0)
+        self.db.registra_movimento(self.m1, "carico", 40.0, fornitore_nome="ALFA")
+
+    def test_righe_come_get_scorte_piu_fornitori(self):
+        """Una query al posto di get_scorte + get_fornitori_per_materiale per materiale"""
+        attese = []
+        for scorta in self.db.get_scorte('nome'):
+            fornitori = self.db.get_fornitori_per_materiale(scorta[0])
+            if not fornitori:
+                attese.append(tuple(scorta) + (None, None, None, None))
+            for _, nome, _, s_min, s_max, giacenza in fornitori:
+                attese.append(tuple(scorta) + (nome, giacenza, s_min, s_max))
+        self.assertEqual([tuple(r) for r in self.db.get_righe_inventario()], attese)
+
+    def test_html_contiene_materiali_e_fornitori(self):
+        html = genera_html_inventario(self.db, datetime(2025, 3, 1, 9, 30))
+        self.assertIn("Generato il 01/03/2025 09:30", html)
+        self.assertIn("B_MAT &lt;TEST&gt;", html)
+        self.assertIn("↳ ALFA", html)
+        self.assertIn("40.00", html)
+        self.assertLess(html.index("A_MAT"), html.index("B_MAT"))
+        self.assertLess(html.index("↳ ALFA"), html.index("↳ ZETA"))
+
+    def test_salva_inventario_su_file(self):
+        cartella = tempfile.mkdtemp()
+        percorso = salva_inventario(self.db, cartella, datetime(2025, 3, 1, 9, 30))
+        self.assertEqual(os.path.basename(percorso), "inventario_20250301_0930.html")
+        with open(percorso, encoding="utf-8") as f:
+            self.assertIn("A_MAT", f.read())
+
+
+# ===========================================================================
+# 20. Riepilogo scorte per materiale aggiornato da trigger (scorte_materiali)
+# ===========================================================================
+
+# La vecchia get_scorte, con LEFT JOIN + GROUP BY ad ogni lettura: riferimento per i confronti
+_SCORTE_AGGREGATE = """
+    SELECT m.id, m.nome,
+           COALESCE(SUM(mf.giacenza), m.giacenza),
+           CASE WHEN m.scorta_massima > 0 THEN m.scorta_massima
+                ELSE COALESCE(MAX(mf.scorta_massima), m.capacita_magazzino) END,
+           COUNT(mf.id),
+           COALESCE(MIN(mf.prezzo_fornitore), m.prezzo_fornitore),
+           m.scorta_minima
+    FROM materiali m
+    LEFT JOIN materiale_fornitori mf ON mf.materiale_id = m.id
+    GROUP BY m.id, m.nome
+    ORDER BY m.nome
+"""
+
+
+class TestRiepilogoScorte(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.m1 = self.db.add_materiale("RIEP_A", 0.25, 30.0, giacenza=7.0)
+        self.m2 = self.db.add_materiale("RIEP_B", 0.25, 30.0)
+        self.m3 = self.db.add_materiale("RIEP_SENZA", 0.25, 30.0, prezzo_fornitore=4.0,
+                                        capacita_magazzino=50.0, giacenza=3.0)
+        self.mf1 = self.db.add_fornitore_a_materiale(self.m1, "ZETA", 10.0, 5.0, 100.0)
+        self.mf2 = self.db.add_fornitore_a_materiale(self.m1, "ALFA", 12.0, 5.0, 80.0)
+        self.mf3 = self.db.add_fornitore_a_materiale(self.m2, "BETA", 9.0, 1.0, 20.0)
+
+    def _assert_come_aggregato(self):
+        attese = [tuple(r) for r in self.db._connect().execute(_SCORTE_AGGREGATE)]
+        self.assertEqual([tuple(r) for r in self.db.get_scorte('nome')], attese)
+        self.assertEqual(self.db.verifica_scorte_materiali(ripara=False), [])
+
+    def test_uguale_all_aggregato_dopo_le_scritture(self):
+        self._assert_come_aggregato()
+        self.db.registra_movimento(self.m1, "carico", 40.0, fornitore_nome="ALFA")
+        mov = self.db.registra_movimento(self.m1, "scarico", 5.5, fornitore_nome="ZETA")
+        self._assert_come_aggregato()
+        self.db.update_fornitore_materiale(self.mf1, "AAA", 3.0, 1.0, 300.0)
+        self.db.modifica_movimento(mov, 2.0, "")
+        self._assert_come_aggregato()
+        self.db.rename_fornitore("ALFA", "OMEGA")
+        self.db.delete_fornitore_materiale(self.mf3)
+        self._assert_come_aggregato()
+        self.db.reset_tutte_giacenze()
+        self.db.delete_materiale(self.m1)
+        self._assert_come_aggregato()
+
+    def test_materiale_senza_fornitori_usa_campi_legacy(self):
+        riga = self.db.get_scorta_materiale(self.m3)
+        self.assertEqual(tuple(riga), (self.m3, "RIEP_SENZA", 3.0, 50.0, 0, 4.0, 0.0))
+
+    def test_ordine_per_primo_fornitore(self):
+        ids = [r[0] for r in self.db.get_scorte('fornitore_asc')]
+        # Senza fornitori prima (NULL), poi ALFA (m1) e BETA (m2)
+        self.assertEqual(ids[-2:], [self.m1, self.m2])
+        self.assertLess(ids.index(self.m3), ids.index(self.m1))
+
+    def test_verifica_ricostruisce_il_riepilogo(self):
+        conn = self.db._connect()
+        conn.execute("UPDATE scorte_materiali SET giacenza = 999 WHERE materiale_id = ?", (self.m1,))
+        conn.execute("DELETE FROM scorte_materiali WHERE materiale_id = ?", (self.m2,))
+        conn.execute("INSERT INTO scorte_materiali VALUES (?, 1, 1, 1, 1, 'X')", (self.m3,))
+        conn.commit()
+        self.assertEqual(self.db.verifica_scorte_materiali(ripara=False), [self.m1, self.m2, self.m3])
+        self.assertEqual(self.db.verifica_scorte_materiali(), [self.m1, self.m2, self.m3])
+        self._assert_come_aggregato()
+
+    def test_lettura_senza_raggruppamento(self):
+        conn = self.db._connect()
+        eseguite = []
+        conn.set_trace_callback(eseguite.append)
+        try:
+            self.db.get_scorte('fornitore_asc')
+        finally:
+            conn.set_trace_callback(None)
+        piano = [r[3] for q in eseguite for r in conn.execute("EXPLAIN QUERY PLAN " + q)]
+        self.assertFalse([d for d in piano if "GROUP BY" in d or "CORRELATED" in d], msg=str(piano))
+        self.assertTrue([d for d in piano if d.startswith("SEARCH s ")], msg=str(piano))
+
+    def test_migrazione_da_versione_7_popola_il_riepilogo(self):
+        conn = self.db._connect()
+        conn.execute("DROP TABLE scorte_materiali")
+        conn.execute("PRAGMA user_version = 7")
+        conn.commit()
+        self.db.init_database()
+        self._assert_come_aggregato()
+
+
+# ===========================================================================
+# 21. Scarico dei consumi di un preventivo (scarica_consumi_preventivo / storno)
+# ===========================================================================
+
+class TestConsumiPreventivo(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.m1 = self.db.add_materiale("CONS_A", 0.3, 20.0)
+        self.m2 = self.db.add_materiale("CONS_LEGACY", 0.3, 20.0, giacenza=10.0)
+        self.db.add_fornitore_a_materiale(self.m1, "POCO", 10.0, 0.0, 100.0)
+        self.db.add_fornitore_a_materiale(self.m1, "TANTO", 10.0, 0.0, 100.0)
+        self.db.registra_movimenti_batch([
+            {'materiale_id': self.m1, 'tipo': 'carico', 'quantita': 2.0, 'fornitore_nome': "POCO"},
+            {'materiale_id': self.m1, 'tipo': 'carico', 'quantita': 50.0, 'fornitore_nome': "TANTO"},
+        ])
+        self.materiali = [_materiale_dict(self.m1, "CONS_A"), _materiale_dict(self.m1, "CONS_A", giri=5),
+                          _materiale_dict(self.m2, "CONS_LEGACY"), _materiale_dict(999999, "ELIMINATO")]
+        self.pid = self.db.add_preventivo(_preventivo_data(materiali_utilizzati=self.materiali))
+        self.consumo_m1 = self.materiali[0]['lunghezza_utilizzata'] + self.materiali[1]['lunghezza_utilizzata']
+
+    def _giacenze(self):
+        return {r[0]: r[2] for r in self.db.get_scorte('nome')}
+
+    def test_raggruppa_per_materiale_e_fornitore(self):
+        consumi = self.db.get_consumi_preventivo(self.pid)
+        self.assertEqual([(c['materiale_id'], c['fornitore_nome']) for c in consumi],
+                         [(self.m1, "TANTO"), (self.m2, "")])
+        self.assertAlmostEqual(consumi[0]['quantita'], self.consumo_m1)
+        scelto = self.db.get_consumi_preventivo(self.pid, fornitori={self.m1: "POCO"})
+        self.assertEqual(scelto[0]['fornitore_nome'], "POCO")
+
+    def test_scarico_idempotente(self):
+        prima = self._giacenze()
+        ids = self.db.scarica_consumi_preventivo(self.pid)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.db.scarica_consumi_preventivo(self.pid), ids)
+        dopo = self._giacenze()
+        self.assertAlmostEqual(dopo[self.m1], prima[self.m1] - self.consumo_m1)
+        self.assertAlmostEqual(dopo[self.m2], 10.0 - self.materiali[2]['lunghezza_utilizzata'])
+        self.assertEqual({self.db.get_movimento_by_id(i)[6] for i in ids}, {self.pid})
+
+    def test_storno_e_nuovo_scarico(self):
+        prima = self._giacenze()
+        self.db.scarica_consumi_preventivo(self.pid)
+        self.assertEqual(len(self.db.storna_consumi_preventivo(self.pid)), 2)
+        self.assertEqual(self.db.get_scarichi_preventivo(self.pid), [])
+        self.assertEqual(self.db.storna_consumi_preventivo(self.pid), [])
+        for materiale_id, giacenza in self._giacenze().items():
+            self.assertAlmostEqual(giacenza, prima[materiale_id])
+        # Lavoro ripreso: si può scaricare di nuovo
+        self.assertEqual(len(self.db.scarica_consumi_preventivo(self.pid)), 2)
+        self.assertEqual(len(self.db.get_scarichi_preventivo(self.pid)), 2)
+
+    def test_giacenza_insufficiente_nessun_movimento(self):
+        self.assertIs(self.db.scarica_consumi_preventivo(self.pid, fornitori={self.m1: "POCO"}), False)
+        self.assertEqual(self.db.get_scarichi_preventivo(self.pid), [])
+        ids = self.db.scarica_consumi_preventivo(self.pid, fornitori={self.m1: "POCO"}, verifica_giacenza=False)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.m1, "POCO")[0], 0.0)
+
+    def test_preventivo_senza_materiali(self):
+        pid = self.db.add_preventivo(_preventivo_data())
+        self.assertEqual(self.db.scarica_consumi_preventivo(pid), [])
+        self.assertEqual(self.db.get_scarichi_preventivo(pid), [])
+
+
+# ===========================================================================
+# 22. Checkpoint mensili e giacenza a una data (get_giacenza_al)
+# ===========================================================================
+
+class TestGiacenzaAlCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.mid = self.db.add_materiale("CKP_A", 0.3, 20.0)
+        self.legacy = self.db.add_materiale("CKP_LEGACY", 0.3, 20.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F1", 10.0, 0.0, 100.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F2", 10.0, 0.0, 100.0)
+        oggi = datetime.now()
+        # (giorni fa, materiale, tipo, quantità, fornitore)
+        self.storico = [(400, self.mid, 'carico', 100.0, "F1"), (380, self.legacy, 'carico', 12.0, ""),
+                        (200, self.mid, 'scarico', 30.0, "F1"), (150, self.mid, 'carico', 40.0, "F2"),
+                        (70, self.mid, 'scarico', 5.5, "F2"), (40, self.legacy, 'scarico', 2.0, ""),
+                        (0, self.mid, 'carico', 1.0, "F1")]
+        conn = self.db._connect()
+        self.ids = []
+        for giorni, materiale_id, tipo, quantita, fornitore in self.storico:
+            mov = self.db.registra_movimento(materiale_id, tipo, quantita, fornitore_nome=fornitore)
+            conn.execute("UPDATE movimenti_magazzino SET data = ? WHERE id = ?",
+                         ((oggi - timedelta(days=giorni)).isoformat(), mov))
+            self.ids.append(mov)
+        # Le date spostate indietro rendono falso il checkpoint del mese scritto durante la
+        # registrazione: si riparte come un database aggiornato con uno storico già presente
+        conn.execute("DROP TABLE giacenze_checkpoint")
+        conn.execute("PRAGMA user_version = 9")
+        conn.commit()
+        self.db.init_database()
+
+    def _ripeti_storico(self, limite):
+        """Riferimento: rilettura completa dei movimenti prima di limite, in ordine, con lo
+        scarico fermo a 0 come in registra_movimento"""
+        giacenze = {}
+        for materiale_id, fornitore, tipo, quantita, data in self.db._connect().execute(
+                "SELECT materiale_id, fornitore_nome, tipo, quantita, data FROM movimenti_magazzino ORDER BY data, id"):
+            if data < limite:
+                chiave = (materiale_id, fornitore)
+                giacenza = giacenze.get(chiave, 0.0)
+                giacenze[chiave] = giacenza + quantita if tipo == 'carico' else max(giacenza - quantita, 0)
+        return giacenze
+
+    def _movimento(self, giorni_fa, tipo, quantita, fornitore="F1"):
+        mov = self.db.registra_movimento(self.mid, tipo, quantita, fornitore_nome=fornitore)
+        conn = self.db._connect()
+        conn.execute("UPDATE movimenti_magazzino SET data = ? WHERE id = ?",
+                     ((datetime.now() - timedelta(days=giorni_fa)).isoformat(), mov))
+        conn.commit()
+        return mov
+
+    def _assert_come_storico(self, quando):
+        limite = self.db._limite_data(quando)
+        attese = {k: v for k, v in self._ripeti_storico(limite).items()}
+        ottenute = {(r[0], r[1]): r[2] for r in self.db.get_giacenza_al(quando)}
+        for chiave, valore in attese.items():
+            self.assertAlmostEqual(ottenute.get(chiave, 0.0), valore, msg=f"{quando} {chiave}")
+        for chiave, valore in ottenute.items():
+            self.assertAlmostEqual(valore, attese.get(chiave, 0.0), msg=f"{quando} {chiave}")
+
+    def test_checkpoint_dai_contatori_del_momento(self):
+        # La migrazione non ricostruisce i mesi passati all'indietro dai contatori
+        conn = self.db._connect()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM giacenze_checkpoint").fetchone()[0], 0)
+        db = make_db()
+        mid = db.add_materiale("CKP_NUOVO", 0.3, 20.0, giacenza=4.0)
+        db.add_fornitore_a_materiale(mid, "F1", 10.0, 0.0, 100.0)
+        db.registra_movimento(mid, 'carico', 10.0, fornitore_nome="F1")
+        db.registra_movimento(mid, 'scarico', 3.0, fornitore_nome="F1")
+        mese = datetime.now().strftime("%Y-%m-01T00:00:00")
+        # Contatori di prima del primo movimento del mese, non toccati dai successivi
+        self.assertEqual(db._connect().execute(
+            "SELECT data, fornitore_nome, giacenza FROM giacenze_checkpoint WHERE materiale_id = ? ORDER BY 2",
+            (mid,)).fetchall(), [(mese, "", 4.0), (mese, "F1", 0.0)])
+
+    def test_scarico_oltre_giacenza(self):
+        # Carico 10, scarico 15 (il contatore si ferma a 0), carico 5: prima dello scarico
+        # c'erano 10, non 15 (contatore attuale 5 più lo scarico meno il carico)
+        mid = self.db.add_materiale("CKP_OLTRE", 0.3, 20.0)
+        self.db.add_fornitore_a_materiale(mid, "F1", 10.0, 0.0, 100.0)
+        self.mid = mid
+        self._movimento(100, 'carico', 10.0)
+        # Checkpoint scritto in avanti dai contatori di quel momento
+        cursor = self.db._connect().cursor()
+        self.db._scrivi_checkpoint(cursor, (datetime.now() - timedelta(days=95)).isoformat())
+        self.db._connect().commit()
+        self._movimento(90, 'scarico', 15.0)
+        self._movimento(80, 'carico', 5.0)
+        oggi = datetime.now()
+        for giorni, attesa in ((97, 10.0), (92, 10.0), (85, 0.0), (70, 5.0)):
+            self.assertEqual(self.db.get_giacenza_al(oggi - timedelta(days=giorni), materiale_id=mid),
+                             [(mid, "", 0.0), (mid, "F1", attesa)], giorni)
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(mid, "F1")[0], 5.0)
+
+    def test_uguale_alla_rilettura_completa(self):
+        oggi = datetime.now()
+        for giorni in (500, 399, 390, 250, 200, 120, 60, 45, 35, 10, 1):
+            self._assert_come_storico(oggi - timedelta(days=giorni))
+            self._assert_come_storico((oggi - timedelta(days=giorni)).date())
+        self._assert_come_storico(oggi + timedelta(days=1))
+
+    def test_dopo_modifica_ed_eliminazione_di_movimenti_vecchi(self):
+        self.db.modifica_movimento(self.ids[0], 90.0, "")
+        self.db.elimina_movimento(self.ids[4])
+        oggi = datetime.now()
+        for giorni in (390, 180, 100, 30, 1):
+            self._assert_come_storico(oggi - timedelta(days=giorni))
+
+    def test_rinomina_fornitore_segue_lo_storico(self):
+        self.db.add_fornitore("F1")
+        self.db.rename_fornitore("F1", "F1_NUOVO")
+        righe = self.db.get_giacenza_al(datetime.now() - timedelta(days=300), materiale_id=self.mid)
+        self.assertEqual([(r[1], r[2]) for r in righe if r[1]], [("F1_NUOVO", 100.0), ("F2", 0.0)])
+
+    def test_giacenze_periodo(self):
+        oggi = datetime.now()
+        inizio, fine = (oggi - timedelta(days=210)).isoformat(), (oggi - timedelta(days=60)).isoformat()
+        righe = {r[0]: r for r in self.db.get_giacenze_periodo(inizio, fine)}
+        _, nome, iniziale, carichi, scarichi, finale = righe[self.mid]
+        self.assertEqual((nome, iniziale, carichi, scarichi, finale), ("CKP_A", 100.0, 40.0, 35.5, 104.5))
+        self.assertEqual(righe[self.legacy][2:], (12.0, 0.0, 0.0, 12.0))
+        # La giacenza finale di oggi coincide con quella di get_scorte
+        attuali = {r[0]: r[2] for r in self.db.get_scorte()}
+        for materiale_id, riga in ((r[0], r) for r in self.db.get_giacenze_periodo(inizio, oggi.isoformat())):
+            self.assertAlmostEqual(riga[5], attuali[materiale_id])
+
+    def test_reset_cancella_i_checkpoint(self):
+        self.db.reset_tutte_giacenze()
+        self.assertEqual(self.db._connect().execute("SELECT COUNT(*) FROM giacenze_checkpoint").fetchone()[0], 0)
+        self.assertTrue(all(r[2] == 0 for r in self.db.get_giacenza_al(datetime.now() - timedelta(days=100))))
+
+
+# ===========================================================================
+# 23. Controllo giacenze contro i movimenti (verifica_giacenze)
+# ===========================================================================
+
+class TestVerificaGiacenze(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.mid = self.db.add_materiale("VG_A", 0.3, 20.0)
+        self.legacy = self.db.add_materiale("VG_LEGACY", 0.3, 20.0, giacenza=5.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F1", 10.0, 0.0, 100.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F2", 10.0, 0.0, 100.0)
+        self.carico = self.db.registra_movimento(self.mid, 'carico', 50.0, fornitore_nome="F1")
+        self.scarico = self.db.registra_movimento(self.mid, 'scarico', 12.5, fornitore_nome="F1")
+        self.db.registra_movimenti_batch([
+            {'materiale_id': self.mid, 'tipo': 'carico', 'quantita': 8.0, 'fornitore_nome': "F2"},
+            {'materiale_id': self.legacy, 'tipo': 'scarico', 'quantita': 2.0},
+        ])
+
+    def _altera(self, sql, *parametri):
+        """Modifica diretta di un contatore, come una deriva accumulata nel tempo"""
+        conn = self.db._connect()
+        conn.execute(sql, parametri)
+        conn.commit()
+
+    def test_giacenze_allineate_ai_movimenti(self):
+        self.assertEqual(self.db.verifica_giacenze(), [])
+        # La giacenza iniziale del materiale legacy non viene dai movimenti ma è attesa
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.legacy, "")[0], 3.0)
+
+    def test_differenza_segnalata_e_riparata(self):
+        self._altera("UPDATE materiale_fornitori SET giacenza = 99 WHERE materiale_id = ? AND fornitore_nome = 'F1'",
+                     self.mid)
+        self._altera("UPDATE materiali SET giacenza = 0 WHERE id = ?", self.legacy)
+        attese = [(self.mid, "VG_A", "F1", 99.0, 37.5), (self.legacy, "VG_LEGACY", "", 0.0, 3.0)]
+        self.assertEqual(self.db.verifica_giacenze(), attese)
+        # Senza riparare i materiali restano da verificare
+        self.assertEqual(self.db.verifica_giacenze(incrementale=True), attese)
+        self.assertEqual(self.db.verifica_giacenze(ripara=True), attese)
+        self.assertEqual(self.db.verifica_giacenze(), [])
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.mid, "F1")[0], 37.5)
+        # Il riepilogo scorte segue la riparazione (trigger)
+        self.assertEqual(self.db.verifica_scorte_materiali(ripara=False), [])
+
+    def test_scarico_oltre_giacenza_allineato(self):
+        # Carico 10, scarico 15 (il contatore si ferma a 0), carico 5: la giacenza vera è 5,
+        # non MAX(10 - 15 + 5, 0) = 0
+        self.db.add_fornitore_a_materiale(self.mid, "F9", 10.0, 0.0, 100.0)
+        self.db.registra_movimento(self.mid, 'carico', 10.0, fornitore_nome="F9")
+        self.db.registra_movimento(self.mid, 'scarico', 15.0, fornitore_nome="F9")
+        self.db.registra_movimento(self.mid, 'carico', 5.0, fornitore_nome="F9")
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.mid, "F9")[0], 5.0)
+        self.assertEqual(self.db.verifica_giacenze(incrementale=True), [])
+        # La riparazione non tocca un contatore giusto
+        self.assertEqual(self.db.verifica_giacenze(ripara=True), [])
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.mid, "F9")[0], 5.0)
+        # Anche con il materiale legacy e uno scarico oltre la giacenza di apertura
+        self.db.registra_movimento(self.legacy, 'scarico', 10.0)
+        self.db.registra_movimento(self.legacy, 'carico', 1.5)
+        self.assertEqual(self.db.verifica_giacenze(), [])
+
+    def test_incrementale_solo_materiali_toccati(self):
+        self.db.verifica_giacenze()
+        conn = self.db._connect()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM giacenze_da_verificare").fetchone()[0], 0)
+        self.assertEqual(self.db.verifica_giacenze(incrementale=True), [])
+        self.db.registra_movimento(self.legacy, 'carico', 1.0)
+        self.assertEqual([r[0] for r in conn.execute("SELECT materiale_id FROM giacenze_da_verificare")],
+                         [self.legacy])
+        # Deriva su un materiale non toccato: la verifica incrementale non lo guarda
+        self._altera("UPDATE materiale_fornitori SET giacenza = 1 WHERE materiale_id = ?", self.mid)
+        conn.execute("DELETE FROM giacenze_da_verificare WHERE materiale_id = ?", (self.mid,))
+        conn.commit()
+        self.assertEqual(self.db.verifica_giacenze(incrementale=True), [])
+        self.assertEqual(len(self.db.verifica_giacenze()), 2)
+
+    def test_modifiche_e_rinomine_restano_allineate(self):
+        self.db.modifica_movimento(self.carico, 40.0, "rettifica")
+        self.db.elimina_movimento(self.scarico)
+        mf_f2 = next(r[0] for r in self.db.get_fornitori_per_materiale(self.mid) if r[1] == "F2")
+        self.db.update_fornitore_materiale(mf_f2, "F3", 10.0, 0.0, 100.0)
+        self.db.add_fornitore("F1")
+        self.assertTrue(self.db.rename_fornitore("F1", "F1_NUOVO"))
+        self.assertEqual(self.db.verifica_giacenze(), [])
+        self.assertEqual(self.db.get_giacenza_scorta_fornitore(self.mid, "F1_NUOVO")[0], 40.0)
+
+    def test_fornitore_aggiunto_con_storico(self):
+        # Fornitore rimosso e aggiunto di nuovo: riparte da 0 nonostante i vecchi movimenti
+        mf_f2 = next(r[0] for r in self.db.get_fornitori_per_materiale(self.mid) if r[1] == "F2")
+        self.db.delete_fornitore_materiale(mf_f2)
+        self.db.add_fornitore_a_materiale(self.mid, "F2", 10.0, 0.0, 100.0)
+        self.assertEqual(self.db.verifica_giacenze(), [])
+
+    def test_migrazione_su_database_esistente(self):
+        # Contatori già diversi dai movimenti prima dell'aggiornamento: diventano il punto di partenza
+        self._altera("UPDATE materiale_fornitori SET giacenza = giacenza + 7 WHERE materiale_id = ?", self.mid)
+        conn = self.db._connect()
+        conn.execute("DROP TABLE giacenze_iniziali")
+        conn.execute("PRAGMA user_version = 10")
+        conn.commit()
+        self.db.init_database()
+        self.assertEqual(self.db.verifica_giacenze(), [])
+        self.db.registra_movimento(self.mid, 'scarico', 1.0, fornitore_nome="F1")
+        self.assertEqual(self.db.verifica_giacenze(incrementale=True), [])
+
+    def test_reset_azzera_il_controllo(self):
+        self.db.reset_tutte_giacenze()
+        conn = self.db._connect()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM giacenze_iniziali").fetchone()[0], 0)
+        self.assertEqual(self.db.verifica_giacenze(), [])
+
+
+# ===========================================================================
+# 24. Previsioni di consumo e riordino (get_previsioni_scorte / get_ordini_suggeriti)
+# ===========================================================================
+
+class TestPrevisioniScorte(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.mid = self.db.add_materiale("PRV_A", 0.3, 20.0)
+        self.fermo = self.db.add_materiale("PRV_FERMO", 0.3, 20.0)
+        self.db.add_fornitore_a_materiale(self.mid, "CARO", 12.0, 0.0, 0.0)
+        self.db.add_fornitore_a_materiale(self.mid, "ECONOMICO", 9.0, 0.0, 0.0)
+        self.db.add_fornitore_a_materiale(self.mid, "SENZA_PREZZO", 0.0, 0.0, 0.0)
+        self.db.update_materiale_scorte(self.mid, 20.0, 100.0)
+        self.db.update_materiale_scorte(self.fermo, 5.0, 0.0)
+        # (giorni fa, tipo, quantità, preventivo): 60 m² consumati in 30 giorni, 10 stornati
+        self._movimenti([(29, 'carico', 100.0, None), (20, 'scarico', 30.0, 7),
+                         (10, 'scarico', 40.0, 8), (5, 'carico', 10.0, 8)])
+
+    def _movimenti(self, storico):
+        conn = self.db._connect()
+        for giorni, tipo, quantita, preventivo_id in storico:
+            mov = self.db.registra_movimento(self.mid, tipo, quantita, preventivo_id=preventivo_id,
+                                             fornitore_nome="CARO")
+            conn.execute("UPDATE movimenti_magazzino SET data = ? WHERE id = ?",
+                         ((datetime.now() - timedelta(days=giorni)).isoformat(), mov))
+        conn.commit()
+
+    def _previsione(self, materiale_id, **kwargs):
+        return next(r for r in self.db.get_previsioni_scorte(**kwargs) if r[0] == materiale_id)
+
+    def test_consumo_copertura_ed_esaurimento(self):
+        _, nome, giacenza, consumo, copertura, esaurimento, da_ordinare, _, fornitore, prezzo = \
+            self._previsione(self.mid)
+        self.assertEqual((nome, giacenza), ("PRV_A", 40.0))
+        self.assertAlmostEqual(consumo, 2.0)
+        self.assertAlmostEqual(copertura, 20.0)
+        self.assertEqual(esaurimento, datetime.now().date() + timedelta(days=20))
+        self.assertFalse(da_ordinare)
+        # Fornitore più conveniente tra quelli con un prezzo
+        self.assertEqual((fornitore, prezzo), ("ECONOMICO", 9.0))
+
+    def test_finestra_storico(self):
+        # Ultimi 15 giorni: 40 scaricati, 10 stornati
+        self.assertAlmostEqual(self._previsione(self.mid, giorni_storico=15)[3], 2.0)
+        self.assertAlmostEqual(self._previsione(self.mid, giorni_storico=12)[3], 30.0 / 12)
+
+    def test_riordino_entro_tempo_di_consegna(self):
+        r = self._previsione(self.mid, giorni_riordino=25)
+        self.assertTrue(r[6])
+        # All'arrivo restano 40 - 2×25 → 0: si ordina fino alla scorta massima
+        self.assertAlmostEqual(r[7], 100.0)
+        ordini = self.db.get_ordini_suggeriti(giorni_riordino=25)
+        # Prima i materiali senza fornitori, poi per fornitore
+        self.assertEqual([r[:6] for r in ordini], [("", self.fermo, "PRV_FERMO", 5.0, 0.0, 0.0),
+                                                   ("ECONOMICO", self.mid, "PRV_A", 100.0, 9.0, 900.0)])
+
+    def test_sotto_scorta_minima_senza_consumi(self):
+        _, _, giacenza, consumo, copertura, esaurimento, da_ordinare, quantita, fornitore, _ = \
+            self._previsione(self.fermo)
+        self.assertEqual((giacenza, consumo, copertura, esaurimento), (0.0, 0.0, None, None))
+        # Senza scorta massima l'obiettivo è la scorta minima
+        self.assertEqual((da_ordinare, quantita, fornitore), (True, 5.0, ""))
+        self.assertEqual([r[1] for r in self.db.get_ordini_suggeriti()], [self.fermo])
+
+    def test_cache_fino_al_prossimo_movimento(self):
+        letture = []
+        originale = self.db._dati_previsioni
+        self.db._dati_previsioni = lambda *a: letture.append(1) or originale(*a)
+        prima = self.db.get_previsioni_scorte()
+        self.assertEqual(self.db.get_previsioni_scorte(), prima)
+        self.assertEqual(len(letture), 1)
+
+        self.db.registra_movimento(self.mid, 'scarico', 10.0, fornitore_nome="CARO")
+        self.assertEqual(self._previsione(self.mid)[2], 30.0)
+        self.assertEqual(len(letture), 2)
+
+        # Movimento da un altro PC (un'altra connessione allo stesso file)
+        altro = DatabaseManager(db_path=self.db.db_path)
+        altro.registra_movimento(self.mid, 'carico', 5.0, fornitore_nome="CARO")
+        altro.close()
+        self.assertEqual(self._previsione(self.mid)[2], 35.0)
+        self.assertEqual(len(letture), 3)
+
+
+# ===========================================================================
+# 25. Valorizzazione del magazzino a costo medio e FIFO (get_valorizzazione_periodo)
+# ===========================================================================
+
+class TestValorizzazione(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.mid = self.db.add_materiale("VAL_A", 0.3, 30.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F10", 10.0, 0.0, 0.0)
+        self.db.add_fornitore_a_materiale(self.mid, "F20", 20.0, 0.0, 0.0)
+        self.conn = self.db._connect()
+
+    def _movimento(self, giorni_fa, tipo, quantita, fornitore):
+        mov = self.db.registra_movimento(self.mid, tipo, quantita, fornitore_nome=fornitore)
+        self.conn.execute("UPDATE movimenti_magazzino SET data = ? WHERE id = ?",
+                          ((datetime.now() - timedelta(days=giorni_fa)).isoformat(), mov))
+        self.conn.commit()
+        return mov
+
+    def _valore(self, metodo, inizio=None, fine=None):
+        inizio = inizio or (datetime.now() - timedelta(days=3650)).isoformat()
+        fine = fine or datetime.now().isoformat()
+        return next(r for r in self.db.get_valorizzazione_periodo(inizio, fine, metodo) if r[0] == self.mid)
+
+    def test_costo_medio_e_fifo(self):
+        self._movimento(30, 'carico', 10.0, "F10")
+        self._movimento(20, 'carico', 10.0, "F20")
+        self._movimento(10, 'scarico', 15.0, "F10")
+        self.assertEqual(self._valore('medio')[2:], (15.0, 225.0, 5.0, 75.0))
+        self.assertEqual(self._valore('fifo')[2:], (15.0, 200.0, 5.0, 100.0))
+
+    def test_prezzo_registrato_sul_movimento(self):
+        self._movimento(20, 'carico', 10.0, "F10")
+        # Un aumento successivo del prezzo non cambia il valore dei carichi già fatti
+        mf = next(r[0] for r in self.db.get_fornitori_per_materiale(self.mid) if r[1] == "F10")
+        self.db.update_fornitore_materiale(mf, "F10", 50.0, 0.0, 0.0)
+        self.assertEqual(self._valore('fifo')[4:], (10.0, 100.0))
+        self.db.registra_movimento(self.mid, 'carico', 1.0, fornitore_nome="F10")
+        self.assertEqual(self._valore('fifo')[4:], (11.0, 150.0))
+
+    def test_giacenza_di_apertura_valorizzata(self):
+        legacy = self.db.add_materiale("VAL_LEGACY", 0.3, 30.0, prezzo_fornitore=4.0, giacenza=10.0)
+        riga = next(r for r in self.db.get_valorizzazione_periodo("2000-01-01", datetime.now().isoformat())
+                    if r[0] == legacy)
+        self.assertEqual(riga[2:], (0.0, 0.0, 10.0, 40.0))
+
+    def test_metodo_sconosciuto(self):
+        self.assertEqual(self.db.get_valorizzazione_periodo("2025-01-01", "2025-12-31", "lifo"), [])
+
+    def test_strati_mensili_riusati_e_invalidati(self):
+        rng = random.Random(7)
+        ids = [self._movimento(400 - 4 * i, 'carico' if rng.random() < 0.5 else 'scarico',
+                               round(rng.uniform(1, 20), 2), rng.choice(["F10", "F20"])) for i in range(90)]
+        self.conn.execute("UPDATE movimenti_magazzino SET prezzo = ROUND(prezzo + id % 3, 2)")
+        self.conn.commit()
+        oggi = datetime.now()
+        periodi = [((oggi - timedelta(days=g + 30)).isoformat(), (oggi - timedelta(days=g)).isoformat())
+                   for g in (300, 200, 120, 45, 0)]
+
+        def da_zero():
+            self.conn.execute("DELETE FROM valorizzazione_mesi")
+            self.conn.execute("DELETE FROM valorizzazione_strati")
+            self.conn.commit()
+            return {(metodo, p): self.db.get_valorizzazione_periodo(*p, metodo)
+                    for metodo in ("medio", "fifo") for p in periodi}
+
+        attesi = da_zero()
+        self.assertGreater(self.conn.execute("SELECT COUNT(*) FROM valorizzazione_mesi").fetchone()[0], 20)
+        # Dai mesi salvati: stessi risultati
+        for (metodo, p), righe in attesi.items():
+            self.assertEqual(self.db.get_valorizzazione_periodo(*p, metodo), righe)
+
+        # Un movimento vecchio modificato invalida i mesi successivi
+        data = self.conn.execute("SELECT data FROM movimenti_magazzino WHERE id = ?", (ids[30],)).fetchone()[0]
+        self.db.modifica_movimento(ids[30], 3.0, "")
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM valorizzazione_mesi WHERE data > ?",
+                                           (data,)).fetchone()[0], 0)
+        dopo = {(metodo, p): self.db.get_valorizzazione_periodo(*p, metodo) for metodo, p in attesi}
+        self.assertEqual(dopo, da_zero())
+        self.assertNotEqual(dopo, attesi)
+
+    def _mesi_salvati(self):
+        return self.conn.execute("SELECT COUNT(*) FROM valorizzazione_mesi").fetchone()[0]
+
+    def test_giacenza_di_apertura_invalida_i_mesi_salvati(self):
+        self._movimento(90, 'carico', 10.0, "F10")
+        self._movimento(60, 'scarico', 4.0, "F10")
+        self._valore('fifo')
+        self.assertGreater(self._mesi_salvati(), 0)
+        nuovo = self.db.add_materiale("VAL_NUOVO", 0.3, 30.0, prezzo_fornitore=3.0, giacenza=7.0)
+        self.assertEqual(self._mesi_salvati(), 0)
+        righe = self.db.get_valorizzazione_periodo("2000-01-01", datetime.now().isoformat(), 'fifo')
+        self.assertEqual(next(r for r in righe if r[0] == nuovo)[2:], (0.0, 0.0, 7.0, 21.0))
+        # Un nuovo movimento riscrive la riga di apertura ma non la cambia: i mesi restano
+        self._valore('fifo')
+        salvati = self._mesi_salvati()
+        self.db.registra_movimento(self.mid, 'carico', 1.0, fornitore_nome="F10")
+        self.assertEqual(self._mesi_salvati(), salvati)
+
+    def test_database_occupato_non_blocca_il_report(self):
+        import time
+        self._movimento(90, 'carico', 10.0, "F10")
+        self._movimento(60, 'carico', 10.0, "F20")
+        self._movimento(30, 'scarico', 15.0, "F10")
+        altra = sqlite3.connect(self.db.db_path, isolation_level=None)
+        self.addCleanup(altra.close)
+        altra.execute("BEGIN IMMEDIATE")
+        inizio = time.perf_counter()
+        self.assertEqual(self._valore('fifo')[2:], (15.0, 200.0, 5.0, 100.0))
+        self.assertLess(time.perf_counter() - inizio, 1.0)
+        altra.execute("COMMIT")
+        # Cache non salvata, timeout della connessione ripristinato
+        self.assertEqual(self._mesi_salvati(), 0)
+        self.assertEqual(self.conn.execute("PRAGMA busy_timeout").fetchone()[0],
+                         self.db.profilo_storage['busy_timeout'])
+        self.assertEqual(self._valore('fifo')[2:], (15.0, 200.0, 5.0, 100.0))
+        self.assertGreater(self._mesi_salvati(), 0)
+
+
+# ===========================================================================
+# 26. Riprezzatura dei preventivi con i prezzi attuali (riprezza_preventivi)
+# ===========================================================================
+
+class TestRiprezzaturaPreventivi(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db()
+        self.db.add_materiale("RP_A", 0.5, 10.0)
+        self.db.add_materiale("RP_B", 0.3, 20.0)
+        self.conn = self.db._connect()
+
+    def _preventivo(self, strati, cliente="Cliente RP", prezzi=None):
+        """Preventivo calcolato come lo salva PreventivoWindow: strati = [(nome, diametro, giri)]"""
+        prezzi = prezzi or {"RP_A": 10.0, "RP_B": 20.0}
+        prev = Preventivo()
+        prev.costi_accessori = 5.0
+        prev.minuti_taglio = 30.0
+        for nome, diametro, giri in strati:
+            m = MaterialeCalcolato()
+            m.materiale_nome = nome
+            m.diametro, m.lunghezza, m.giri, m.spessore = diametro, 1000.0, giri, 0.5
+            m.costo_materiale = prezzi.get(nome, 7.0)
+            m.ricalcola_tutto()
+            prev.materiali_calcolati.append(m)
+        prev.ricalcola_tutto()
+        dati = prev.to_dict()
+        dati.update(nome_cliente=cliente, prezzo_cliente=100.0)
+        return self.db.add_preventivo(dati), prev
+
+    def _cambia_prezzo(self, nome, prezzo):
+        self.conn.execute("UPDATE materiali SET prezzo = ? WHERE nome = ?", (prezzo, nome))
+        self.conn.commit()
+
+    def test_prezzi_invariati_nessun_impatto(self):
+        self._preventivo([("RP_A", 100.0, 3), ("RP_B", 50.0, 2)])
+        self.assertEqual(self.db.riprezza_preventivi(), ([], []))
+
+    def test_impatto_uguale_ad_aggiorna_prezzi(self):
+        pid, prev = self._preventivo([("RP_A", 100.0, 3), ("RP_B", 50.0, 2)])
+        self._preventivo([("RP_B", 80.0, 1)], cliente="Altro")
+        self._cambia_prezzo("RP_A", 15.0)
+        preventivi, clienti = self.db.riprezza_preventivi()
+
+        # Stesso ricalcolo di PreventivoWindow.aggiorna_prezzi_materiali
+        finale_attuale = prev.preventivo_finale
+        prev.materiali_calcolati[0].costo_materiale = 15.0
+        for m in prev.materiali_calcolati:
+            m.ricalcola_tutto()
+        prev.ricalcola_tutto()
+        self.assertEqual(preventivi, [(pid, pid, 1, "Cliente RP", finale_attuale, prev.preventivo_finale, None)])
+        self.assertEqual(clienti, [("Cliente RP", 1, finale_attuale, prev.preventivo_finale)])
+        # Senza applica non si scrive nulla
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM preventivi").fetchone()[0], 2)
+
+    def test_applica_crea_revisioni(self):
+        pid, _ = self._preventivo([("RP_A", 100.0, 3)])
+        self._cambia_prezzo("RP_A", 12.0)
+        preventivi, _ = self.db.riprezza_preventivi(applica=True, note_revisione="Listino 2026")
+        revisione_id = preventivi[0][6]
+        rev = self.db.get_preventivo_by_id(revisione_id)
+        self.assertEqual((rev['preventivo_originale_id'], rev['numero_revisione'], rev['note_revisione']),
+                         (pid, 2, "Listino 2026"))
+        self.assertEqual(rev['preventivo_finale'], preventivi[0][5])
+        self.assertEqual(rev['prezzo_cliente'], 100.0)
+        self.assertEqual(rev['materiali_utilizzati'][0]['costo_materiale'], 12.0)
+        self.assertAlmostEqual(self.db.get_materiali_preventivo(revisione_id)[0][7],
+                               rev['materiali_utilizzati'][0]['costo_totale'])
+        # L'ultima revisione è ora allineata: un secondo giro non trova nulla
+        self.assertEqual(self.db.riprezza_preventivi(applica=True), ([], []))
+
+    def test_solo_ultima_revisione(self):
+        pid, prev = self._preventivo([("RP_A", 100.0, 3)])
+        dati = prev.to_dict()
+        dati.update(nome_cliente="Cliente RP", prezzo_cliente=100.0)
+        rev = self.db.add_revisione_preventivo(pid, dati)
+        self._cambia_prezzo("RP_A", 11.0)
+        preventivi, _ = self.db.riprezza_preventivi()
+        self.assertEqual([(r[0], r[1], r[2]) for r in preventivi], [(rev, pid, 2)])
+
+    def test_materiale_non_in_anagrafica_resta_invariato(self):
+        self._preventivo([("RP_SCONOSCIUTO", 100.0, 3)])
+        self._cambia_prezzo("RP_A", 99.0)
+        self.assertEqual(self.db.riprezza_preventivi(), ([], []))
+
+
+# ===========================================================================
+# 27. Calcolo a colonne contro i metodi scalari (models.calcolo_colonne)
+# ===========================================================================
+
+def _valore_casuale(rng, massimo):
+    """Numero casuale con i casi limite dei campi dei modelli: zero, interi, negativi"""
+    caso = rng.random()
+    if caso < 0.1:
+        return 0.0
+    if caso < 0.2:
+        return float(rng.randint(-5, int(massimo)))
+    if caso < 0.3:
+        return -rng.uniform(0, massimo)
+    return rng.uniform(0, massimo)
+
+
+class TestCalcoloColonne(unittest.TestCase):
+
+    N_STRATI = 1_000_000
+    LOTTO = 50_000
+
+    def _strati(self, rng, n):
+        """Colonne casuali per n strati; arrotondamento e alias prezzo spesso a zero"""
+        return {
+            'diametro': [_valore_casuale(rng, 500) for _ in range(n)],
+            'lunghezza': [_valore_casuale(rng, 5000) for _ in range(n)],
+            'giri': [rng.randint(-2, 30) for _ in range(n)],
+            'spessore': [_valore_casuale(rng, 3) for _ in range(n)],
+            'costo_materiale': [_valore_casuale(rng, 80) for _ in range(n)],
+            'arrotondamento_manuale': [_valore_casuale(rng, 3000) if rng.random() < 0.3 else 0.0 for _ in range(n)],
+            'prezzo': [_valore_casuale(rng, 80) if rng.random() < 0.3 else 0.0 for _ in range(n)],
+            'lunghezza_utilizzata': [_valore_casuale(rng, 10) for _ in range(n)],
+        }
+
+    @staticmethod
+    def _scalare(colonne, i):
+        m = MaterialeCalcolato()
+        for campo, colonna in colonne.items():
+            setattr(m, campo, colonna[i])
+        m.ricalcola_tutto()
+        return m
+
+    def test_materiali_uguali_ai_metodi_scalari(self):
+        rng = random.Random(25)
+        for _ in range(self.N_STRATI // self.LOTTO):
+            colonne = self._strati(rng, self.LOTTO)
+            calcolati = calcola_materiali(**colonne)
+            scalari = [self._scalare(colonne, i) for i in range(self.LOTTO)]
+            for campo in CAMPI_MATERIALE:
+                # Uguaglianza esatta: stesso ordine delle operazioni dei metodi scalari
+                self.assertEqual(calcolati[campo], [getattr(m, campo) for m in scalari], campo)
+
+    def test_colonne_opzionali_come_oggetto_nuovo(self):
+        colonne = self._strati(random.Random(7), 1000)
+        for campo in ('arrotondamento_manuale', 'prezzo', 'lunghezza_utilizzata'):
+            del colonne[campo]
+        calcolati = calcola_materiali(**colonne)
+        scalari = [self._scalare(colonne, i) for i in range(1000)]
+        for campo in CAMPI_MATERIALE:
+            self.assertEqual(calcolati[campo], [getattr(m, campo) for m in scalari], campo)
+
+    def test_preventivi_uguali_ai_metodi_scalari(self):
+        rng = random.Random(26)
+        campi = ('costi_accessori', 'minuti_taglio', 'minuti_avvolgimento', 'minuti_pulizia',
+                 'minuti_rettifica', 'minuti_imballaggio')
+        preventivi, maggiorazione, inizi = [], [], []
+        for _ in range(20_000):
+            prev = Preventivo()
+            for campo in campi:
+                setattr(prev, campo, _valore_casuale(rng, 200))
+            inizi.append(len(maggiorazione))
+            for _ in range(rng.randint(0, 12)):  # anche preventivi senza materiali
+                m = MaterialeCalcolato()
+                m.maggiorazione = _valore_casuale(rng, 500)
+                prev.materiali_calcolati.append(m)
+                maggiorazione.append(m.maggiorazione)
+            prev.ricalcola_tutto()
+            preventivi.append(prev)
+        totali = calcola_preventivi(maggiorazione, inizi,
+                                    *([getattr(p, campo) for p in preventivi] for campo in campi))
+        for campo in CAMPI_PREVENTIVO:
+            self.assertEqual(totali[campo], [getattr(p, campo) for p in preventivi], campo)
+
+
 # ===========================================================================
 # Entry point
 # ===========================================================================
@@ -27,6 +27,8 @@ from PyQt5.QtWidgets import (QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton,
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont, QColor
 from ui.responsive import get_metrics
+from ui.filtro_ricerca import FiltroRicerca, estende_ricerca
+from ui.preventivi_model import CAMPI_RICERCA, parole_ricerca, corrisponde_ricerca
 
 class ConfrontoPreventiviWindow(QMainWindow):
     def __init__(self, db_manager, parent=None):
@@ -210,7 +212,14 @@ class ConfrontoPreventiviWindow(QMainWindow):
                 border-color: #4299e1;
             }
         """)
-        self.input_filtro.textChanged.connect(self.filtra_preventivi)
+        # Filtro dopo una pausa di battitura; allungando il testo restringe i risultati già trovati
+        self.filtro_ricerca = FiltroRicerca(
+            self.input_filtro, self._cerca_preventivi,
+            chiave=lambda: self.combo_clienti.currentData(),
+            # un numero da solo cerca anche l'id esatto: "1" → "12" non è un sottoinsieme
+            restringe=lambda prima, dopo: estende_ricerca(prima, dopo) and not prima.isdigit(),
+        )
+        self._parole_preventivi = {}
         filtro_layout.addWidget(self.input_filtro, 1)
 
         self.content_layout.addLayout(filtro_layout)
@@ -290,16 +299,7 @@ class ConfrontoPreventiviWindow(QMainWindow):
         self.combo_clienti.addItem("-- Tutti i clienti --", None)
 
         try:
-            preventivi_raw = self.db_manager.get_all_preventivi()
-            clienti = set()
-            for prev_tuple in preventivi_raw:
-                # prev_tuple è (id, data_creazione, preventivo_finale, prezzo_cliente,
-                #               nome_cliente, numero_ordine, descrizione, codice, numero_revisione)
-                nome_cliente = prev_tuple[4].strip() if len(prev_tuple) > 4 and prev_tuple[4] else ''
-                if nome_cliente:
-                    clienti.add(nome_cliente)
-
-            for cliente in sorted(clienti):
+            for cliente in self.db_manager.get_nomi_clienti_distinti():
                 self.combo_clienti.addItem(cliente, cliente)
 
             self.combo_clienti.currentIndexChanged.connect(self.filtra_preventivi)
@@ -309,89 +309,67 @@ class ConfrontoPreventiviWindow(QMainWindow):
 
     def filtra_preventivi(self):
         """Filtra i preventivi in base al cliente e al testo di ricerca"""
-        self.lista_preventivi.clear()
+        self.filtro_ricerca.aggiorna()
 
+    def _cerca_preventivi(self, testo_filtro, candidati):
+        """Richiamato da FiltroRicerca: cerca nel database o, se il testo allunga
+        una ricerca precedente, tra i suoi risultati (stessa regola per parole)"""
+        self.lista_preventivi.clear()
         cliente_selezionato = self.combo_clienti.currentData()
-        testo_filtro = self.input_filtro.text().lower().strip()
 
         try:
-            preventivi_raw = self.db_manager.get_all_preventivi()
-            preventivi_filtrati = []
-
-            for prev_tuple in preventivi_raw:
-                # prev_tuple è (id, data_creazione, preventivo_finale, prezzo_cliente,
-                #               nome_cliente, numero_ordine, descrizione, codice, numero_revisione)
-                id_prev = prev_tuple[0]
-                data_creazione = prev_tuple[1]
-                preventivo_finale = prev_tuple[2]
-                prezzo_cliente = prev_tuple[3]
-                nome_cliente = prev_tuple[4] if len(prev_tuple) > 4 else ''
-                numero_ordine = prev_tuple[5] if len(prev_tuple) > 5 else ''
-                descrizione = prev_tuple[6] if len(prev_tuple) > 6 else ''
-                codice = prev_tuple[7] if len(prev_tuple) > 7 else ''
-                numero_revisione = prev_tuple[8] if len(prev_tuple) > 8 else 1
-
-                # Filtro per cliente
-                if cliente_selezionato:
-                    if nome_cliente.strip() != cliente_selezionato:
-                        continue
-
-                # Filtro per testo (cerca in TUTTI i campi)
-                if testo_filtro:
-                    # Crea una stringa con tutti i valori
-                    valori_da_cercare = [
-                        str(id_prev),
-                        str(data_creazione),
-                        str(preventivo_finale),
-                        str(prezzo_cliente),
-                        str(nome_cliente),
-                        str(numero_ordine),
-                        str(descrizione),
-                        str(codice),
-                        str(numero_revisione),
-                        "originale" if numero_revisione == 1 else "revisionato",
-                        "revisione" if numero_revisione > 1 else ""
-                    ]
-
-                    testo_completo = " ".join(valori_da_cercare).lower()
-
-                    if testo_filtro not in testo_completo:
-                        continue
-
-                preventivi_filtrati.append(prev_tuple)
-
-            # Mostra/nascondi label "nessun preventivo"
-            if len(preventivi_filtrati) == 0:
-                self.lista_preventivi.setVisible(False)
-                self.label_nessun_preventivo.setVisible(True)
+            if candidati is None:
+                # Cliente e testo (indice full-text, anche per iniziali) filtrati dal database
+                preventivi_filtrati = self.db_manager.search_preventivi(
+                    testo_filtro, {'cliente': cliente_selezionato})
             else:
-                self.lista_preventivi.setVisible(True)
-                self.label_nessun_preventivo.setVisible(False)
-
-                # Popola la lista
-                for prev_tuple in preventivi_filtrati:
-                    id_prev = prev_tuple[0]
-                    data_creazione = prev_tuple[1]
-                    preventivo_finale = prev_tuple[2]
-                    nome_cliente = prev_tuple[4] if len(prev_tuple) > 4 else 'N/A'
-                    descrizione = prev_tuple[6] if len(prev_tuple) > 6 else 'N/A'
-                    numero_revisione = prev_tuple[8] if len(prev_tuple) > 8 else 1
-
-                    tipo_preventivo = "Originale" if numero_revisione == 1 else f"Revisione {numero_revisione}"
-
-                    testo = (f"ID: {id_prev} - "
-                            f"{nome_cliente} - "
-                            f"{descrizione} - "
-                            f"€{preventivo_finale:.2f} - "
-                            f"{data_creazione} - "
-                            f"{tipo_preventivo}")
-
-                    item = QListWidgetItem(testo)
-                    item.setData(Qt.UserRole, id_prev)
-                    self.lista_preventivi.addItem(item)
-
+                preventivi_filtrati = [p for p in candidati
+                                       if corrisponde_ricerca(self._parole_preventivo(p), testo_filtro)]
         except Exception as e:
             QMessageBox.warning(self, "Errore", f"Errore nel caricamento preventivi: {str(e)}")
+            return None
+
+        # Mostra/nascondi label "nessun preventivo"
+        if len(preventivi_filtrati) == 0:
+            self.lista_preventivi.setVisible(False)
+            self.label_nessun_preventivo.setVisible(True)
+        else:
+            self.lista_preventivi.setVisible(True)
+            self.label_nessun_preventivo.setVisible(False)
+
+            # Popola la lista a lotti: la finestra resta reattiva mentre si scrive
+            self.filtro_ricerca.a_lotti(preventivi_filtrati, self._aggiungi_preventivo_lista)
+
+        return preventivi_filtrati
+
+    def _parole_preventivo(self, prev_tuple):
+        """Parole cercabili di un preventivo (in cache per id)"""
+        parole = self._parole_preventivi.get(prev_tuple[0])
+        if parole is None:
+            parole = parole_ricerca(" ".join(str(prev_tuple[c] or '') for c in CAMPI_RICERCA))
+            self._parole_preventivi[prev_tuple[0]] = parole
+        return parole
+
+    def _aggiungi_preventivo_lista(self, prev_tuple):
+        id_prev = prev_tuple[0]
+        data_creazione = prev_tuple[1]
+        preventivo_finale = prev_tuple[2]
+        nome_cliente = prev_tuple[4] if len(prev_tuple) > 4 else 'N/A'
+        descrizione = prev_tuple[6] if len(prev_tuple) > 6 else 'N/A'
+        numero_revisione = prev_tuple[8] if len(prev_tuple) > 8 else 1
+
+        tipo_preventivo = "Originale" if numero_revisione == 1 else f"Revisione {numero_revisione}"
+
+        testo = (f"ID: {id_prev} - "
+                f"{nome_cliente} - "
+                f"{descrizione} - "
+                f"€{preventivo_finale:.2f} - "
+                f"{data_creazione} - "
+                f"{tipo_preventivo}")
+
+        item = QListWidgetItem(testo)
+        item.setData(Qt.UserRole, id_prev)
+        self.lista_preventivi.addItem(item)
 
     def seleziona_preventivo(self, numero_preventivo):
         """Seleziona un preventivo e passa alla fase successiva"""
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+© 2025 RCS - Software Proprietario
+Filtro Ricerca - Controller comune dei campi "Cerca"
+Uso riservato esclusivamente a RCS
+
+FiltroRicerca raccoglie i tasti premuti in un campo di ricerca e lancia il filtro
+una sola volta quando l'utente si ferma (RITARDO_MS). Se il nuovo testo allunga
+quello precedente i risultati sono un sottoinsieme dei precedenti: il filtro
+riceve quelli come candidati invece di ripartire da tutti gli elementi.
+Il riempimento delle viste lunghe si fa a lotti (a_lotti), un lotto per giro del
+ciclo eventi: una nuova ricerca ferma i lotti ancora in coda di quella vecchia.
+"""
+
+# type: ignore
+# pyright: reportUnknownParameterType=false, reportMissingParameterType=false
+# pyright: reportUnknownMemberType=false, reportUnknownVariableType=false
+# pyright: reportUnknownArgumentType=false, reportAttributeAccessIssue=false
+
+from PyQt5.QtCore import QObject, QTimer
+
+# Pausa di battitura dopo cui parte il filtro
+RITARDO_MS = 250
+
+# Elementi aggiunti alla vista per ogni giro del ciclo eventi
+DIMENSIONE_LOTTO = 100
+
+
+def estende_ricerca(precedente, nuovo):
+    """True se i risultati di `nuovo` sono per forza tra quelli di `precedente`:
+    il nuovo testo allunga il precedente (maiuscole ignorate)."""
+    precedente = precedente.lower()
+    return bool(precedente) and nuovo.lower().startswith(precedente)
+
+
+class FiltroRicerca(QObject):
+    """Filtro differito e incrementale di un campo di ricerca.
+
+    filtra(testo, candidati) -> risultati
+        candidati è None se il filtro deve ripartire da tutti gli elementi,
+        altrimenti la lista dei risultati di una ricerca più corta di cui `testo`
+        è l'estensione. Il valore restituito viene tenuto per le ricerche successive.
+    chiave() -> valore degli altri filtri della finestra (combo, ecc.): se cambia
+        i risultati tenuti non valgono più.
+    restringe(precedente, nuovo) -> True se si può partire dai risultati di
+        `precedente` (default estende_ricerca).
+    """
+
+    def __init__(self, campo, filtra, chiave=None, restringe=estende_ricerca,
+                 ritardo_ms=RITARDO_MS, parent=None):
+        # Senza parent vive quanto il campo (le finestre che ricreano i widget lo buttano con loro)
+        super().__init__(parent if parent is not None else campo)
+        self.campo = campo
+        self._filtra = filtra
+        self._chiave = chiave or (lambda: None)
+        self._restringe = restringe
+        self._generazione = 0
+        # Ricerche precedenti (testo, risultati), ognuna prefisso della successiva
+        self._risultati = []
+        self._chiave_risultati = None
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(ritardo_ms)
+        self._timer.timeout.connect(self._esegui)
+
+        # Lotti della vista ancora da aggiungere (timer figlio: muore con il filtro)
+        self._lotti = None
+        self._timer_lotti = QTimer(self)
+        self._timer_lotti.setSingleShot(True)
+        self._timer_lotti.setInterval(0)
+        self._timer_lotti.timeout.connect(self._prossimo_lotto)
+        campo.textChanged.connect(self.richiedi)
+
+    # =================== RICHIESTE ===================
+
+    def richiedi(self, *args):
+        """Un tasto premuto: riavvia l'attesa e ferma il lavoro in corso"""
+        self._generazione += 1
+        self._timer.start()
+
+    def subito(self, *args):
+        """Filtra adesso (cambio di combo, apertura finestra)"""
+        self._timer.stop()
+        self._generazione += 1
+        self._esegui()
+
+    def ferma(self):
+        """La vista passa ad altro: annulla il filtro in attesa e i lotti in coda"""
+        self._timer.stop()
+        self._generazione += 1
+
+    def invalida(self):
+        """I dati sotto sono cambiati: la prossima ricerca riparte da tutti gli elementi"""
+        self._risultati = []
+
+    def aggiorna(self):
+        """Ricarica dopo una modifica dei dati e filtra subito"""
+        self.invalida()
+        self.subito()
+
+    def attuale(self, generazione):
+        """True se nessuna ricerca è partita dopo quella con questa generazione"""
+        return generazione == self._generazione
+
+    # =================== ESECUZIONE ===================
+
+    def _esegui(self):
+        testo = self.campo.text().strip()
+        chiave = self._chiave()
+        if chiave != self._chiave_risultati:
+            self._risultati = []
+            self._chiave_risultati = chiave
+
+        # Tieni solo le ricerche di cui il nuovo testo è un'estensione (o lo stesso testo)
+        while self._risultati and not (self._risultati[-1][0] == testo
+                                       or self._restringe(self._risultati[-1][0], testo)):
+            self._risultati.pop()
+        candidati = self._risultati[-1][1] if self._risultati else None
+
+        risultati = self._filtra(testo, candidati)
+        if risultati is None:
+            self._risultati = []
+            return
+        if self._risultati and self._risultati[-1][0] == testo:
+            self._risultati[-1] = (testo, risultati)
+        else:
+            self._risultati.append((testo, risultati))
+
+    def a_lotti(self, elementi, aggiungi, fine=None, dimensione=DIMENSIONE_LOTTO):
+        """Chiama aggiungi(elemento) a lotti, uno per giro del ciclo eventi, così la
+        finestra resta reattiva; si ferma se nel frattempo parte un'altra ricerca.
+        fine() viene chiamata dopo l'ultimo lotto (non se la ricerca è superata)."""
+        self._lotti = (self._generazione, list(elementi), 0, aggiungi, fine, dimensione)
+        self._prossimo_lotto()
+
+    def _prossimo_lotto(self):
+        if self._lotti is None:
+            return
+        generazione, elementi, inizio, aggiungi, fine, dimensione = self._lotti
+        if not self.attuale(generazione):
+            self._lotti = None
+            return
+        for elemento in elementi[inizio:inizio + dimensione]:
+            aggiungi(elemento)
+        if inizio + dimensione < len(elementi):
+            self._lotti = (generazione, elementi, inizio + dimensione, aggiungi, fine, dimensione)
+            self._timer_lotti.start()
+        else:
+            self._lotti = None
+            if fine is not None:
+                fine()
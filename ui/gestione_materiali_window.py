@@ -16,6 +16,7 @@ from PyQt5.QtCore import Qt, pyqtSignal, QSize
 from PyQt5.QtGui import QFont, QColor, QPainter, QBrush, QPen
 from ui.materiale_ui_components import NoScrollDoubleSpinBox
 from ui.responsive import get_metrics
+from ui.filtro_ricerca import FiltroRicerca
 
 
 # ---------------------------------------------------------------------------
@@ -274,7 +275,7 @@ class GestioneMaterialiWindow(QMainWindow):
         search_row.addWidget(QLabel("Cerca:"))
         self.search_edit = QLineEdit()
         self.search_edit.setPlaceholderText("Inserisci nome materiale...")
-        self.search_edit.textChanged.connect(self._applica_filtri)
+        self.filtro_materiali = FiltroRicerca(self.search_edit, self._filtra_materiali)
         search_row.addWidget(self.search_edit)
         lista_inner.addLayout(search_row)
 
@@ -490,16 +491,23 @@ class GestioneMaterialiWindow(QMainWindow):
             self.lista_materiali.addItem(item)
 
         self.lbl_conteggio.setText(f"{self.lista_materiali.count()} materiali caricati")
+        self._nomi_materiali = [mat[1].lower() for mat in self.materiali_data]
         self._applica_filtri()
 
     def _applica_filtri(self):
-        """Applica filtro di ricerca per nome."""
-        search_text = self.search_edit.text().lower()
-        for i in range(self.lista_materiali.count()):
-            item = self.lista_materiali.item(i)
-            mat = item.data(Qt.UserRole)
-            nome = mat[1].lower()
-            item.setHidden(search_text not in nome)
+        """Applica filtro di ricerca per nome (lista appena ricaricata: riparte da tutte le righe)."""
+        self.filtro_materiali.aggiorna()
+
+    def _filtra_materiali(self, testo, candidati):
+        """Richiamato da filtro_materiali. Le righe fuori dai candidati sono già nascoste
+        (la lista mostra una ricerca che allunga quella dei candidati): si ricontrollano solo questi."""
+        search_text = testo.lower()
+        righe = range(self.lista_materiali.count()) if candidati is None else candidati
+        visibili = [i for i in righe if search_text in self._nomi_materiali[i]]
+        da_mostrare = set(visibili)
+        for i in righe:
+            self.lista_materiali.item(i).setHidden(i not in da_mostrare)
+        return visibili
 
     def on_materiale_selezionato(self):
         current_item = self.lista_materiali.currentItem()
@@ -16,11 +16,13 @@ from PyQt5.QtWidgets import (QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton,
                              QLineEdit, QTextEdit, QTabWidget, QGridLayout,
                              QTableWidget, QTableWidgetItem, QHeaderView,
                              QListWidget, QListWidgetItem, QAbstractItemView,
-                             QDialogButtonBox)
+                             QDialogButtonBox, QListView, QStackedWidget)
 from PyQt5.QtCore import Qt, pyqtSignal, QDate
 from PyQt5.QtGui import QColor, QPainter, QLinearGradient
 from ui.materiale_ui_components import NoScrollDoubleSpinBox
 from ui.responsive import get_metrics
+from ui.filtro_ricerca import FiltroRicerca
+from ui.scorte_model import ScorteListModel, ScortaDelegate, disegna_barra_scorta
 from datetime import datetime, timedelta
 
 
@@ -40,35 +42,7 @@ class BarraScorta(QWidget):
 
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
-
-        w = self.width()
-        h = self.height()
-        radius = 6
-
-        # Sfondo grigio chiaro
-        painter.setBrush(QColor(226, 232, 240))
-        painter.setPen(Qt.NoPen)
-        painter.drawRoundedRect(0, 0, w, h, radius, radius)
-
-        # Barra riempita
-        if self.percentuale > 0:
-            fill_width = max(int(w * self.percentuale / 100), radius * 2)
-
-            # Colore basato su HSV: 0% = rosso (hue=0), 100% = verde (hue=120)
-            hue = min(self.percentuale, 100) * 1.2
-            color = QColor.fromHsv(int(hue), 180, 200)
-
-            painter.setBrush(color)
-            painter.drawRoundedRect(0, 0, fill_width, h, radius, radius)
-
-        # Testo percentuale
-        painter.setPen(QColor(45, 55, 72))
-        from PyQt5.QtGui import QFont
-        font = QFont("system-ui", 12, QFont.Bold)
-        painter.setFont(font)
-        painter.drawText(0, 0, w, h, Qt.AlignCenter, f"{self.percentuale:.0f}%")
-
+        disegna_barra_scorta(painter, self.rect(), self.percentuale)
         painter.end()
 
 
@@ -200,14 +174,20 @@ class MagazzinoWindow(QMainWindow):
         self.tab_scorte = QWidget()
         self.tab_consumi = QWidget()
         self.tab_fornitori = QWidget()
+        self.tab_ordini = QWidget()
 
         self.tabs.addTab(self.tab_scorte, "Scorte")
         self.tabs.addTab(self.tab_consumi, "Consumi")
+        self.tabs.addTab(self.tab_ordini, "Da Ordinare")
         self.tabs.addTab(self.tab_fornitori, "Fornitori")
 
         self.setup_tab_scorte()
         self.setup_tab_consumi()
+        self.setup_tab_ordini()
         self.setup_tab_fornitori()
+        # Le previsioni restano in cache fino al prossimo movimento: si ricaricano a ogni apertura della tab
+        self.tabs.currentChanged.connect(
+            lambda indice: self.carica_ordini() if self.tabs.widget(indice) is self.tab_ordini else None)
 
         main_layout.addWidget(self.tabs, 1)
 
@@ -291,6 +271,14 @@ class MagazzinoWindow(QMainWindow):
         btn_scarico.setToolTip("Scarico Materiale")
         btn_scarico.clicked.connect(self.apri_dialog_scarico)
 
+        btn_multiplo = QPushButton("Movimento Multiplo")
+        btn_multiplo.setStyleSheet("""
+            QPushButton { background-color: #3182ce; color: #ffffff; min-height: 32px; padding: 5px 14px; }
+            QPushButton:hover { background-color: #2b6cb0; }
+        """)
+        btn_multiplo.setToolTip("Carico/scarico di più righe (es. una consegna) in una sola registrazione")
+        btn_multiplo.clicked.connect(self.apri_dialog_movimento_multiplo)
+
         btn_azzera = QPushButton("Azzera Giacenze")
         btn_azzera.setStyleSheet("""
             QPushButton { background-color: #dd6b20; color: #ffffff; min-height: 32px; padding: 5px 14px; }
@@ -306,11 +294,22 @@ class MagazzinoWindow(QMainWindow):
         """)
         btn_stampa.clicked.connect(self.stampa_inventario)
 
+        btn_verifica = QPushButton("Verifica Giacenze")
+        btn_verifica.setStyleSheet("""
+            QPushButton { background-color: #f7fafc; color: #4a5568;
+                          border: 1px solid #e2e8f0; min-height: 32px; padding: 5px 14px; }
+            QPushButton:hover { background-color: #edf2f7; }
+        """)
+        btn_verifica.setToolTip("Confronta le giacenze registrate con quelle ricostruite dai movimenti")
+        btn_verifica.clicked.connect(self.verifica_giacenze)
+
         row1.addWidget(self.btn_vista_singoli)
         row1.addStretch()
+        row1.addWidget(btn_verifica)
         row1.addWidget(btn_stampa)
         row1.addWidget(btn_carico)
         row1.addWidget(btn_scarico)
+        row1.addWidget(btn_multiplo)
         row1.addWidget(btn_azzera)
 
         # Riga 2: ricerca + filtri
@@ -326,7 +325,10 @@ class MagazzinoWindow(QMainWindow):
                         font-size: 13px; background-color: #ffffff; min-height: 20px; }
             QLineEdit:focus { border-color: #718096; }
         """)
-        self.search_scorte.textChanged.connect(self.carica_scorte)
+        # Filtro dopo una pausa di battitura: allungando il nome restringe le scorte già filtrate
+        self.filtro_scorte = FiltroRicerca(
+            self.search_scorte, self._filtra_scorte,
+            chiave=lambda: (self.combo_filtro_scorte.currentData(), self.combo_fornitore_filtro.currentData()))
 
         lbl_filtro = QLabel("Mostra:")
         lbl_filtro.setStyleSheet("font-weight: 600; font-size: 13px;")
@@ -356,7 +358,34 @@ class MagazzinoWindow(QMainWindow):
         top_container.addLayout(row2)
         layout.addLayout(top_container)
 
-        # Scroll area per le scorte
+        # Pagina 0: lista scorte virtualizzata (il delegate disegna solo le righe visibili)
+        self.stack_scorte = QStackedWidget()
+        pagina_lista = QWidget()
+        lista_layout = QVBoxLayout(pagina_lista)
+        lista_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.lbl_scorte_vuote = QLabel("Nessun materiale presente in magazzino.")
+        self.lbl_scorte_vuote.setAlignment(Qt.AlignCenter)
+        self.lbl_scorte_vuote.setStyleSheet("color: #718096; font-size: 16px; padding: 40px;")
+        self.lbl_scorte_vuote.setVisible(False)
+        lista_layout.addWidget(self.lbl_scorte_vuote)
+
+        self.model_scorte = ScorteListModel(self.db_manager, self)
+        self.delegate_scorte = ScortaDelegate(self)
+        self.delegate_scorte.fornitori_cliccato.connect(self._mostra_fornitori_materiale)
+        self.delegate_scorte.storico_cliccato.connect(self.mostra_storico)
+        self.lista_scorte = QListView()
+        self.lista_scorte.setModel(self.model_scorte)
+        self.lista_scorte.setItemDelegate(self.delegate_scorte)
+        self.lista_scorte.setUniformItemSizes(True)
+        self.lista_scorte.setMouseTracking(True)
+        self.lista_scorte.setSelectionMode(QAbstractItemView.NoSelection)
+        self.lista_scorte.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.lista_scorte.setStyleSheet("QListView { border: none; background-color: transparent; }")
+        lista_layout.addWidget(self.lista_scorte, 1)
+        self.stack_scorte.addWidget(pagina_lista)
+
+        # Pagina 1: dettaglio fornitori di un materiale
         self.scroll_scorte = QScrollArea()
         self.scroll_scorte.setWidgetResizable(True)
         self.scroll_scorte.setStyleSheet("QScrollArea { border: none; background-color: transparent; }")
@@ -365,7 +394,8 @@ class MagazzinoWindow(QMainWindow):
         self.scorte_layout.setContentsMargins(0, 0, 0, 0)
         self.scorte_layout.setSpacing(8)
         self.scroll_scorte.setWidget(self.scorte_container)
-        layout.addWidget(self.scroll_scorte)
+        self.stack_scorte.addWidget(self.scroll_scorte)
+        layout.addWidget(self.stack_scorte)
 
     def _vista_singoli(self):
         self._scorte_vista = 'singoli'
@@ -374,26 +404,48 @@ class MagazzinoWindow(QMainWindow):
 
     def carica_scorte(self):
         """Carica e visualizza le scorte nella vista corrente"""
-        # Pulisci layout
+        self.filtro_scorte.aggiorna()
+
+    def _pulisci_scorte(self):
         while self.scorte_layout.count():
             child = self.scorte_layout.takeAt(0)
             if child.widget():
                 child.widget().deleteLater()
 
-        self._carica_scorte_singoli()
+    def _filtra_scorte(self, testo, candidati):
+        """Richiamato da filtro_scorte: legge le scorte (o restringe quelle della
+        ricerca precedente) e le passa al modello della lista"""
+        self.stack_scorte.setCurrentIndex(0)
+        search_text = testo.lower()
+
+        if candidati is None:
+            scorte = self._leggi_scorte()
+        else:
+            scorte = candidati
+        if search_text:
+            scorte = [m for m in scorte if search_text in m[1].lower()]
+
+        self.model_scorte.imposta_righe(scorte)
+        self.lbl_scorte_vuote.setVisible(not scorte)
+        self.lista_scorte.setVisible(bool(scorte))
+        return scorte
 
-    def _carica_scorte_singoli(self):
-        """Visualizza le scorte dei materiali (aggregate per materiale)"""
+    def _aggiorna_scorta(self, materiale_id):
+        """Dopo un movimento: ridisegna solo la riga del materiale. I risultati di ricerca
+        tenuti dal filtro non valgono più (la prossima ricerca rilegge le scorte)."""
+        self.filtro_scorte.invalida()
+        if self.stack_scorte.currentIndex() != 0 or not self.model_scorte.aggiorna_materiale(materiale_id):
+            self.carica_scorte()
+
+    def _leggi_scorte(self):
+        """Scorte dei materiali (aggregate per materiale) con i filtri Mostra/Fornitore"""
         ordina_per = 'nome'
         scorte = self.db_manager.get_scorte(ordina_per)
 
         # Applica filtri
-        search_text = self.search_scorte.text().lower()
         filtro_val = self.combo_filtro_scorte.currentData()
         fornitore_sel = self.combo_fornitore_filtro.currentData()
 
-        if search_text:
-            scorte = [m for m in scorte if search_text in m[1].lower()]
         if filtro_val == 'basse':
             scorte = [m for m in scorte if m[3] > 0 and m[2] < m[3] * 0.3]
         elif filtro_val == 'alte':
@@ -401,132 +453,16 @@ class MagazzinoWindow(QMainWindow):
         if fornitore_sel:
             ids = self.db_manager.get_materiali_ids_per_fornitore(fornitore_sel)
             scorte = [m for m in scorte if m[0] in ids]
-
-        if not scorte:
-            lbl_vuoto = QLabel("Nessun materiale presente in magazzino.")
-            lbl_vuoto.setAlignment(Qt.AlignCenter)
-            lbl_vuoto.setStyleSheet("color: #718096; font-size: 16px; padding: 40px;")
-            self.scorte_layout.addWidget(lbl_vuoto)
-            self.scorte_layout.addStretch()
-            return
-
-        for mat in scorte:
-            # get_scorte restituisce: id, nome, giacenza_totale, scorta_massima, n_fornitori, prezzo_min, scorta_minima
-            mat_id, nome, giacenza_totale, scorta_massima, n_fornitori, prezzo_min = mat[:6]
-            scorta_minima = mat[6] if len(mat) > 6 else 0.0
-            card = self._crea_card_scorta(mat_id, nome, giacenza_totale, scorta_massima, scorta_minima, n_fornitori, prezzo_min)
-            self.scorte_layout.addWidget(card)
-
-        self.scorte_layout.addStretch()
-
-    def _crea_card_scorta(self, mat_id, nome, giacenza_totale, scorta_massima, scorta_minima, n_fornitori, prezzo_min):
-        """Crea una card per un materiale (giacenza aggregata su tutti i fornitori)"""
-        card = QFrame()
-        card.setStyleSheet("""
-            QFrame {
-                background-color: #ffffff;
-                border: none;
-                border-bottom: 1px solid #f0f0f0;
-            }
-            QFrame:hover { background-color: #fafbfc; }
-        """)
-
-        _cm = get_metrics()
-        card_layout = QHBoxLayout(card)
-        card_layout.setContentsMargins(_cm['mi'], _cm['sf'], _cm['mi'], _cm['sf'])
-        card_layout.setSpacing(_cm['sc'])
-
-        # Nome materiale
-        lbl_nome = QLabel(nome)
-        lbl_nome.setWordWrap(True)
-        lbl_nome.setStyleSheet(f"font-size: {_cm['ft'] - 4}px; font-weight: 700; color: #2d3748; min-width: 140px;")
-        card_layout.addWidget(lbl_nome)
-
-        # Giacenza totale
-        lbl_giacenza = QLabel(f"{giacenza_totale:.2f} m²")
-        lbl_giacenza.setStyleSheet(f"font-size: {_cm['ft'] - 6}px; font-weight: 600; color: #38a169; min-width: 100px;")
-        lbl_giacenza_label = QLabel("Giacenza")
-        lbl_giacenza_label.setStyleSheet("font-size: 11px; color: #a0aec0; font-weight: 500;")
-        giacenza_col = QVBoxLayout()
-        giacenza_col.setSpacing(2)
-        giacenza_col.addWidget(lbl_giacenza_label)
-        giacenza_col.addWidget(lbl_giacenza)
-        card_layout.addLayout(giacenza_col)
-
-        # Numero fornitori
-        forn_text = f"{n_fornitori}" if n_fornitori > 0 else "—"
-        lbl_forn = QLabel(forn_text)
-        lbl_forn.setWordWrap(True)
-        lbl_forn.setStyleSheet(f"font-size: {_cm['ft'] - 6}px; font-weight: 600; color: #4a5568; min-width: 40px;")
-        lbl_forn_label = QLabel("Fornitori")
-        lbl_forn_label.setStyleSheet("font-size: 11px; color: #a0aec0; font-weight: 500;")
-        forn_col = QVBoxLayout()
-        forn_col.setSpacing(2)
-        forn_col.addWidget(lbl_forn_label)
-        forn_col.addWidget(lbl_forn)
-        card_layout.addLayout(forn_col)
-
-        # Scorta minima (se impostata)
-        if scorta_minima > 0 or scorta_massima > 0:
-            lbl_min_val = QLabel(f"min {scorta_minima:.1f} / max {scorta_massima:.1f} m²")
-            lbl_min_val.setStyleSheet("font-size: 12px; color: #718096; min-width: 140px;")
-            card_layout.addWidget(lbl_min_val)
-
-        # Barra scorta
-        percentuale = (giacenza_totale / scorta_massima * 100) if scorta_massima > 0 else 0
-        barra = BarraScorta(percentuale)
-        barra.setMinimumWidth(160)
-        card_layout.addWidget(barra, 1)
-
-        # Bottone fornitori (drill-down)
-        btn_forn = QPushButton("Fornitori")
-        if n_fornitori > 1:
-            btn_forn.setStyleSheet("""
-                QPushButton {
-                    background-color: #ebf8ff; color: #2b6cb0;
-                    border: none; border-radius: 6px;
-                    min-height: 34px; padding: 6px 18px;
-                    font-size: 13px; font-weight: 600;
-                }
-                QPushButton:hover { background-color: #bee3f8; }
-            """)
-            btn_forn.clicked.connect(lambda checked, mid=mat_id, mn=nome: self._mostra_fornitori_materiale(mid, mn))
-        else:
-            btn_forn.setStyleSheet("""
-                QPushButton {
-                    background-color: #f7fafc; color: #cbd5e0;
-                    border: none; border-radius: 6px;
-                    min-height: 34px; padding: 6px 18px;
-                    font-size: 13px; font-weight: 600;
-                }
-            """)
-            btn_forn.setEnabled(False)
-        card_layout.addWidget(btn_forn)
-
-        # Bottone storico
-        btn_storico = QPushButton("Storico")
-        btn_storico.setStyleSheet("""
-            QPushButton {
-                background-color: #f7fafc; color: #4a5568;
-                border: none; border-radius: 6px;
-                min-height: 34px; padding: 6px 18px; font-size: 13px;
-            }
-            QPushButton:hover { background-color: #edf2f7; }
-        """)
-        btn_storico.clicked.connect(lambda checked, mid=mat_id, mn=nome: self.mostra_storico(mid, mn))
-        card_layout.addWidget(btn_storico)
-
-        return card
+        return scorte
 
     def _mostra_fornitori_materiale(self, materiale_id, nome_materiale):
         """Mostra inline (nel pannello scorte) la tabella fornitori del materiale selezionato"""
         fornitori = self.db_manager.get_fornitori_per_materiale(materiale_id)
 
-        # Pulisci layout scorte
-        while self.scorte_layout.count():
-            child = self.scorte_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
+        # Ferma la ricerca in attesa e passa alla pagina dettaglio
+        self.filtro_scorte.ferma()
+        self._pulisci_scorte()
+        self.stack_scorte.setCurrentIndex(1)
 
         # Header: bottone indietro + titolo
         header = QWidget()
@@ -605,76 +541,8 @@ class MagazzinoWindow(QMainWindow):
 
     def stampa_inventario(self):
         """Genera report inventario come tabella HTML e lo mostra in anteprima stampabile"""
-        from datetime import datetime as _dt
-        now = _dt.now().strftime("%d/%m/%Y %H:%M")
-        scorte = self.db_manager.get_scorte('nome')
-
-        # Costruisci la tabella HTML
-        td = 'style="border:1px solid #cbd5e0; padding:8px 12px; font-size:14px;"'
-        td_num = 'style="border:1px solid #cbd5e0; padding:8px 12px; font-size:14px; text-align:right;"'
-        td_sub = 'style="border:1px solid #cbd5e0; padding:6px 12px 6px 28px; font-size:13px; color:#4a5568; background:#f7fafc;"'
-        td_sub_num = 'style="border:1px solid #cbd5e0; padding:6px 12px; font-size:13px; color:#4a5568; text-align:right; background:#f7fafc;"'
-        th = 'style="border:1px solid #a0aec0; padding:10px 12px; background:#edf2f7; font-size:14px; font-weight:bold; text-align:left;"'
-        th_num = 'style="border:1px solid #a0aec0; padding:10px 12px; background:#edf2f7; font-size:14px; font-weight:bold; text-align:right;"'
-
-        rows_html = ""
-        for row in scorte:
-            mat_id, nome, giacenza_totale, scorta_massima, n_fornitori, prezzo_min = row[:6]
-            scorta_minima = row[6] if len(row) > 6 else 0.0
-            pct = f"{(giacenza_totale / scorta_massima * 100):.0f}%" if scorta_massima > 0 else "—"
-
-            rows_html += f"""
-            <tr>
-              <td {td}><b>{nome}</b></td>
-              <td {td_num}><b>{giacenza_totale:.2f}</b></td>
-              <td {td_num}>{scorta_minima:.2f}</td>
-              <td {td_num}>{scorta_massima:.2f}</td>
-              <td {td_num}>{pct}</td>
-              <td {td}>—</td>
-              <td {td_num}>—</td>
-              <td {td_num}>—</td>
-              <td {td_num}>—</td>
-            </tr>"""
-
-            if n_fornitori > 0:
-                fornitori = self.db_manager.get_fornitori_per_materiale(mat_id)
-                for mf in fornitori:
-                    _, forn_nome, _, s_min, s_max, giacenza = mf
-                    pct_f = f"{(giacenza / s_max * 100):.0f}%" if s_max > 0 else "—"
-                    rows_html += f"""
-            <tr>
-              <td {td_sub}></td>
-              <td {td_sub_num}></td>
-              <td {td_sub_num}></td>
-              <td {td_sub_num}></td>
-              <td {td_sub_num}></td>
-              <td {td_sub}>↳ {forn_nome}</td>
-              <td {td_sub_num}>{giacenza:.2f}</td>
-              <td {td_sub_num}>{s_min:.2f}</td>
-              <td {td_sub_num}>{pct_f}</td>
-            </tr>"""
-
-        html = f"""
-        <html><body style="font-family: Arial, sans-serif; margin: 0; padding: 0;">
-        <h2 style="font-size:18px; margin-bottom:4px; margin-top:0;">Inventario Magazzino — Software Aziendale RCS</h2>
-        <p style="font-size:12px; color:#718096; margin-top:0; margin-bottom:8px;">Generato il {now}</p>
-        <table style="border-collapse:collapse; width:100%;">
-          <thead>
-            <tr>
-              <th {th}>Materiale</th>
-              <th {th_num}>Giac. Tot (m²)</th>
-              <th {th_num}>Scorta Min</th>
-              <th {th_num}>Scorta Max</th>
-              <th {th_num}>% Agg.</th>
-              <th {th}>Fornitore</th>
-              <th {th_num}>Giac. Forn (m²)</th>
-              <th {th_num}>Min Forn</th>
-              <th {th_num}>% Forn</th>
-            </tr>
-          </thead>
-          <tbody>{rows_html}</tbody>
-        </table>
-        </body></html>"""
+        from utils.report_inventario import genera_html_inventario
+        html = genera_html_inventario(self.db_manager)
 
         try:
             from PyQt5.QtPrintSupport import QPrinter, QPrintDialog
@@ -763,6 +631,39 @@ class MagazzinoWindow(QMainWindow):
 
         dialog.exec_()
 
+    def verifica_giacenze(self):
+        """Controllo completo delle giacenze contro i movimenti, con riparazione su conferma"""
+        differenze = self.db_manager.verifica_giacenze()
+        if differenze is None:
+            QMessageBox.critical(self, "Errore", "Impossibile completare il controllo delle giacenze.")
+            return
+        if not differenze:
+            QMessageBox.information(self, "Verifica Giacenze",
+                                    "Tutte le giacenze corrispondono ai movimenti registrati.")
+            return
+
+        righe = [f"• {nome}" + (f" ({fornitore})" if fornitore else "")
+                 + f": registrata {registrata:.2f} m², dai movimenti {attesa:.2f} m²"
+                 for _, nome, fornitore, registrata, attesa in differenze]
+        if len(righe) > 20:
+            righe = righe[:20] + [f"... e altre {len(righe) - 20}"]
+        risposta = QMessageBox.question(
+            self,
+            "Verifica Giacenze",
+            f"{len(differenze)} giacenze non corrispondono ai movimenti:\n\n" + "\n".join(righe)
+            + "\n\nRiportarle ai valori ricostruiti dai movimenti?",
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.No
+        )
+        if risposta != QMessageBox.Yes:
+            return
+        if self.db_manager.verifica_giacenze(ripara=True) is None:
+            QMessageBox.critical(self, "Errore", "Si è verificato un errore durante la correzione.")
+            return
+        QMessageBox.information(self, "Completato", "Giacenze corrette.")
+        self.carica_scorte()
+        self.magazzino_aggiornato.emit()
+
     def azzera_tutte_giacenze(self):
         """Azzera la giacenza di tutti i materiali e cancella tutti i movimenti."""
         from PyQt5.QtWidgets import QMessageBox
@@ -934,7 +835,7 @@ class MagazzinoWindow(QMainWindow):
             QMessageBox.information(dialog, "Successo",
                                     f"Movimento registrato: {quantita:.2f} m² {verbo} ({forn_nome}).")
             dialog.accept()
-            self.carica_scorte()
+            self._aggiorna_scorta(mat_id)
             self.magazzino_aggiornato.emit()
 
         btn_conferma.clicked.connect(conferma)
@@ -946,6 +847,169 @@ class MagazzinoWindow(QMainWindow):
         layout.addLayout(btn_layout)
         dialog.exec_()
 
+    def apri_dialog_movimento_multiplo(self):
+        """Dialog per carico/scarico di più righe (materiale, fornitore, quantità, note)
+        registrate tutte insieme con registra_movimenti_batch: o tutte o nessuna"""
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Movimento Multiplo")
+        dialog.resize(860, 480)
+        dialog.setStyleSheet("""
+            QDialog { background-color: #fafbfc; font-family: system-ui, -apple-system, sans-serif; }
+            QLabel { color: #2d3748; font-size: 13px; font-weight: 500; }
+            QComboBox, QDoubleSpinBox, QLineEdit {
+                border: 1px solid #e2e8f0; border-radius: 6px;
+                padding: 4px 8px; font-size: 13px;
+                background-color: #ffffff; color: #2d3748; min-height: 16px;
+            }
+            QPushButton {
+                border: none; border-radius: 6px;
+                font-size: 13px; font-weight: 600;
+                padding: 8px 16px; min-height: 34px;
+            }
+            QTableWidget { background-color: #ffffff; border: 1px solid #e2e8f0; border-radius: 8px; }
+        """)
+
+        layout = QVBoxLayout(dialog)
+        layout.setContentsMargins(20, 16, 20, 16)
+        layout.setSpacing(12)
+
+        # Tipo del movimento, uguale per tutte le righe
+        riga_tipo = QHBoxLayout()
+        lbl_titolo = QLabel("Movimento Multiplo")
+        lbl_titolo.setStyleSheet("font-size: 16px; font-weight: 700;")
+        combo_tipo = QComboBox()
+        combo_tipo.addItem("Carico", 'carico')
+        combo_tipo.addItem("Scarico", 'scarico')
+        riga_tipo.addWidget(lbl_titolo)
+        riga_tipo.addStretch()
+        riga_tipo.addWidget(QLabel("Tipo:"))
+        riga_tipo.addWidget(combo_tipo)
+        layout.addLayout(riga_tipo)
+
+        materiali = [(mat[0], mat[1]) for mat in self.db_manager.get_all_materiali()]
+
+        table = QTableWidget(0, 4)
+        table.setHorizontalHeaderLabels(["Materiale", "Fornitore", "Quantità", "Note"])
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeToContents)
+        table.horizontalHeader().setSectionResizeMode(3, QHeaderView.Stretch)
+        table.verticalHeader().setDefaultSectionSize(40)
+        table.setSelectionBehavior(QAbstractItemView.SelectRows)
+
+        def aggiorna_fornitori(combo_mat, combo_forn):
+            combo_forn.clear()
+            mat_id = combo_mat.currentData()
+            fornitori = self.db_manager.get_fornitori_per_materiale(mat_id) if mat_id else []
+            for _, forn_nome, _, _, _, giacenza in fornitori:
+                combo_forn.addItem(f"{forn_nome}  (giac: {giacenza:.1f} m²)", forn_nome)
+            if not fornitori:
+                combo_forn.addItem("— Nessun fornitore configurato —", "")
+            combo_forn.setEnabled(bool(fornitori))
+
+        def aggiungi_riga():
+            row = table.rowCount()
+            table.insertRow(row)
+            combo_mat = QComboBox()
+            for mat_id, nome in materiali:
+                combo_mat.addItem(nome, mat_id)
+            combo_forn = QComboBox()
+            combo_mat.currentIndexChanged.connect(lambda _: aggiorna_fornitori(combo_mat, combo_forn))
+            aggiorna_fornitori(combo_mat, combo_forn)
+            edit_quantita = NoScrollDoubleSpinBox()
+            edit_quantita.setDecimals(2)
+            edit_quantita.setMaximum(99999.99)
+            edit_quantita.setMinimum(0.01)
+            edit_quantita.setSuffix(" m²")
+            edit_note = QLineEdit()
+            edit_note.setPlaceholderText("Note opzionali...")
+            for col, widget in enumerate((combo_mat, combo_forn, edit_quantita, edit_note)):
+                table.setCellWidget(row, col, widget)
+            table.setCurrentCell(row, 0)
+
+        def rimuovi_riga():
+            row = table.currentRow()
+            if row >= 0:
+                table.removeRow(row)
+
+        def leggi_movimenti():
+            tipo = combo_tipo.currentData()
+            return [{
+                'materiale_id': table.cellWidget(row, 0).currentData(),
+                'tipo': tipo,
+                'quantita': table.cellWidget(row, 2).value(),
+                'note': table.cellWidget(row, 3).text().strip(),
+                'fornitore_nome': table.cellWidget(row, 1).currentData() or "",
+            } for row in range(table.rowCount())]
+
+        layout.addWidget(table)
+
+        btn_righe = QHBoxLayout()
+        btn_aggiungi = QPushButton("+ Aggiungi Riga")
+        btn_rimuovi = QPushButton("Rimuovi Riga")
+        for btn in (btn_aggiungi, btn_rimuovi):
+            btn.setStyleSheet("""
+                QPushButton { background-color: #f7fafc; color: #4a5568; border: 1px solid #e2e8f0; }
+                QPushButton:hover { background-color: #edf2f7; }
+            """)
+            btn_righe.addWidget(btn)
+        btn_righe.addStretch()
+        btn_aggiungi.clicked.connect(aggiungi_riga)
+        btn_rimuovi.clicked.connect(rimuovi_riga)
+        layout.addLayout(btn_righe)
+
+        btn_layout = QHBoxLayout()
+        btn_annulla = QPushButton("Annulla")
+        btn_annulla.setStyleSheet("""
+            QPushButton { background-color: #f7fafc; color: #4a5568; border: 1px solid #e2e8f0; }
+            QPushButton:hover { background-color: #edf2f7; }
+        """)
+        btn_annulla.clicked.connect(dialog.reject)
+        btn_conferma = QPushButton("Registra Movimenti")
+        btn_conferma.setStyleSheet("""
+            QPushButton { background-color: #3182ce; color: #ffffff; }
+            QPushButton:hover { background-color: #2b6cb0; }
+        """)
+
+        def conferma():
+            movimenti = leggi_movimenti()
+            if not movimenti:
+                QMessageBox.warning(dialog, "Attenzione", "Aggiungi almeno una riga.")
+                return
+            senza_fornitore = [str(i + 1) for i, mov in enumerate(movimenti) if not mov['fornitore_nome']]
+            if senza_fornitore:
+                QMessageBox.warning(dialog, "Attenzione",
+                                    f"Seleziona un fornitore (righe {', '.join(senza_fornitore)}).")
+                return
+            errori = self.db_manager.valida_movimenti(movimenti)
+            if errori:
+                QMessageBox.warning(dialog, "Movimenti non validi", "\n".join(errori))
+                return
+
+            ids = self.db_manager.registra_movimenti_batch(movimenti)
+            if ids is False:
+                QMessageBox.critical(dialog, "Errore",
+                                     "Movimenti non registrati: nessuna riga è stata salvata.\n"
+                                     "Le giacenze potrebbero essere cambiate nel frattempo, riprova.")
+                return
+            verbo = "caricati" if combo_tipo.currentData() == 'carico' else "scaricati"
+            totale = sum(mov['quantita'] for mov in movimenti)
+            QMessageBox.information(dialog, "Successo",
+                                    f"{len(ids)} movimenti registrati: {totale:.2f} m² {verbo}.")
+            dialog.accept()
+            for mat_id in dict.fromkeys(mov['materiale_id'] for mov in movimenti):
+                self._aggiorna_scorta(mat_id)
+            self.magazzino_aggiornato.emit()
+
+        btn_conferma.clicked.connect(conferma)
+        btn_layout.addWidget(btn_annulla)
+        btn_layout.addStretch()
+        btn_layout.addWidget(btn_conferma)
+        layout.addLayout(btn_layout)
+
+        aggiungi_riga()
+        dialog.exec_()
+
     # =================== TAB CONSUMI ===================
 
     def setup_tab_consumi(self):
@@ -975,8 +1039,18 @@ class MagazzinoWindow(QMainWindow):
         """)
         btn_aggiorna.clicked.connect(self.carica_consumi)
 
+        lbl_metodo = QLabel("Valorizzazione:")
+        lbl_metodo.setStyleSheet("font-weight: 600;")
+        self.combo_metodo_valore = QComboBox()
+        self.combo_metodo_valore.addItem("Costo medio ponderato", "medio")
+        self.combo_metodo_valore.addItem("FIFO", "fifo")
+        self.combo_metodo_valore.currentIndexChanged.connect(self.carica_consumi)
+
         filtri_layout.addWidget(lbl_periodo)
         filtri_layout.addWidget(self.combo_periodo)
+        filtri_layout.addSpacing(16)
+        filtri_layout.addWidget(lbl_metodo)
+        filtri_layout.addWidget(self.combo_metodo_valore)
         filtri_layout.addStretch()
         filtri_layout.addWidget(btn_aggiorna)
 
@@ -991,6 +1065,26 @@ class MagazzinoWindow(QMainWindow):
         """)
         layout.addWidget(self.lbl_riepilogo_consumi)
 
+        # Giacenza iniziale e finale del periodo per materiale
+        self.tabella_giacenze_periodo = QTableWidget()
+        self.tabella_giacenze_periodo.setColumnCount(7)
+        self.tabella_giacenze_periodo.setHorizontalHeaderLabels(
+            ["Materiale", "Giacenza Iniziale (m²)", "Carichi (m²)", "Scarichi (m²)", "Giacenza Finale (m²)",
+             "Costo Consumi", "Valore Finale"]
+        )
+        self.tabella_giacenze_periodo.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        for col in range(1, 7):
+            self.tabella_giacenze_periodo.horizontalHeader().setSectionResizeMode(col, QHeaderView.ResizeToContents)
+        self.tabella_giacenze_periodo.verticalHeader().setVisible(False)
+        self.tabella_giacenze_periodo.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.tabella_giacenze_periodo.setAlternatingRowColors(True)
+        self.tabella_giacenze_periodo.setStyleSheet("""
+            QTableWidget { border: 1px solid #e2e8f0; border-radius: 8px; }
+            QTableWidget::item { padding: 6px; }
+            QTableWidget::item:alternate { background-color: #f7fafc; }
+        """)
+        layout.addWidget(self.tabella_giacenze_periodo, 1)
+
         # Tabella movimenti individuali
         self.tabella_consumi = QTableWidget()
         self.tabella_consumi.setColumnCount(7)
@@ -1014,7 +1108,7 @@ class MagazzinoWindow(QMainWindow):
             QTableWidget::item:alternate { background-color: #f7fafc; }
         """)
 
-        layout.addWidget(self.tabella_consumi, 1)
+        layout.addWidget(self.tabella_consumi, 2)
 
     def carica_consumi(self):
         """Carica e visualizza i movimenti individuali per il periodo selezionato"""
@@ -1085,16 +1179,39 @@ class MagazzinoWindow(QMainWindow):
             self.tabella_consumi.setCellWidget(row, 6, btn_frame)
             self.tabella_consumi.setRowHeight(row, 44)
 
+        # Giacenze iniziali e finali del periodo (dai checkpoint mensili) con costo dei
+        # consumi e valore finale (dagli strati di costo)
+        giacenze = self.db_manager.get_giacenze_periodo(data_inizio, data_fine)
+        metodo = self.combo_metodo_valore.currentData() or 'medio'
+        valori = {r[0]: r for r in self.db_manager.get_valorizzazione_periodo(data_inizio, data_fine, metodo)}
+        self.tabella_giacenze_periodo.setRowCount(len(giacenze))
+        for row, (materiale_id, nome, iniziale, carichi, scarichi, finale) in enumerate(giacenze):
+            self.tabella_giacenze_periodo.setItem(row, 0, QTableWidgetItem(nome))
+            costo, valore_finale = (valori[materiale_id][3], valori[materiale_id][5]) \
+                if materiale_id in valori else (0.0, 0.0)
+            testi = [f"{v:.2f}" for v in (iniziale, carichi, scarichi, finale)] + \
+                    [f"€ {costo:,.2f}", f"€ {valore_finale:,.2f}"]
+            for col, testo in enumerate(testi, 1):
+                item = QTableWidgetItem(testo)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.tabella_giacenze_periodo.setItem(row, col, item)
+        totale_iniziale = sum(r[2] for r in giacenze)
+        totale_finale = sum(r[5] for r in giacenze)
+        costo_consumi = sum(r[3] for r in valori.values())
+        valore_magazzino = sum(r[5] for r in valori.values())
+
         # Aggiorna riepilogo
         periodo_testo = self.combo_periodo.currentText()
+        giacenze_testo = (f"Giacenza iniziale: {totale_iniziale:.2f} m²  →  finale: {totale_finale:.2f} m²  |  "
+                          f"Costo consumi: € {costo_consumi:,.2f}  |  Valore finale: € {valore_magazzino:,.2f}")
         if movimenti:
             self.lbl_riepilogo_consumi.setText(
                 f"{periodo_testo}:  {len(movimenti)} movimenti  |  "
-                f"Totale scaricato: {totale_scarico:.2f} m²  ({n_scarichi} scarichi)"
+                f"Totale scaricato: {totale_scarico:.2f} m²  ({n_scarichi} scarichi)  |  {giacenze_testo}"
             )
         else:
             self.lbl_riepilogo_consumi.setText(
-                f"{periodo_testo}:  Nessun movimento registrato nel periodo selezionato"
+                f"{periodo_testo}:  Nessun movimento registrato nel periodo selezionato  |  {giacenze_testo}"
             )
 
     def _modifica_movimento(self, movimento_id, quantita_attuale, note_attuale):
@@ -1151,10 +1268,14 @@ class MagazzinoWindow(QMainWindow):
             if nuova_q <= 0:
                 QMessageBox.warning(self, "Errore", "La quantità deve essere maggiore di 0.")
                 return
+            movimento = self.db_manager.get_movimento_by_id(movimento_id)
             ok = self.db_manager.modifica_movimento(movimento_id, nuova_q, edit_note.text().strip())
             if ok:
                 self.carica_consumi()
-                self.carica_scorte()
+                if movimento:
+                    self._aggiorna_scorta(movimento[1])
+                else:
+                    self.carica_scorte()
             else:
                 QMessageBox.critical(self, "Errore", "Errore durante la modifica del movimento.")
 
@@ -1167,10 +1288,14 @@ class MagazzinoWindow(QMainWindow):
             QMessageBox.Yes | QMessageBox.No, QMessageBox.No
         )
         if risposta == QMessageBox.Yes:
+            movimento = self.db_manager.get_movimento_by_id(movimento_id)
             ok = self.db_manager.elimina_movimento(movimento_id)
             if ok:
                 self.carica_consumi()
-                self.carica_scorte()
+                if movimento:
+                    self._aggiorna_scorta(movimento[1])
+                else:
+                    self.carica_scorte()
             else:
                 QMessageBox.critical(self, "Errore", "Errore durante l'eliminazione del movimento.")
 
@@ -1203,6 +1328,103 @@ class MagazzinoWindow(QMainWindow):
 
         return inizio.isoformat(), fine.isoformat()
 
+    # =================== TAB DA ORDINARE ===================
+
+    def setup_tab_ordini(self):
+        layout = QVBoxLayout(self.tab_ordini)
+        layout.setContentsMargins(0, 20, 0, 0)
+        layout.setSpacing(16)
+
+        filtri_layout = QHBoxLayout()
+        lbl_storico = QLabel("Consumo calcolato su:")
+        lbl_storico.setStyleSheet("font-weight: 600;")
+        self.combo_storico_ordini = QComboBox()
+        self.combo_storico_ordini.addItem("Tutto lo storico", None)
+        self.combo_storico_ordini.addItem("Ultimi 6 mesi", 180)
+        self.combo_storico_ordini.addItem("Ultimi 3 mesi", 90)
+        self.combo_storico_ordini.addItem("Ultimo mese", 30)
+        self.combo_storico_ordini.currentIndexChanged.connect(self.carica_ordini)
+
+        lbl_consegna = QLabel("Tempo di consegna:")
+        lbl_consegna.setStyleSheet("font-weight: 600;")
+        self.combo_consegna_ordini = QComboBox()
+        for giorni in (7, 14, 30, 60):
+            self.combo_consegna_ordini.addItem(f"{giorni} giorni", giorni)
+        self.combo_consegna_ordini.setCurrentIndex(1)
+        self.combo_consegna_ordini.currentIndexChanged.connect(self.carica_ordini)
+
+        filtri_layout.addWidget(lbl_storico)
+        filtri_layout.addWidget(self.combo_storico_ordini)
+        filtri_layout.addSpacing(16)
+        filtri_layout.addWidget(lbl_consegna)
+        filtri_layout.addWidget(self.combo_consegna_ordini)
+        filtri_layout.addStretch()
+        layout.addLayout(filtri_layout)
+
+        self.lbl_riepilogo_ordini = QLabel("")
+        self.lbl_riepilogo_ordini.setStyleSheet("""
+            font-size: 15px; font-weight: 600; color: #2d3748;
+            background-color: #fffaf0; border: 1px solid #f6ad55;
+            border-radius: 8px; padding: 12px 16px;
+        """)
+        layout.addWidget(self.lbl_riepilogo_ordini)
+
+        self.tabella_ordini = QTableWidget()
+        self.tabella_ordini.setColumnCount(8)
+        self.tabella_ordini.setHorizontalHeaderLabels(
+            ["Fornitore", "Materiale", "Giacenza (m²)", "Consumo/giorno (m²)", "Esaurimento",
+             "Da Ordinare (m²)", "Prezzo", "Costo Stimato"]
+        )
+        self.tabella_ordini.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.tabella_ordini.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.tabella_ordini.verticalHeader().setVisible(False)
+        self.tabella_ordini.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.tabella_ordini.setAlternatingRowColors(True)
+        self.tabella_ordini.setStyleSheet("""
+            QTableWidget { border: 1px solid #e2e8f0; border-radius: 8px; }
+            QTableWidget::item { padding: 6px; }
+            QTableWidget::item:alternate { background-color: #f7fafc; }
+        """)
+        layout.addWidget(self.tabella_ordini, 1)
+
+    def carica_ordini(self):
+        """Materiali da ordinare per fornitore, dalle previsioni di consumo"""
+        giorni_storico = self.combo_storico_ordini.currentData()
+        giorni_riordino = self.combo_consegna_ordini.currentData() or 14
+        previsioni = {r[0]: r for r in self.db_manager.get_previsioni_scorte(giorni_storico, giorni_riordino)}
+        ordini = self.db_manager.get_ordini_suggeriti(giorni_storico, giorni_riordino)
+
+        self.tabella_ordini.setRowCount(len(ordini))
+        oggi = datetime.now().date()
+        for row, (fornitore, materiale_id, nome, quantita, prezzo, costo, esaurimento) in enumerate(ordini):
+            giacenza, consumo_giornaliero = previsioni[materiale_id][2:4]
+            if esaurimento is None:
+                testo_esaurimento = "—"
+            elif esaurimento <= oggi:
+                testo_esaurimento = "Esaurito"
+            else:
+                testo_esaurimento = f"{esaurimento.strftime('%d/%m/%Y')} ({(esaurimento - oggi).days} gg)"
+            valori = [fornitore or "—", nome, f"{giacenza:.2f}", f"{consumo_giornaliero:.2f}",
+                      testo_esaurimento, f"{quantita:.2f}", f"€ {prezzo:.2f}" if prezzo else "—",
+                      f"€ {costo:,.2f}" if prezzo else "—"]
+            for col, valore in enumerate(valori):
+                item = QTableWidgetItem(valore)
+                if col >= 2:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                if col == 4 and esaurimento is not None and (esaurimento - oggi).days <= giorni_riordino:
+                    item.setForeground(QColor(229, 62, 62))
+                self.tabella_ordini.setItem(row, col, item)
+
+        if ordini:
+            fornitori = {r[0] for r in ordini}
+            totale = sum(r[5] for r in ordini)
+            self.lbl_riepilogo_ordini.setText(
+                f"{len(ordini)} materiali da ordinare da {len(fornitori)} fornitori  |  "
+                f"Costo stimato: € {totale:,.2f}"
+            )
+        else:
+            self.lbl_riepilogo_ordini.setText("Nessun materiale da ordinare: scorte sufficienti per il tempo di consegna")
+
     # =================== TAB FORNITORI ===================
 
     def setup_tab_fornitori(self):
@@ -1248,7 +1470,8 @@ class MagazzinoWindow(QMainWindow):
             if child.widget():
                 child.widget().deleteLater()
 
-        fornitori = self.db_manager.get_all_fornitori()
+        # Conteggi, giacenze e valore di tutti i fornitori in una sola query
+        fornitori = self.db_manager.get_riepilogo_fornitori()
 
         if not fornitori:
             lbl_vuoto = QLabel("Nessun fornitore presente. Aggiungine uno con il pulsante qui sopra.")
@@ -1258,20 +1481,17 @@ class MagazzinoWindow(QMainWindow):
             return
 
         col_count = 3
-        for idx, (forn_id, nome) in enumerate(fornitori):
+        for idx, riepilogo in enumerate(fornitori):
             row = idx // col_count
             col = idx % col_count
-            card = self._crea_card_fornitore(nome)
+            card = self._crea_card_fornitore(*riepilogo[1:])
             self.fornitori_layout.addWidget(card, row, col)
 
         # Spacer per evitare che le card si espandano verticalmente
         self.fornitori_layout.setRowStretch(len(fornitori) // col_count + 1, 1)
 
-    def _crea_card_fornitore(self, nome):
-        """Crea una card cliccabile per un fornitore"""
-        # Conta i materiali del fornitore
-        materiali = self.db_manager.get_scorte_per_fornitore(nome)
-        n_materiali = len(materiali)
+    def _crea_card_fornitore(self, nome, n_materiali, giacenza_totale, n_sotto_scorta, valore):
+        """Crea una card cliccabile per un fornitore (dati da get_riepilogo_fornitori)"""
 
         card = QFrame()
         card.setStyleSheet("""
@@ -1286,7 +1506,7 @@ class MagazzinoWindow(QMainWindow):
             }
         """)
         card.setCursor(Qt.PointingHandCursor)
-        card.setMinimumHeight(120)
+        card.setMinimumHeight(160)
 
         card_layout = QVBoxLayout(card)
         card_layout.setContentsMargins(24, 20, 24, 20)
@@ -1300,6 +1520,14 @@ class MagazzinoWindow(QMainWindow):
         lbl_mat.setStyleSheet("font-size: 13px; color: #718096;")
         lbl_mat.setAlignment(Qt.AlignCenter)
 
+        lbl_giacenza = QLabel(f"{giacenza_totale:.2f} m²  •  € {valore:,.2f}")
+        lbl_giacenza.setStyleSheet("font-size: 13px; color: #4a5568; font-weight: 600;")
+        lbl_giacenza.setAlignment(Qt.AlignCenter)
+
+        lbl_sotto = QLabel(f"{n_sotto_scorta} sotto scorta minima" if n_sotto_scorta else "Scorte in regola")
+        lbl_sotto.setStyleSheet(f"font-size: 12px; color: {'#c53030' if n_sotto_scorta else '#38a169'};")
+        lbl_sotto.setAlignment(Qt.AlignCenter)
+
         btn_row = QHBoxLayout()
         btn_row.setSpacing(8)
 
@@ -1322,6 +1550,8 @@ class MagazzinoWindow(QMainWindow):
 
         card_layout.addWidget(lbl_nome)
         card_layout.addWidget(lbl_mat)
+        card_layout.addWidget(lbl_giacenza)
+        card_layout.addWidget(lbl_sotto)
         card_layout.addLayout(btn_row)
 
         return card
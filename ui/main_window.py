@@ -129,5 +129,8 @@ class MainWindow(QMainWindow):
     def preventivo_salvato(self):
         """Callback chiamato quando un preventivo viene salvato"""
         MainWindowBusinessLogic.preventivo_salvato(self)
-            
-        
\ No newline at end of file
+
+    def closeEvent(self, event):
+        """Chiude le connessioni persistenti al database alla chiusura dell'applicazione"""
+        self.db_manager.close()
+        super().closeEvent(event)
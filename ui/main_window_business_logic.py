@@ -27,12 +27,13 @@ import os
 import json
 import subprocess
 from PyQt5.QtWidgets import (QMessageBox, QDialog, QVBoxLayout, QTextEdit,
-                             QDialogButtonBox, QLabel, QListWidgetItem, QFileDialog)
+                             QDialogButtonBox, QLabel, QFileDialog)
 from PyQt5.QtCore import Qt
 from ui.preventivo_window import PreventivoWindow
 from ui.gestione_materiali_window import GestioneMaterialiWindow
 from ui.magazzino_window import MagazzinoWindow
 from ui.document_utils import DocumentUtils
+from ui.preventivi_model import PreventiviTableModel, PreventiviFilterProxyModel
 
 class MainWindowBusinessLogic:
 
@@ -43,118 +44,78 @@ class MainWindowBusinessLogic:
         window_instance.filtro_cliente.addItem("Tutti i clienti", None)
 
         try:
-            preventivi = window_instance.db_manager.get_all_preventivi()
-            clienti = set()
-            for prev in preventivi:
-                if len(prev) >= 5:
-                    nome_cliente = str(prev[4]).strip() if prev[4] is not None else ''
-                    if nome_cliente:
-                        clienti.add(nome_cliente)
-
-            for cliente in sorted(clienti):
+            for cliente in window_instance.db_manager.get_nomi_clienti_distinti():
                 window_instance.filtro_cliente.addItem(cliente, cliente)
         except Exception as e:
             print(f"Errore nel caricamento clienti filtro: {str(e)}")
 
     @staticmethod
-    def load_preventivi(window_instance):
-        """Carica preventivi o revisioni in base alla modalità di visualizzazione E ai filtri attivi"""
-        window_instance.lista_preventivi.clear()
+    def _preventivo_selezionato(window_instance):
+        """Id del preventivo selezionato nella lista della finestra, o None"""
+        if hasattr(window_instance, '_get_current_preventivo_id'):
+            return window_instance._get_current_preventivo_id()
+        return window_instance.lista_preventivi.currentIndex().data(Qt.UserRole)
 
-        # Ottieni i valori dei filtri
-        filtro_origine_text = window_instance.filtro_origine.currentText()
-        filtro_cliente_data = window_instance.filtro_cliente.currentData()
-        filtro_keyword_text = window_instance.filtro_keyword.text().lower().strip()
+    @staticmethod
+    def _testo_preventivo(riga, modalita):
+        """Testo su più righe di un preventivo nella lista (riga di search_preventivi)"""
+        id_prev, data_creazione, preventivo_finale, prezzo_cliente, nome_cliente, numero_ordine, descrizione, codice, numero_revisione = riga[:9]
+
+        # Formatta la data
+        data_formattata = data_creazione.split('T')[0] if 'T' in data_creazione else data_creazione
+
+        # Nella sezione revisioni: sempre [Revisione]; nella sezione preventivi: Originale o Revisionato
+        if modalita == 'revisioni':
+            prefisso_tipo = "Revisione"
+        elif numero_revisione == 1:
+            prefisso_tipo = "Originale"
+        else:
+            prefisso_tipo = "Revisionato"
+
+        cliente_info = nome_cliente if nome_cliente else "Cliente non specificato"
+        ordine_info = f" | {numero_ordine}" if numero_ordine else ""
+
+        testo = f"#{id_prev:03d} [{prefisso_tipo}] - {data_formattata} - {cliente_info}{ordine_info}"
+        testo += f"\nPreventivo: EUR {preventivo_finale:,.2f} | Cliente: EUR {prezzo_cliente:,.2f}"
+        if descrizione:
+            testo += f"\nDescrizione: {descrizione[:60]}{'...' if len(descrizione) > 60 else ''}"
+        return testo
+
+    @staticmethod
+    def load_preventivi(window_instance):
+        """Carica preventivi o revisioni in base alla modalità di visualizzazione E ai filtri attivi.
+        La lista (QListView) mostra un PreventiviTableModel caricato a pagine mentre si scorre,
+        con i filtri passati alla query da un PreventiviFilterProxyModel."""
+        model = getattr(window_instance, 'model_preventivi', None)
+        if model is None:
+            colonne = [("Preventivo",
+                        lambda r: MainWindowBusinessLogic._testo_preventivo(r, window_instance.modalita_visualizzazione),
+                        Qt.AlignLeft | Qt.AlignVCenter)]
+            model = PreventiviTableModel(window_instance.db_manager, colonne, window_instance)
+            window_instance.model_preventivi = model
+            window_instance.proxy_preventivi = PreventiviFilterProxyModel(window_instance)
+            window_instance.proxy_preventivi.setSourceModel(model)
+            window_instance.lista_preventivi.setModel(window_instance.proxy_preventivi)
 
         if window_instance.modalita_visualizzazione == 'preventivi':
             # Mostra solo preventivi originali (ultima revisione di ogni gruppo)
-            preventivi = window_instance.db_manager.get_all_preventivi_latest()
+            base = {'solo_ultime': True}
         else:
             # Mostra solo le revisioni (escludendo i preventivi originali)
-            preventivi = window_instance.db_manager.get_all_preventivi()
-            # Filtra per mostrare solo le revisioni (numero_revisione > 1)
-            preventivi_filtrati = []
-            for prev in preventivi:
-                if len(prev) >= 9:
-                    numero_revisione = prev[8] if len(prev) > 8 else 1
-                    if numero_revisione > 1:
-                        preventivi_filtrati.append(prev)
-
-            preventivi = preventivi_filtrati
-
-        for preventivo in preventivi:
-            # Formato: id, data_creazione, preventivo_finale, prezzo_cliente,
-            # nome_cliente, numero_ordine, descrizione, codice, numero_revisione
-            if len(preventivo) >= 9:
-                id_prev, data_creazione, preventivo_finale, prezzo_cliente, nome_cliente, numero_ordine, descrizione, codice, numero_revisione = preventivo[:9]
-            else:
-                # Fallback per compatibilità
-                id_prev, data_creazione, preventivo_finale, prezzo_cliente = preventivo[:4]
-                nome_cliente, numero_ordine, descrizione, codice, numero_revisione = "", "", "", "", 1
-
-            # APPLICA FILTRO ORIGINE
-            if filtro_origine_text == "Originali" and numero_revisione != 1:
-                continue  # Salta se non è originale
-            elif filtro_origine_text == "Revisionati" and numero_revisione == 1:
-                continue  # Salta se è originale
-            elif filtro_origine_text == "Modificati" and numero_revisione == 1:
-                continue  # Modificati = Revisionati (numero_revisione > 1)
-
-            # APPLICA FILTRO CLIENTE
-            if filtro_cliente_data and nome_cliente.strip() != filtro_cliente_data:
-                continue  # Salta se il cliente non corrisponde
-
-            # APPLICA FILTRO KEYWORD
-            if filtro_keyword_text:
-                # Cerca la keyword in TUTTI i campi del preventivo
-                campi_ricerca = [
-                    str(id_prev),
-                    str(data_creazione),
-                    str(preventivo_finale),
-                    str(prezzo_cliente),
-                    str(nome_cliente),
-                    str(numero_ordine),
-                    str(descrizione),
-                    str(codice),
-                    str(numero_revisione)
-                ]
-                testo_completo = " ".join(campi_ricerca).lower()
-                if filtro_keyword_text not in testo_completo:
-                    continue  # Salta se la keyword non è trovata
-
-            # Formatta la data
-            data_formattata = data_creazione.split('T')[0] if 'T' in data_creazione else data_creazione
-            
-            # Logica corretta per le etichette con formato migliorato
-            if window_instance.modalita_visualizzazione == 'revisioni':
-                # Nella sezione revisioni: mostra sempre [Revisione] per le revisioni
-                prefisso_tipo = "Revisione"
-                cliente_info = nome_cliente if nome_cliente else "Cliente non specificato"
-                ordine_info = f" | {numero_ordine}" if numero_ordine else ""
-                
-                testo = f"#{id_prev:03d} [{prefisso_tipo}] - {data_formattata} - {cliente_info}{ordine_info}"
-                testo += f"\nPreventivo: EUR {preventivo_finale:,.2f} | Cliente: EUR {prezzo_cliente:,.2f}"
-                if descrizione:
-                    testo += f"\nDescrizione: {descrizione[:60]}{'...' if len(descrizione) > 60 else ''}"
-            else:
-                # Nella sezione preventivi: distingui tra Originale e Revisionato
-                if numero_revisione == 1:
-                    prefisso_tipo = "Originale"
-                else:
-                    prefisso_tipo = "Revisionato"
-                
-                cliente_info = nome_cliente if nome_cliente else "Cliente non specificato"
-                ordine_info = f" | {numero_ordine}" if numero_ordine else ""
-                
-                testo = f"#{id_prev:03d} [{prefisso_tipo}] - {data_formattata} - {cliente_info}{ordine_info}"
-                testo += f"\nPreventivo: EUR {preventivo_finale:,.2f} | Cliente: EUR {prezzo_cliente:,.2f}"
-                if descrizione:
-                    testo += f"\nDescrizione: {descrizione[:60]}{'...' if len(descrizione) > 60 else ''}"
-            
-            item = QListWidgetItem(testo)
-            item.setData(Qt.UserRole, id_prev)  # Salva l'ID del preventivo
-            window_instance.lista_preventivi.addItem(item)
-    
+            base = {'tipo': 'revisionati'}
+
+        # Filtri della finestra insieme a quelli della modalità
+        filtro_origine_text = window_instance.filtro_origine.currentText()
+        window_instance.proxy_preventivi.imposta_filtri(
+            # Modificati = Revisionati (numero_revisione > 1)
+            tipo={"Originali": 'originali', "Revisionati": 'revisionati',
+                  "Modificati": 'revisionati'}.get(filtro_origine_text),
+            cliente=window_instance.filtro_cliente.currentData(),
+            keyword=window_instance.filtro_keyword.text(),
+            base=base,
+            ricarica=True,
+        )
+
     @staticmethod
     def cambia_visualizzazione(window_instance, modalita):
         """Cambia tra visualizzazione Preventivi e Revisioni"""
@@ -227,12 +188,11 @@ class MainWindowBusinessLogic:
     @staticmethod
     def modifica_preventivo(window_instance):
         """Apre un preventivo esistente per la modifica DIRETTA"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione", "Seleziona un preventivo da modificare.")
             return
         
-        preventivo_id = current_item.data(Qt.UserRole)
         window_instance.preventivo_window = PreventivoWindow(
             window_instance.db_manager, 
             window_instance, 
@@ -245,12 +205,11 @@ class MainWindowBusinessLogic:
     @staticmethod
     def crea_revisione(window_instance):
         """Crea una revisione di un preventivo esistente"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione", "Seleziona un preventivo per creare una revisione.")
             return
         
-        preventivo_id = current_item.data(Qt.UserRole)
         
         # Dialog per inserire note sulla revisione
         note_revisione = MainWindowBusinessLogic.richiedi_note_revisione(window_instance)
@@ -270,14 +229,13 @@ class MainWindowBusinessLogic:
     @staticmethod
     def genera_documento_preventivo(window_instance):
         """Genera documento di produzione dal preventivo selezionato"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione",
                               "Seleziona un preventivo dalla lista per generare il documento.")
             return
 
         try:
-            preventivo_id = current_item.data(Qt.UserRole)
 
             # Carica dati preventivo
             preventivo_data = None
@@ -320,11 +278,7 @@ class MainWindowBusinessLogic:
                 }
                 materiali = []
             else:
-                import re
-                testo_item = current_item.text()
-                prima_linea = testo_item.split('\n')[0] if testo_item else ""
-                match = re.search(r'#(\d+)', prima_linea)
-                codice = f"PREV_{match.group(1) if match else preventivo_id:03d}"
+                codice = f"PREV_{preventivo_id:03d}"
                 dati_cliente = {
                     'nome_cliente': '',
                     'numero_ordine': '',
@@ -365,14 +319,13 @@ class MainWindowBusinessLogic:
     @staticmethod
     def anteprima_documento_preventivo(window_instance):
         """Mostra anteprima del documento preventivo nel browser senza salvarlo"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione",
                                 "Seleziona un preventivo dalla lista per visualizzare l'anteprima.")
             return
 
         try:
-            preventivo_id = current_item.data(Qt.UserRole)
 
             # Carica dati preventivo
             preventivo_data = None
@@ -512,12 +465,11 @@ class MainWindowBusinessLogic:
     @staticmethod
     def visualizza_preventivo(window_instance):
         """Visualizza i dettagli del preventivo selezionato"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione", "Seleziona un preventivo da visualizzare.")
             return
         
-        preventivo_id = current_item.data(Qt.UserRole)
         
         # Apre in modalità visualizzazione (sola lettura)
         window_instance.preventivo_window = PreventivoWindow(
@@ -531,12 +483,11 @@ class MainWindowBusinessLogic:
     @staticmethod
     def elimina_preventivo(window_instance):
         """Elimina preventivo utilizzando il metodo del database"""
-        current_item = window_instance.lista_preventivi.currentItem()
-        if not current_item:
+        preventivo_id = MainWindowBusinessLogic._preventivo_selezionato(window_instance)
+        if preventivo_id is None:
             QMessageBox.warning(window_instance, "Attenzione", "Seleziona un preventivo da eliminare.")
             return
         
-        preventivo_id = current_item.data(Qt.UserRole)
 
         # Determina se è una revisione o l'originale per mostrare il messaggio corretto
         prev_data = window_instance.db_manager.get_preventivo_by_id(preventivo_id)
@@ -713,9 +664,16 @@ class MainWindowBusinessLogic:
         if not path_nuovo:
             return
 
-        # Salva il nuovo percorso in config.json
+        # Salva il nuovo percorso in config.json, mantenendo le altre impostazioni (es. storage_profile)
         try:
-            config = {"db_path": path_nuovo}
+            config = {}
+            if os.path.exists(config_path):
+                try:
+                    with open(config_path, "r", encoding="utf-8") as f:
+                        config = json.load(f)
+                except (OSError, ValueError):
+                    config = {}
+            config["db_path"] = path_nuovo
             with open(config_path, "w", encoding="utf-8") as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
         except Exception as e:
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+© 2025 RCS - Software Proprietario
+Preventivi Model - Modello Qt dei preventivi caricato a pagine
+Uso riservato esclusivamente a RCS
+
+Le righe arrivano da DatabaseManager.get_pagina_preventivi (paginazione keyset
+su data_creazione, id): la vista chiede la pagina successiva (canFetchMore /
+fetchMore) solo quando l'utente scorre verso il fondo della lista.
+PreventiviFilterProxyModel passa i filtri della finestra (tipo, cliente, parole
+chiave) alla query del modello; li applica in memoria solo quando restringono
+righe già caricate tutte.
+"""
+
+# type: ignore
+# pyright: reportUnknownParameterType=false, reportMissingParameterType=false
+# pyright: reportUnknownMemberType=false, reportUnknownVariableType=false
+# pyright: reportUnknownArgumentType=false, reportAttributeAccessIssue=false
+
+import re
+import unicodedata
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+from ui.filtro_ricerca import estende_ricerca
+
+# Indici delle colonne restituite da search_preventivi / get_pagina_preventivi
+ID, DATA_CREAZIONE, PREVENTIVO_FINALE, PREZZO_CLIENTE, NOME_CLIENTE, NUMERO_ORDINE, \
+    DESCRIZIONE, CODICE, NUMERO_REVISIONE, N_MODIFICHE, MISURA, FINITURA = range(12)
+
+# Campi in cui cercano le parole chiave (gli stessi dell'indice full-text del database)
+CAMPI_RICERCA = (NOME_CLIENTE, NUMERO_ORDINE, DESCRIZIONE, CODICE, MISURA, FINITURA)
+
+
+def parole_ricerca(testo):
+    """Parole minuscole e senza accenti, come le tokenizza l'indice FTS (unicode61)"""
+    testo = unicodedata.normalize('NFKD', str(testo or '').lower())
+    testo = ''.join(c for c in testo if not unicodedata.combining(c))
+    return re.findall(r'[^\W_]+', testo)  # "_" separa le parole, come in unicode61
+
+
+def corrisponde_ricerca(parole_riga, query):
+    """Stessa regola di search_preventivi: ogni parola della query (anche composta, es.
+    "rg-100") deve comparire nella riga, con l'ultima parte come prefisso."""
+    for parola in query.split():
+        parti = parole_ricerca(parola)
+        if not parti:
+            continue
+        trovata = False
+        for i in range(len(parole_riga) - len(parti) + 1):
+            if (parole_riga[i:i + len(parti) - 1] == parti[:-1]
+                    and parole_riga[i + len(parti) - 1].startswith(parti[-1])):
+                trovata = True
+                break
+        if not trovata:
+            return False
+    return True
+
+
+class PreventiviTableModel(QAbstractTableModel):
+    """Preventivi filtrati, caricati a pagine man mano che la vista scorre.
+
+    colonne: lista di (intestazione, formatta(riga) -> testo, allineamento)
+    """
+
+    DIMENSIONE_PAGINA = 200
+
+    def __init__(self, db_manager, colonne, parent=None):
+        super().__init__(parent)
+        self.db_manager = db_manager
+        self.colonne = colonne
+        self.query = ""
+        self.filtri = {}
+        self._righe = []
+        self._totale = None
+        self._finito = True
+
+    # =================== CARICAMENTO ===================
+
+    def imposta_ricerca(self, query="", filtri=None):
+        """Riparte dalla prima pagina con nuovi filtri"""
+        self.beginResetModel()
+        self.query = query or ""
+        self.filtri = dict(filtri or {})
+        self._righe = []
+        self._totale = None
+        self._finito = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def svuota(self):
+        """Nessuna riga, senza query (filtri che si escludono a vicenda)"""
+        self.beginResetModel()
+        self.query = ""
+        self.filtri = None
+        self._righe = []
+        self._finito = True
+        self.endResetModel()
+
+    def ricarica(self):
+        """Ricarica dalla prima pagina con i filtri correnti"""
+        if self.filtri is None:
+            self.svuota()
+        else:
+            self.imposta_ricerca(self.query, self.filtri)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._finito
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._finito:
+            return
+        dopo = None
+        if self._righe:
+            ultima = self._righe[-1]
+            dopo = (ultima[DATA_CREAZIONE], ultima[ID])
+        pagina = self.db_manager.get_pagina_preventivi(
+            self.query, self.filtri, limit=self.DIMENSIONE_PAGINA, dopo=dopo)
+        self._finito = len(pagina) < self.DIMENSIONE_PAGINA
+        if not pagina:
+            return
+        inizio = len(self._righe)
+        self.beginInsertRows(QModelIndex(), inizio, inizio + len(pagina) - 1)
+        self._righe.extend(pagina)
+        self.endInsertRows()
+
+    def totale(self):
+        """Numero di preventivi che corrispondono ai filtri (anche non ancora caricati): le
+        righe caricate se sono tutte, altrimenti un conteggio per ricerca, tenuto"""
+        if self._finito:
+            return len(self._righe)
+        if self._totale is None:
+            self._totale = self.db_manager.conta_preventivi(self.query, self.filtri)
+        return self._totale
+
+    # =================== ACCESSO ===================
+
+    def riga(self, row):
+        return self._righe[row] if 0 <= row < len(self._righe) else None
+
+    def preventivo_id(self, index):
+        """Id del preventivo all'indice dato, o None"""
+        riga = self.riga(index.row()) if index is not None and index.isValid() else None
+        return riga[ID] if riga else None
+
+    # =================== INTERFACCIA QAbstractTableModel ===================
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._righe)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.colonne)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        riga = self._righe[index.row()]
+        _, formatta, allineamento = self.colonne[index.column()]
+        if role == Qt.DisplayRole:
+            return formatta(riga)
+        if role == Qt.TextAlignmentRole:
+            return int(allineamento)
+        if role == Qt.UserRole:
+            return riga[ID]  # id in ogni colonna → compatibile con currentIndex().data(Qt.UserRole)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and 0 <= section < len(self.colonne):
+            return self.colonne[section][0]
+        return None
+
+
+class PreventiviFilterProxyModel(QSortFilterProxyModel):
+    """Filtri della finestra (Originali/Revisionati, con modifiche, cliente, parole chiave).
+
+    Di norma diventano la query del modello sorgente (get_pagina_preventivi), così ogni
+    pagina caricata è già filtrata e la vista non resta mai senza righe da chiedere.
+    Solo se i nuovi filtri restringono quelli con cui il modello ha caricato tutte le
+    righe (la keyword si allunga) il proxy le filtra in memoria, senza query."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tipo = None
+        self.cliente = None
+        self.keyword = ""
+        self.solo_con_modifiche = False
+        # Filtri fissi della lista (es. solo_ultime), sempre passati alla query
+        self.filtri_base = {}
+        # True se le righe caricate vengono da filtri più larghi di quelli correnti
+        self._in_memoria = False
+        self._parole_righe = {}
+        # Id scartati dai filtri correnti: se la nuova keyword allunga la vecchia restano scartati
+        self._scartati = set()
+
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        self._parole_righe = {}
+        self._scartati = set()
+        model.modelReset.connect(self._parole_righe.clear)
+        model.modelReset.connect(self._scartati.clear)
+
+    def imposta_filtri(self, tipo=None, cliente=None, keyword="", solo_con_modifiche=False,
+                       base=None, ricarica=False):
+        """tipo: None | 'originali' | 'revisionati'; base: nuovi filtri_base (None = invariati).
+        ricarica rilegge il database anche se i filtri non cambiano."""
+        cliente = (cliente or '').strip() or None
+        keyword = (keyword or '').strip()
+        base = self.filtri_base if base is None else dict(base)
+        stato = (tipo, cliente, keyword, solo_con_modifiche, base)
+        if not ricarica and stato == (self.tipo, self.cliente, self.keyword, self.solo_con_modifiche,
+                                      self.filtri_base):
+            return
+        # Restringe solo se cambia la sola keyword, allungandosi (un numero cerca anche
+        # l'id esatto: "1" → "12" non è un sottoinsieme), e il modello ha già tutte le righe
+        restringe = (not ricarica
+                     and (tipo, cliente, solo_con_modifiche, base)
+                     == (self.tipo, self.cliente, self.solo_con_modifiche, self.filtri_base)
+                     and estende_ricerca(self.keyword, keyword) and not self.keyword.isdigit()
+                     and not self.sourceModel().canFetchMore())
+        self.tipo, self.cliente, self.keyword, self.solo_con_modifiche, self.filtri_base = stato
+        if restringe:
+            self._in_memoria = True
+            self.invalidateFilter()
+            return
+        self._in_memoria = False
+        filtri = self.filtri_db()
+        if filtri is None:
+            self.sourceModel().svuota()
+        else:
+            self.sourceModel().imposta_ricerca(self.keyword, filtri)
+
+    def filtri_db(self):
+        """Filtri base e della finestra nel formato di DatabaseManager.get_pagina_preventivi /
+        conta_preventivi; None se si escludono a vicenda (es. base revisionati, tipo originali)"""
+        filtri = dict(self.filtri_base)
+        if self.tipo:
+            if filtri.get('tipo', self.tipo) != self.tipo:
+                return None
+            filtri['tipo'] = self.tipo
+        if self.cliente:
+            filtri['cliente'] = self.cliente
+        if self.solo_con_modifiche:
+            filtri['solo_con_modifiche'] = True
+        return filtri
+
+    def totale(self):
+        """Numero di preventivi che passano i filtri, anche tra quelli non ancora caricati"""
+        if self._in_memoria:
+            return self.rowCount()
+        return self.sourceModel().totale()
+
+    def preventivo_id(self, index):
+        """Id del preventivo all'indice (della vista) dato, o None"""
+        if index is None or not index.isValid():
+            return None
+        return self.sourceModel().preventivo_id(self.mapToSource(index))
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        riga = self.sourceModel().riga(source_row)
+        if riga is None:
+            return False
+        if not self._in_memoria:
+            return True  # già filtrata dalla query
+        if riga[ID] in self._scartati:
+            return False
+        if not self._accetta(riga):
+            self._scartati.add(riga[ID])
+            return False
+        return True
+
+    def _accetta(self, riga):
+        """Filtri della finestra sulla singola riga"""
+        if self.tipo == 'originali' and riga[NUMERO_REVISIONE] != 1:
+            return False
+        if self.tipo == 'revisionati' and riga[NUMERO_REVISIONE] == 1:
+            return False
+        if self.solo_con_modifiche and not riga[N_MODIFICHE]:
+            return False
+        if self.cliente and (riga[NOME_CLIENTE] or '').strip() != self.cliente:
+            return False
+        if self.keyword:
+            if self.keyword.isdigit() and riga[ID] == int(self.keyword):
+                return True
+            parole = self._parole_righe.get(riga[ID])
+            if parole is None:
+                parole = parole_ricerca(" ".join(str(riga[c] or '') for c in CAMPI_RICERCA))
+                self._parole_righe[riga[ID]] = parole
+            return corrisponde_ricerca(parole, self.keyword)
+        return True
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+© 2025 RCS - Software Proprietario
+Scorte Model - Vista virtualizzata delle scorte di magazzino
+Uso riservato esclusivamente a RCS
+
+ScorteListModel tiene le righe di DatabaseManager.get_scorte; ScortaDelegate
+disegna per ogni riga la card del materiale (nome, giacenza, fornitori, barra
+scorta e pulsanti) solo quando la riga è visibile, senza widget per riga.
+Dopo un movimento si rilegge e ridisegna solo la riga del materiale.
+"""
+
+# type: ignore
+# pyright: reportUnknownParameterType=false, reportMissingParameterType=false
+# pyright: reportUnknownMemberType=false, reportUnknownVariableType=false
+# pyright: reportUnknownArgumentType=false, reportAttributeAccessIssue=false
+
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyle
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QEvent, pyqtSignal
+from PyQt5.QtGui import QColor, QPainter, QFont
+from ui.responsive import get_metrics
+
+# Indici delle colonne restituite da get_scorte / get_scorta_materiale
+ID, NOME, GIACENZA_TOTALE, SCORTA_MASSIMA, N_FORNITORI, PREZZO_MIN, SCORTA_MINIMA = range(7)
+
+
+def disegna_barra_scorta(painter, rect, percentuale):
+    """Barra del livello di scorta (0% rosso → 100% verde) con la percentuale al centro"""
+    percentuale = max(0, min(100, percentuale))
+    radius = 6
+    painter.save()
+    painter.setRenderHint(QPainter.Antialiasing)
+
+    # Sfondo grigio chiaro
+    painter.setBrush(QColor(226, 232, 240))
+    painter.setPen(Qt.NoPen)
+    painter.drawRoundedRect(rect, radius, radius)
+
+    # Barra riempita
+    if percentuale > 0:
+        fill_width = max(int(rect.width() * percentuale / 100), radius * 2)
+
+        # Colore basato su HSV: 0% = rosso (hue=0), 100% = verde (hue=120)
+        hue = min(percentuale, 100) * 1.2
+        painter.setBrush(QColor.fromHsv(int(hue), 180, 200))
+        painter.drawRoundedRect(QRect(rect.x(), rect.y(), fill_width, rect.height()), radius, radius)
+
+    # Testo percentuale
+    painter.setPen(QColor(45, 55, 72))
+    painter.setFont(QFont("system-ui", 12, QFont.Bold))
+    painter.drawText(rect, Qt.AlignCenter, f"{percentuale:.0f}%")
+    painter.restore()
+
+
+class ScorteListModel(QAbstractListModel):
+    """Righe di get_scorte (giacenza aggregata per materiale). Qt.UserRole → riga intera"""
+
+    def __init__(self, db_manager, parent=None):
+        super().__init__(parent)
+        self.db_manager = db_manager
+        self._righe = []
+        self._posizioni = {}  # {materiale_id: riga}
+
+    def imposta_righe(self, righe):
+        self.beginResetModel()
+        self._righe = list(righe)
+        self._posizioni = {r[ID]: i for i, r in enumerate(self._righe)}
+        self.endResetModel()
+
+    def aggiorna_materiale(self, materiale_id):
+        """Rilegge dal database la sola riga del materiale e la ridisegna.
+        Restituisce False se il materiale non è tra le righe mostrate."""
+        row = self._posizioni.get(materiale_id)
+        if row is None:
+            return False
+        riga = self.db_manager.get_scorta_materiale(materiale_id)
+        if riga is None:
+            return False
+        self._righe[row] = riga
+        indice = self.index(row)
+        self.dataChanged.emit(indice, indice)
+        return True
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._righe)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        riga = self._righe[index.row()]
+        if role == Qt.DisplayRole:
+            return riga[NOME]
+        if role == Qt.UserRole:
+            return riga
+        return None
+
+
+class ScortaDelegate(QStyledItemDelegate):
+    """Disegna la card di un materiale; i pulsanti Fornitori/Storico sono aree cliccabili"""
+
+    fornitori_cliccato = pyqtSignal(int, str)
+    storico_cliccato = pyqtSignal(int, str)
+
+    LARGHEZZA_PULSANTE = 100
+    ALTEZZA_PULSANTE = 34
+    ALTEZZA_BARRA = 32
+
+    def _geometria(self, rect, riga):
+        """Rettangoli delle parti della card, da sinistra a destra come nel vecchio layout"""
+        m = get_metrics()
+        area = rect.adjusted(m['mi'], m['sf'], -m['mi'], -m['sf'])
+        spazio = m['sc']
+        cy = area.center().y()
+
+        def colonna(x, larghezza):
+            return QRect(x, area.y(), larghezza, area.height())
+
+        g = {}
+        x = area.x()
+        for nome, larghezza in (('nome', max(140, area.width() // 6)), ('giacenza', 100), ('fornitori', 60)):
+            g[nome] = colonna(x, larghezza)
+            x += larghezza + spazio
+        if riga[SCORTA_MINIMA] > 0 or riga[SCORTA_MASSIMA] > 0:
+            g['min_max'] = colonna(x, 140)
+            x += 140 + spazio
+
+        destra = area.right() + 1
+        for nome in ('storico', 'btn_fornitori'):
+            destra -= self.LARGHEZZA_PULSANTE
+            g[nome] = QRect(destra, cy - self.ALTEZZA_PULSANTE // 2, self.LARGHEZZA_PULSANTE, self.ALTEZZA_PULSANTE)
+            destra -= spazio
+        g['barra'] = QRect(x, cy - self.ALTEZZA_BARRA // 2, max(destra - x, 60), self.ALTEZZA_BARRA)
+        return g
+
+    def sizeHint(self, option, index):
+        m = get_metrics()
+        return QSize(option.rect.width(), max(self.ALTEZZA_PULSANTE, 2 * (m['ft'] - 4)) + 2 * m['sf'] + 8)
+
+    def paint(self, painter, option, index):
+        riga = index.data(Qt.UserRole)
+        if riga is None:
+            return
+        m = get_metrics()
+        g = self._geometria(option.rect, riga)
+        painter.save()
+
+        # Card: sfondo, hover e bordo inferiore
+        sfondo = "#fafbfc" if option.state & QStyle.State_MouseOver else "#ffffff"
+        painter.fillRect(option.rect, QColor(sfondo))
+        painter.setPen(QColor("#f0f0f0"))
+        painter.drawLine(option.rect.bottomLeft(), option.rect.bottomRight())
+
+        # Nome materiale
+        font = QFont(option.font)
+        font.setPixelSize(m['ft'] - 4)
+        font.setWeight(QFont.Bold)
+        painter.setFont(font)
+        painter.setPen(QColor("#2d3748"))
+        painter.drawText(g['nome'], Qt.AlignVCenter | Qt.AlignLeft | Qt.TextWordWrap, riga[NOME])
+
+        # Giacenza e numero fornitori: etichetta piccola sopra, valore sotto
+        forn_text = f"{riga[N_FORNITORI]}" if riga[N_FORNITORI] > 0 else "—"
+        for chiave, etichetta, valore, colore in (
+                ('giacenza', "Giacenza", f"{riga[GIACENZA_TOTALE]:.2f} m²", "#38a169"),
+                ('fornitori', "Fornitori", forn_text, "#4a5568")):
+            r = g[chiave]
+            font_etichetta = QFont(option.font)
+            font_etichetta.setPixelSize(11)
+            painter.setFont(font_etichetta)
+            painter.setPen(QColor("#a0aec0"))
+            painter.drawText(QRect(r.x(), r.y(), r.width(), r.height() // 2), Qt.AlignLeft | Qt.AlignBottom, etichetta)
+            font_valore = QFont(option.font)
+            font_valore.setPixelSize(m['ft'] - 6)
+            font_valore.setWeight(QFont.DemiBold)
+            painter.setFont(font_valore)
+            painter.setPen(QColor(colore))
+            painter.drawText(QRect(r.x(), r.center().y() + 2, r.width(), r.height() // 2),
+                             Qt.AlignLeft | Qt.AlignTop, valore)
+
+        # Scorta minima/massima (se impostate)
+        if 'min_max' in g:
+            font_mm = QFont(option.font)
+            font_mm.setPixelSize(12)
+            painter.setFont(font_mm)
+            painter.setPen(QColor("#718096"))
+            painter.drawText(g['min_max'], Qt.AlignVCenter | Qt.AlignLeft,
+                             f"min {riga[SCORTA_MINIMA]:.1f} / max {riga[SCORTA_MASSIMA]:.1f} m²")
+
+        # Barra scorta
+        percentuale = (riga[GIACENZA_TOTALE] / riga[SCORTA_MASSIMA] * 100) if riga[SCORTA_MASSIMA] > 0 else 0
+        disegna_barra_scorta(painter, g['barra'], percentuale)
+
+        # Pulsanti: Fornitori attivo solo con più di un fornitore
+        attivo = riga[N_FORNITORI] > 1
+        for chiave, testo, sfondo, colore in (
+                ('btn_fornitori', "Fornitori", "#ebf8ff" if attivo else "#f7fafc", "#2b6cb0" if attivo else "#cbd5e0"),
+                ('storico', "Storico", "#f7fafc", "#4a5568")):
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor(sfondo))
+            painter.drawRoundedRect(g[chiave], 6, 6)
+            font_btn = QFont(option.font)
+            font_btn.setPixelSize(13)
+            font_btn.setWeight(QFont.DemiBold)
+            painter.setFont(font_btn)
+            painter.setPen(QColor(colore))
+            painter.drawText(g[chiave], Qt.AlignCenter, testo)
+
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            riga = index.data(Qt.UserRole)
+            if riga is not None:
+                g = self._geometria(option.rect, riga)
+                if g['btn_fornitori'].contains(event.pos()) and riga[N_FORNITORI] > 1:
+                    self.fornitori_cliccato.emit(riga[ID], riga[NOME])
+                    return True
+                if g['storico'].contains(event.pos()):
+                    self.storico_cliccato.emit(riga[ID], riga[NOME])
+                    return True
+        return super().editorEvent(event, model, option, index)
@@ -289,7 +289,8 @@ class VisualizzaModificheDialog(QDialog):
 
     def load_storico(self) -> None:
         """Carica lo storico modifiche dal database"""
-        self.storico = self.db_manager.get_storico_modifiche(self.preventivo_id)
+        # Solo l'indice delle versioni: i dati di una versione si leggono quando viene selezionata
+        self.storico = self.db_manager.get_indice_storico(self.preventivo_id)
         self.preventivo_corrente = self.db_manager.get_preventivo_by_id(self.preventivo_id)
 
         self.lista_versioni.clear()
@@ -307,8 +308,7 @@ class VisualizzaModificheDialog(QDialog):
         self.lista_versioni.addItem(item_corrente)
 
         # Aggiungi versioni nello storico
-        for i, snapshot in enumerate(reversed(self.storico)):
-            timestamp = snapshot.get('timestamp', 'Data sconosciuta')
+        for i, timestamp in enumerate(reversed(self.storico)):
             try:
                 dt = datetime.fromisoformat(timestamp)
                 timestamp_str = dt.strftime("%d/%m/%Y %H:%M:%S")
@@ -353,21 +353,19 @@ class VisualizzaModificheDialog(QDialog):
 
     def mostra_dettagli_versione(self, timestamp: str) -> None:
         """Mostra dettagli di una versione storica"""
-        for snapshot in self.storico:
-            if snapshot['timestamp'] == timestamp:
-                data = snapshot['data']
-
-                try:
-                    dt = datetime.fromisoformat(timestamp)
-                    timestamp_str = dt.strftime("%d/%m/%Y %H:%M:%S")
-                except Exception:
-                    timestamp_str = timestamp
+        data = self.db_manager.get_versione_storico(self.preventivo_id, timestamp)
+        if data is None:
+            self.text_dettagli.setText("Errore: versione non trovata")
+            return
 
-                dettagli = self.formatta_dettagli_preventivo(data, f"VERSIONE DEL {timestamp_str}")
-                self.text_dettagli.setText(dettagli)
-                return
+        try:
+            dt = datetime.fromisoformat(timestamp)
+            timestamp_str = dt.strftime("%d/%m/%Y %H:%M:%S")
+        except Exception:
+            timestamp_str = timestamp
 
-        self.text_dettagli.setText("Errore: versione non trovata")
+        dettagli = self.formatta_dettagli_preventivo(data, f"VERSIONE DEL {timestamp_str}")
+        self.text_dettagli.setText(dettagli)
 
     def formatta_dettagli_preventivo(self, data: Any, titolo: str) -> str:
         """Formatta i dettagli del preventivo per la visualizzazione"""
@@ -436,11 +434,7 @@ class VisualizzaModificheDialog(QDialog):
             return
 
         # Trova la versione selezionata
-        versione_selezionata = None
-        for snapshot in self.storico:
-            if snapshot['timestamp'] == timestamp:
-                versione_selezionata = snapshot['data']
-                break
+        versione_selezionata = self.db_manager.get_versione_storico(self.preventivo_id, timestamp)
 
         if not versione_selezionata or not self.preventivo_corrente:
             QMessageBox.warning(self, "Errore", "Impossibile effettuare il confronto")
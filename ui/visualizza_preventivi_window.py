@@ -28,7 +28,7 @@ v1.0.0 (2026-02-06):
 # pyright: reportUnknownLambdaType=false
 
 from PyQt5.QtWidgets import (QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton,
-                             QWidget, QLabel, QTableWidget, QTableWidgetItem,
+                             QWidget, QLabel, QTableView,
                              QMessageBox, QGroupBox, QFrame, QGraphicsDropShadowEffect,
                              QLineEdit, QComboBox, QAbstractItemView, QSizePolicy,
                              QHeaderView)
@@ -36,6 +36,34 @@ from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QColor
 from typing import Optional, Any
 from ui.responsive import get_metrics
+from ui.filtro_ricerca import FiltroRicerca
+from ui.preventivi_model import (PreventiviTableModel, PreventiviFilterProxyModel, ID, PREVENTIVO_FINALE, PREZZO_CLIENTE,
+                                 NOME_CLIENTE, DESCRIZIONE, NUMERO_REVISIONE, N_MODIFICHE, MISURA)
+
+
+def _tipo_preventivo(riga):
+    """Originale / Rev.#N, con badge se ha modifiche nello storico"""
+    tipo = "Originale" if riga[NUMERO_REVISIONE] == 1 else f"Rev.#{riga[NUMERO_REVISIONE]}"
+    return tipo + " ✎" if riga[N_MODIFICHE] else tipo
+
+
+def _euro(valore):
+    return f"€ {valore:.2f}" if valore is not None else "—"
+
+
+_SINISTRA = Qt.AlignVCenter | Qt.AlignLeft
+_DESTRA = Qt.AlignRight | Qt.AlignVCenter
+
+# Colonne della tabella: (intestazione, testo della cella, allineamento)
+COLONNE_PREVENTIVI = [
+    ("#",           lambda r: f"#{r[ID]:03d}",                Qt.AlignCenter),
+    ("Tipo",        _tipo_preventivo,                          _SINISTRA),
+    ("Cliente",     lambda r: r[NOME_CLIENTE] or "—",          _SINISTRA),
+    ("Misura",      lambda r: r[MISURA] or "—",                _SINISTRA),
+    ("Descrizione", lambda r: r[DESCRIZIONE] or "—",           _SINISTRA),
+    ("Prev. €",     lambda r: _euro(r[PREVENTIVO_FINALE]),     _DESTRA),
+    ("Prezzo €",    lambda r: _euro(r[PREZZO_CLIENTE]),        _DESTRA),
+]
 
 class VisualizzaPreventiviWindow(QMainWindow):
     preventivo_modificato = pyqtSignal()  # Signal per notificare modifiche
@@ -44,6 +72,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
         super().__init__(None)  # No parent per evitare bug ridimensionamento
         self.db_manager = db_manager
         self.parent_window = parent
+        self._totale_preventivi = 0
         self.init_ui()
         self.load_clienti_filtro()
         self.load_preventivi()
@@ -83,7 +112,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
                 background-color: transparent;
                 color: #4a5568;
             }
-            QTableWidget {
+            QTableView {
                 background-color: #ffffff;
                 border: 1px solid #e2e8f0;
                 border-radius: 8px;
@@ -91,19 +120,19 @@ class VisualizzaPreventiviWindow(QMainWindow):
                 font-family: system-ui, -apple-system, sans-serif;
                 gridline-color: #f0f4f8;
             }
-            QTableWidget::item {
+            QTableView::item {
                 padding: 6px 10px;
                 color: #2d3748;
                 border: none;
             }
-            QTableWidget::item:hover {
+            QTableView::item:hover {
                 background-color: #ebf4ff;
             }
-            QTableWidget::item:selected {
+            QTableView::item:selected {
                 background-color: #3b82f6;
                 color: #ffffff;
             }
-            QTableWidget::item:selected:hover {
+            QTableView::item:selected:hover {
                 background-color: #2563eb;
                 color: #ffffff;
             }
@@ -256,7 +285,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
         tipo_label.setStyleSheet("QLabel { font-weight: 500; color: #4a5568; }")
         self.filtro_origine = QComboBox()
         self.filtro_origine.addItems(["Tutti", "Originali", "Revisionati", "Con modifiche"])
-        self.filtro_origine.currentIndexChanged.connect(self.load_preventivi)
+        self.filtro_origine.currentIndexChanged.connect(self.applica_filtri)
         self.filtro_origine.setMinimumWidth(110 if get_metrics()['small'] else 140)
 
         filters_layout.addWidget(tipo_label)
@@ -267,7 +296,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
         cliente_label.setStyleSheet("QLabel { font-weight: 500; color: #4a5568; }")
         self.filtro_cliente = QComboBox()
         self.filtro_cliente.addItem("Tutti i clienti", None)
-        self.filtro_cliente.currentIndexChanged.connect(self.load_preventivi)
+        self.filtro_cliente.currentIndexChanged.connect(self.applica_filtri)
         self.filtro_cliente.setMinimumWidth(140 if get_metrics()['small'] else 180)
 
         filters_layout.addWidget(cliente_label)
@@ -277,8 +306,9 @@ class VisualizzaPreventiviWindow(QMainWindow):
         keyword_label = QLabel("Cerca:")
         keyword_label.setStyleSheet("QLabel { font-weight: 500; color: #4a5568; }")
         self.filtro_keyword = QLineEdit()
-        self.filtro_keyword.setPlaceholderText("ID, cliente, descrizione, codice, prezzo...")
-        self.filtro_keyword.textChanged.connect(self.load_preventivi)
+        self.filtro_keyword.setPlaceholderText("ID, cliente, n° ordine, descrizione, codice, misura, finitura...")
+        # Filtro dopo una pausa di battitura, non a ogni tasto
+        self.filtro_ricerca = FiltroRicerca(self.filtro_keyword, self._filtra_keyword)
 
         filters_layout.addWidget(keyword_label)
         filters_layout.addWidget(self.filtro_keyword, 1)  # Stretch per occupare spazio rimanente
@@ -295,13 +325,14 @@ class VisualizzaPreventiviWindow(QMainWindow):
         lista_layout.setContentsMargins(_lm['sf'], _lm['mi'], _lm['sf'], _lm['sf'])
         lista_layout.setSpacing(_lm['sf'])
 
-        # Tabella principale
-        self.lista_preventivi = QTableWidget()
-        self.lista_preventivi.setColumnCount(7)
-        self.lista_preventivi.setHorizontalHeaderLabels([
-            "#", "Tipo", "Cliente", "Misura",
-            "Descrizione", "Prev. €", "Prezzo €"
-        ])
+        # Tabella principale: modello caricato a pagine mentre si scorre
+        # e filtri (tipo, cliente, parole chiave) passati dal proxy alla query delle pagine
+        self.model_preventivi = PreventiviTableModel(self.db_manager, COLONNE_PREVENTIVI, self)
+        self.proxy_preventivi = PreventiviFilterProxyModel(self)
+        self.proxy_preventivi.setSourceModel(self.model_preventivi)
+        self.proxy_preventivi.rowsInserted.connect(self._aggiorna_conteggio)
+        self.lista_preventivi = QTableView()
+        self.lista_preventivi.setModel(self.proxy_preventivi)
         self.lista_preventivi.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.lista_preventivi.setSelectionMode(QAbstractItemView.SingleSelection)
         self.lista_preventivi.setEditTriggers(QAbstractItemView.NoEditTriggers)
@@ -321,7 +352,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
         hdr.setSectionResizeMode(6, QHeaderView.ResizeToContents)   # Prezzo €
 
         self.lista_preventivi.doubleClicked.connect(self.visualizza_preventivo)
-        self.lista_preventivi.currentItemChanged.connect(self._on_selezione_cambiata)
+        self.lista_preventivi.selectionModel().currentRowChanged.connect(self._on_selezione_cambiata)
         lista_layout.addWidget(self.lista_preventivi)
 
         # Area nota revisione (sotto la tabella)
@@ -497,6 +528,44 @@ class VisualizzaPreventiviWindow(QMainWindow):
         """)
         self.btn_genera.clicked.connect(self.genera_documento)
 
+        # Scarico magazzino dei materiali consumati (o storno se già scaricato)
+        self.btn_scarico = QPushButton("Scarico Magazzino")
+        self.btn_scarico.setStyleSheet("""
+            QPushButton {
+                background-color: #f0fff4;
+                color: #276749;
+                border: 1px solid #c6f6d5;
+                min-height: 38px;
+                min-width: 150px;
+                padding: 8px 16px;
+            }
+            QPushButton:hover {
+                background-color: #c6f6d5;
+            }
+        """)
+        self.btn_scarico.setToolTip("Scarica dal magazzino i materiali del preventivo messo in produzione,\n"
+                                    "o storna lo scarico se il lavoro è stato annullato")
+        self.btn_scarico.clicked.connect(self.scarico_magazzino)
+
+        # Riprezzatura di tutti i preventivi con i prezzi attuali dei materiali
+        self.btn_aggiorna_prezzi = QPushButton("Aggiorna Prezzi")
+        self.btn_aggiorna_prezzi.setStyleSheet("""
+            QPushButton {
+                background-color: #fffaf0;
+                color: #c05621;
+                border: 1px solid #feebc8;
+                min-height: 38px;
+                min-width: 150px;
+                padding: 8px 16px;
+            }
+            QPushButton:hover {
+                background-color: #feebc8;
+            }
+        """)
+        self.btn_aggiorna_prezzi.setToolTip("Ricalcola l'ultima revisione di tutti i preventivi con i prezzi\n"
+                                            "attuali dei materiali e crea le revisioni aggiornate")
+        self.btn_aggiorna_prezzi.clicked.connect(self.aggiorna_prezzi_preventivi)
+
         # Elimina
         self.btn_elimina = QPushButton("Elimina")
         self.btn_elimina.setStyleSheet("""
@@ -515,6 +584,8 @@ class VisualizzaPreventiviWindow(QMainWindow):
         row2.addWidget(self.btn_confronta)
         row2.addWidget(self.btn_anteprima)
         row2.addWidget(self.btn_genera)
+        row2.addWidget(self.btn_scarico)
+        row2.addWidget(self.btn_aggiorna_prezzi)
         row2.addWidget(self.btn_elimina)
 
         buttons_layout.addLayout(row1)
@@ -553,128 +624,64 @@ class VisualizzaPreventiviWindow(QMainWindow):
 
     def _get_current_preventivo_id(self):
         """Restituisce l'id del preventivo della riga selezionata nella tabella, o None"""
-        item = self.lista_preventivi.currentItem()
-        return item.data(Qt.UserRole) if item else None
+        return self.proxy_preventivi.preventivo_id(self.lista_preventivi.currentIndex())
 
     def _on_selezione_cambiata(self, current, previous) -> None:
         """Aggiorna la nota revisione quando cambia la selezione"""
-        if current is None:
-            self.lbl_nota_corrente.setText("—")
-            return
-        row = self.lista_preventivi.currentRow()
-        if row < 0:
-            self.lbl_nota_corrente.setText("—")
-            return
-        id_item = self.lista_preventivi.item(row, 0)
-        if not id_item:
+        preventivo_id = self.proxy_preventivi.preventivo_id(current)
+        if preventivo_id is None:
             self.lbl_nota_corrente.setText("—")
             return
-        preventivo_id = id_item.data(Qt.UserRole)
         prev = self.db_manager.get_preventivo_by_id(preventivo_id)
         nota = (prev.get('note_revisione') or '').strip() if prev else ''
         self.lbl_nota_corrente.setText(nota if nota else "—")
 
+    def _aggiorna_conteggio(self, *args) -> None:
+        """Conteggio: righe caricate su totale dei preventivi filtrati"""
+        caricati = self.proxy_preventivi.rowCount()
+        if caricati < self._totale_preventivi:
+            self.lbl_conteggio.setText(f"{caricati} di {self._totale_preventivi} preventivi caricati (scorri per altri)")
+        else:
+            self.lbl_conteggio.setText(f"{self._totale_preventivi} preventivi visualizzati")
+
     def load_clienti_filtro(self) -> None:
         """Carica la lista dei clienti nel filtro"""
         self.filtro_cliente.clear()
         self.filtro_cliente.addItem("Tutti i clienti", None)
 
         try:
-            preventivi = self.db_manager.get_all_preventivi()
-            clienti = set()
-            for prev in preventivi:
-                if len(prev) >= 5:
-                    nome_cliente = prev[4].strip() if prev[4] else ''
-                    if nome_cliente:
-                        clienti.add(nome_cliente)
-
-            for cliente in sorted(clienti):
+            for cliente in self.db_manager.get_nomi_clienti_distinti():
                 self.filtro_cliente.addItem(cliente, cliente)
         except Exception as e:
             print(f"Errore nel caricamento clienti filtro: {str(e)}")
 
     def load_preventivi(self) -> None:
-        """Carica TUTTI i preventivi con filtri"""
-        self.lista_preventivi.setRowCount(0)
+        """Ricarica i preventivi dal database (prima pagina) con i filtri correnti"""
+        self._applica_filtri(ricarica=True)
+
+    def applica_filtri(self) -> None:
+        """Applica tipo, cliente e parole chiave (in memoria se restringono righe già tutte caricate)"""
+        self._applica_filtri()
+
+    def _applica_filtri(self, ricarica=False) -> None:
         self.lbl_nota_corrente.setText("—")
 
         # Ottieni i valori dei filtri
         filtro_origine_text = self.filtro_origine.currentText()
-        filtro_cliente_data = self.filtro_cliente.currentData()
-        filtro_keyword_text = self.filtro_keyword.text().lower().strip()
+        self.proxy_preventivi.imposta_filtri(
+            tipo={"Originali": 'originali', "Revisionati": 'revisionati'}.get(filtro_origine_text),
+            cliente=self.filtro_cliente.currentData(),
+            keyword=self.filtro_keyword.text(),
+            solo_con_modifiche=(filtro_origine_text == "Con modifiche"),
+            ricarica=ricarica,
+        )
+        self._totale_preventivi = self.proxy_preventivi.totale()
+        self._aggiorna_conteggio()
 
-        # Carica SEMPRE tutti i preventivi
-        if filtro_origine_text == "Con modifiche":
-            preventivi = self.db_manager.get_preventivi_con_modifiche()
-        else:
-            preventivi = self.db_manager.get_all_preventivi()
-
-        count = 0
-        for preventivo in preventivi:
-            # Ottieni i dati del preventivo - LEGGI MISURA DAL DB
-            prev_completo = self.db_manager.get_preventivo_by_id(preventivo[0])
-            if not prev_completo:
-                continue
-
-            id_prev = prev_completo['id']
-            nome_cliente = prev_completo.get('nome_cliente', '')
-            misura = prev_completo.get('misura', '')
-            descrizione = prev_completo.get('descrizione', '')
-            numero_revisione = prev_completo.get('numero_revisione', 1)
-            storico_modifiche = prev_completo.get('storico_modifiche', [])
-
-            # APPLICA FILTRO TIPO
-            if filtro_origine_text == "Originali" and numero_revisione != 1:
-                continue
-            elif filtro_origine_text == "Revisionati" and numero_revisione == 1:
-                continue
-
-            # APPLICA FILTRO CLIENTE
-            if filtro_cliente_data and nome_cliente.strip() != filtro_cliente_data:
-                continue
-
-            # APPLICA FILTRO KEYWORD
-            if filtro_keyword_text:
-                campi_ricerca = [
-                    str(id_prev), str(nome_cliente), str(misura), str(descrizione)
-                ]
-                testo_completo = " ".join(campi_ricerca).lower()
-                if filtro_keyword_text not in testo_completo:
-                    continue
-
-            # Tipo con badge modifiche
-            tipo_preventivo = "Originale" if numero_revisione == 1 else f"Rev.#{numero_revisione}"
-            if storico_modifiche and len(storico_modifiche) > 0:
-                tipo_preventivo += " ✎"
-
-            # Prezzi
-            p_finale = prev_completo.get('preventivo_finale')
-            p_cliente = prev_completo.get('prezzo_cliente')
-            prev_str = f"€ {p_finale:.2f}" if p_finale is not None else "—"
-            prezzo_str = f"€ {p_cliente:.2f}" if p_cliente is not None else "—"
-
-            # Aggiungi riga alla tabella
-            row_idx = self.lista_preventivi.rowCount()
-            self.lista_preventivi.insertRow(row_idx)
-
-            def make_cell(text, align=Qt.AlignVCenter | Qt.AlignLeft):
-                cell = QTableWidgetItem(str(text) if text else "")
-                cell.setTextAlignment(align)
-                cell.setData(Qt.UserRole, id_prev)  # id in ogni cella → compatibile con currentItem()
-                return cell
-
-            self.lista_preventivi.setItem(row_idx, 0, make_cell(f"#{id_prev:03d}", align=Qt.AlignCenter))
-            self.lista_preventivi.setItem(row_idx, 1, make_cell(tipo_preventivo))
-            self.lista_preventivi.setItem(row_idx, 2, make_cell(nome_cliente or "—"))
-            self.lista_preventivi.setItem(row_idx, 3, make_cell(misura or "—"))
-            self.lista_preventivi.setItem(row_idx, 4, make_cell(descrizione or "—"))
-            self.lista_preventivi.setItem(row_idx, 5, make_cell(prev_str, align=Qt.AlignRight | Qt.AlignVCenter))
-            self.lista_preventivi.setItem(row_idx, 6, make_cell(prezzo_str, align=Qt.AlignRight | Qt.AlignVCenter))
-            count += 1
-
-        self.lista_preventivi.resizeRowsToContents()
-        # Aggiorna conteggio
-        self.lbl_conteggio.setText(f"{count} preventivi visualizzati")
+    def _filtra_keyword(self, testo, candidati):
+        """Richiamato da FiltroRicerca: il proxy sceglie se restringere in memoria o rileggere"""
+        self.applica_filtri()
+        return []
 
     def visualizza_preventivo(self) -> None:
         """Visualizza i dettagli del preventivo selezionato"""
@@ -744,8 +751,7 @@ class VisualizzaPreventiviWindow(QMainWindow):
             QMessageBox.warning(self, "Attenzione", "Seleziona un preventivo per visualizzare le modifiche.")
             return
 
-        storico = self.db_manager.get_storico_modifiche(preventivo_id)
-        if not storico:
+        if not self.db_manager.get_indice_storico(preventivo_id):
             QMessageBox.information(self, "Info", "Questo preventivo non ha modifiche nello storico.")
             return
 
@@ -780,6 +786,105 @@ class VisualizzaPreventiviWindow(QMainWindow):
         from ui.main_window_business_logic import MainWindowBusinessLogic
         MainWindowBusinessLogic.genera_documento_preventivo(self)
 
+    def scarico_magazzino(self) -> None:
+        """Scarica i consumi del preventivo selezionato dal magazzino, o li storna se già scaricati"""
+        preventivo_id = self._get_current_preventivo_id()
+        if preventivo_id is None:
+            QMessageBox.warning(self, "Attenzione", "Seleziona un preventivo dalla lista.")
+            return
+
+        scarichi = self.db_manager.get_scarichi_preventivo(preventivo_id)
+        if scarichi:
+            totale = sum(r[3] for r in scarichi)
+            risposta = QMessageBox.question(
+                self, "Preventivo già scaricato",
+                f"I materiali del preventivo #{preventivo_id} sono già stati scaricati "
+                f"({len(scarichi)} movimenti, {totale:.2f} m²).\n\n"
+                f"Vuoi stornare lo scarico (lavoro annullato)? Le quantità tornano in magazzino.",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if risposta != QMessageBox.Yes:
+                return
+            if self.db_manager.storna_consumi_preventivo(preventivo_id) is False:
+                QMessageBox.critical(self, "Errore", "Errore durante lo storno: nessun movimento registrato.")
+                return
+            QMessageBox.information(self, "Successo", "Scarico stornato: le quantità sono tornate in magazzino.")
+            return
+
+        consumi = self.db_manager.get_consumi_preventivo(preventivo_id)
+        if not consumi:
+            QMessageBox.information(self, "Scarico Magazzino",
+                                    "Il preventivo non ha materiali di magazzino da scaricare.")
+            return
+        righe = "\n".join(
+            f"• {c['materiale_nome']}" + (f" ({c['fornitore_nome']})" if c['fornitore_nome'] else "")
+            + f": {c['quantita']:.2f} m²" for c in consumi)
+        # Errori che nemmeno lo scarico forzato supera (fornitore non configurato, materiale
+        # eliminato, errore database): niente conferma, solo il messaggio
+        errori = self.db_manager.valida_movimenti(consumi, verifica_giacenza=False)
+        if errori:
+            QMessageBox.critical(self, "Scarico non possibile", "\n".join(errori))
+            return
+        carenze = self.db_manager.valida_movimenti(consumi)
+        verifica_giacenza = True
+        if carenze:
+            risposta = QMessageBox.question(
+                self, "Giacenza insufficiente",
+                "\n".join(carenze) + "\n\nRegistrare comunque lo scarico? "
+                "Le giacenze insufficienti verranno portate a zero.",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if risposta != QMessageBox.Yes:
+                return
+            verifica_giacenza = False
+        else:
+            risposta = QMessageBox.question(
+                self, "Scarico Magazzino",
+                f"Scaricare dal magazzino i materiali del preventivo #{preventivo_id}?\n\n{righe}",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if risposta != QMessageBox.Yes:
+                return
+
+        ids = self.db_manager.scarica_consumi_preventivo(preventivo_id, verifica_giacenza=verifica_giacenza)
+        if ids is False:
+            QMessageBox.critical(self, "Errore", "Scarico non registrato: nessun movimento è stato salvato.")
+            return
+        QMessageBox.information(self, "Successo", f"Scarico registrato: {len(ids)} movimenti.\n\n{righe}")
+
+    def aggiorna_prezzi_preventivi(self) -> None:
+        """Mostra l'impatto dei prezzi attuali dei materiali su tutti i preventivi e, se
+        confermato, crea una revisione aggiornata per ognuno di quelli che cambiano"""
+        impatto = self.db_manager.riprezza_preventivi()
+        if impatto is None:
+            QMessageBox.critical(self, "Errore", "Errore durante il ricalcolo dei preventivi.")
+            return
+        preventivi, clienti = impatto
+        if not preventivi:
+            QMessageBox.information(self, "Aggiorna Prezzi",
+                                    "Tutti i preventivi sono già allineati ai prezzi attuali dei materiali.")
+            return
+
+        attuale = sum(r[4] for r in preventivi)
+        nuovo = sum(r[5] for r in preventivi)
+        righe = "\n".join(f"• {cliente or 'Senza cliente'}: {n} preventivi, "
+                          f"{_euro(tot_attuale)} → {_euro(tot_nuovo)}"
+                          for cliente, n, tot_attuale, tot_nuovo in clienti[:15])
+        if len(clienti) > 15:
+            righe += f"\n… e altri {len(clienti) - 15} clienti"
+        risposta = QMessageBox.question(
+            self, "Aggiorna Prezzi",
+            f"Con i prezzi attuali cambiano {len(preventivi)} preventivi: "
+            f"{_euro(attuale)} → {_euro(nuovo)} ({nuovo - attuale:+.2f} €).\n\n{righe}\n\n"
+            f"Creare una revisione aggiornata per ognuno? Il prezzo cliente resta invariato.",
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if risposta != QMessageBox.Yes:
+            return
+
+        impatto = self.db_manager.riprezza_preventivi(applica=True)
+        if impatto is None:
+            QMessageBox.critical(self, "Errore", "Aggiornamento non riuscito: nessuna revisione è stata salvata.")
+            return
+        QMessageBox.information(self, "Successo", f"Create {len(impatto[0])} revisioni con i prezzi aggiornati.")
+        self.load_preventivi()
+
     def elimina_preventivo(self) -> None:
         """Elimina il preventivo selezionato"""
         preventivo_id = self._get_current_preventivo_id()
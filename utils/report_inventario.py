@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+© 2025 RCS - Software Proprietario
+Report inventario di magazzino in HTML
+Uso riservato esclusivamente a RCS
+
+Non dipende da PyQt5: lo usa "Stampa Inventario" del magazzino e si può eseguire
+anche da riga di comando (es. da Utilità di pianificazione) per salvare una
+fotografia dell'inventario:
+
+    python -m utils.report_inventario --cartella Z:\\RCS\\inventari
+    python -m utils.report_inventario --db Z:\\RCS\\materiali.db --cartella inventari
+"""
+
+import os
+import sys
+import html
+import argparse
+from itertools import groupby
+from datetime import datetime
+
+# Stili in un solo blocco <style> (una classe per cella) invece che ripetuti su ogni cella:
+# con migliaia di righe gli stili in linea erano quasi tutto il documento
+STILE = """
+td { border:1px solid #cbd5e0; padding:8px 12px; font-size:14px; }
+th { border:1px solid #a0aec0; padding:10px 12px; background:#edf2f7; font-size:14px; font-weight:bold; text-align:left; }
+.n { text-align:right; }
+td.f { padding:6px 12px; font-size:13px; color:#4a5568; background:#f7fafc; }
+td.fnum { padding:6px 12px; font-size:13px; color:#4a5568; background:#f7fafc; text-align:right; }
+td.fn { padding:6px 12px 6px 28px; font-size:13px; color:#4a5568; background:#f7fafc; }
+"""
+
+INTESTAZIONE = """<html><head><meta charset="utf-8"><style>{stile}</style></head>
+<body style="font-family: Arial, sans-serif; margin: 0; padding: 0;">
+<h2 style="font-size:18px; margin-bottom:4px; margin-top:0;">Inventario Magazzino — Software Aziendale RCS</h2>
+<p style="font-size:12px; color:#718096; margin-top:0; margin-bottom:8px;">Generato il {generato_il}</p>
+<table style="border-collapse:collapse; width:100%;">
+<thead>
+<tr><th>Materiale</th><th class="n">Giac. Tot (m²)</th><th class="n">Scorta Min</th><th class="n">Scorta Max</th>
+<th class="n">% Agg.</th><th>Fornitore</th><th class="n">Giac. Forn (m²)</th><th class="n">Min Forn</th><th class="n">% Forn</th></tr>
+</thead>
+<tbody>
+"""
+
+CHIUSURA = """</tbody>
+</table>
+</body></html>"""
+
+
+def _percentuale(giacenza, massimo):
+    return f"{(giacenza / massimo * 100):.0f}%" if massimo > 0 else "—"
+
+
+def righe_html_inventario(righe):
+    """Pezzi HTML delle righe della tabella, uno per materiale o fornitore, a partire
+    dalle righe di DatabaseManager.get_righe_inventario (già ordinate per materiale)"""
+    for _, gruppo in groupby(righe, key=lambda r: r[0]):
+        gruppo = list(gruppo)
+        _, nome, giacenza, s_max, _, _, s_min = gruppo[0][:7]
+        yield (f'<tr><td><b>{html.escape(nome)}</b></td><td class="n"><b>{giacenza:.2f}</b></td>'
+               f'<td class="n">{s_min or 0.0:.2f}</td><td class="n">{s_max:.2f}</td>'
+               f'<td class="n">{_percentuale(giacenza, s_max)}</td><td>—</td>'
+               f'<td class="n">—</td><td class="n">—</td><td class="n">—</td></tr>\n')
+        for riga in gruppo:
+            fornitore, giacenza, s_min, s_max = riga[7:11]
+            if fornitore is None:
+                continue
+            yield (f'<tr><td class="f"></td><td class="fnum"></td><td class="fnum"></td><td class="fnum"></td>'
+                   f'<td class="fnum"></td><td class="fn">↳ {html.escape(fornitore)}</td>'
+                   f'<td class="fnum">{giacenza:.2f}</td><td class="fnum">{s_min:.2f}</td>'
+                   f'<td class="fnum">{_percentuale(giacenza, s_max)}</td></tr>\n')
+
+
+def genera_html_inventario(db_manager, generato_il=None):
+    """HTML completo del report inventario (una query, pezzi uniti con join)"""
+    generato_il = generato_il or datetime.now()
+    parti = [INTESTAZIONE.format(stile=STILE, generato_il=generato_il.strftime("%d/%m/%Y %H:%M"))]
+    parti.extend(righe_html_inventario(db_manager.get_righe_inventario()))
+    parti.append(CHIUSURA)
+    return "".join(parti)
+
+
+def salva_inventario(db_manager, cartella, generato_il=None):
+    """Scrive il report in cartella/inventario_AAAAMMGG_HHMM.html e ne restituisce il percorso"""
+    generato_il = generato_il or datetime.now()
+    os.makedirs(cartella, exist_ok=True)
+    percorso = os.path.join(cartella, f"inventario_{generato_il.strftime('%Y%m%d_%H%M')}.html")
+    with open(percorso, "w", encoding="utf-8") as f:
+        f.write(genera_html_inventario(db_manager, generato_il))
+    return percorso
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Salva una fotografia dell'inventario di magazzino in HTML")
+    parser.add_argument("--db", default=None, help="percorso del database (default: quello di config.json)")
+    parser.add_argument("--cartella", default="inventari", help="cartella in cui salvare il report")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from database.db_manager import DatabaseManager
+
+    db = DatabaseManager(db_path=args.db)
+    try:
+        print(salva_inventario(db, args.cartella))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()